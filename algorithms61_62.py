@@ -3,98 +3,670 @@
 algorithms 61 and 62 following chapter 6 of bengio book
 
 a reverse adjacency list representation of nodes presumed
-to satisfy ordering of v_0, .... v_n-1 as input nodes (leaves)
-of graph, and all v_j in Parent(v_i) => j < i,
-aka all inputs are lesser-indexed.
+to satisfy all v_j in Parent(v_i) => j < i,
+aka all inputs are lesser-indexed. nodes without parents are the
+input nodes (leaves) of the graph, with values x[i] for leaf v_i.
 
 implements algorithms 61 and 62: forward and backprop on this representation.
+FlatCGraph holds the same graph in compressed sparse row arrays with
+integer op codes for the elementary nodes, and batch_value_and_grad
+runs a whole minibatch through the graph at once, leaf values
+carrying a leading batch dimension.
 
 """
 import random
+import time
+from array import array
+
+import numpy as np
+
+from metrics import PrintSink
+from optimizers import SGD, LeafParams
+from profiling import op_name
+from stopping import StoppingCriteria, TrainingResult
 
 
 class SimpleCGraph:
     # graph as list of nodes and reverse adjacency list
-    # presumed to satisfy ordering of v_0, .... v_n-1 as input nodes (leaves)
-    # of graph, and all v_j in Parent(v_i) => j < i,
+    # presumed to satisfy all v_j in Parent(v_i) => j < i,
     # aka all inputs are lesser-indexed.
+    # nodes without parents are input nodes (leaves) of graph.
     def __init__(self, reverse_adj, nodes):
         # reverse adj dict: reverse_adj[i] = list of parents of v_i
         # nodes = list of SimpleNodes in order nodes[i] = v_i
         self.reverse_adj = reverse_adj
         self.nodes = nodes
+        n = len(nodes)
+        self.leaf_indices = [i for i in range(n) if not reverse_adj.get(i)]
+        self.op_indices = [i for i in range(n) if reverse_adj.get(i)]
+        self._forward_adj = None
+
+    @property
+    def forward_adj(self):
+        # forward adj list: forward_adj[j] = list of (i, slot) pairs with
+        # v_j the parent of v_i at input slot reverse_adj[i][slot].
+        # built on first use, as it costs a tuple per edge
+        if self._forward_adj is None:
+            self._forward_adj = build_forward_adj(self.reverse_adj, len(self.nodes))
+        return self._forward_adj
+
+
+def build_forward_adj(reverse_adj, n):
+    """ Inverts the reverse adjacency list into a forward adjacency
+    list of (child index, input slot) pairs, so walking the
+    children of all nodes is linear in the number of edges.
+    Children appear in reverse_adj iteration order.
+    """
+    forward_adj = [[] for _ in range(n)]
+    for i in reverse_adj:
+        for slot, j in enumerate(reverse_adj[i]):
+            forward_adj[j].append((i, slot))
+    return forward_adj
+
+
+class Node:
+    """ base of the SimpleCGraph nodes: f(arr) the value on the list
+    of parent values arr, vjp(g, arr) the contributions of g to the
+    grad_table entries of all parents at once, val the evaluated value """
 
+    __slots__ = ('val',)
 
-class SimpleNode:
+    def __init__(self, val=None):
+        self.val = val
+
+    def f(self, arr):
+        raise NotImplementedError
+
+    def vjp(self, g, arr):
+        raise NotImplementedError
+
+    def pd(self, arr):
+        # partial derivatives wrt. all parents
+        return self.vjp(1., arr)
+
+
+class SimpleNode(Node):
     """ Operates with function f on parent node values
     to hold an evaluated value val """
 
+    # the functions are stored on the node, taking the place of the
+    # f and pd methods of Node
+    __slots__ = ('f', 'pd')
+
     def __init__(self, f, pd, val=None):
         self.f = f
         self.pd = pd
         self.val = val
 
-    def partial_derivative(self, child_index, cx):
-        return self.pd(cx)[child_index]
+    def vjp(self, g, cx):
+        # contributions from the full partials vector pd(cx), nodes
+        # with a cheaper vector-Jacobian product subclass Node
+        return [g * p for p in self.pd(cx)]
+
+
+# elementary node functions f and partial derivatives pd,
+# on the list of parent values arr
+
+
+def sum_f(arr):
+    # g(a1, a2, ...) = a1 + a2 + ...
+    return sum(arr)
+
+
+def sum_pd(arr):
+    return [1] * len(arr)
+
+
+def sqdiff_f(arr):
+    # g(a1, a2, a3, ...) = (a1 - a2 - a3 - ... )^2
+    return (arr[0] - sum(arr[1:])) ** 2
+
+
+def sqdiff_pd(arr):
+    return [2 * (arr[0] - sum(arr[1:]))] + \
+           [-2 * (arr[0] - sum(arr[1:]))] * (len(arr) - 1)
+
+
+def dot_f(arr):
+    # g(w, x) = <w, x>, w the first half of arr and x the second half
+    dotp = 0.
+    m = int(len(arr)/2)
+    for i in range(m):
+        dotp += arr[i] * arr[i + m]
+    return dotp
+
+
+def dot_pd(arr):
+    # del g del ni = x_i for first half, w_i for second half
+    m = int(len(arr)/2)
+    return arr[m:] + arr[:m]
+
 
+# op codes for FlatCGraph node kinds
+OP_LEAF = 0
+OP_SUM = 1
+OP_SQDIFF = 2
+OP_DOT = 3
+OP_NODE = 4  # any other node, evaluated through its f and vjp
 
-def alg61(cgraph, x):
+OP_CODES = {sum_f: OP_SUM, sqdiff_f: OP_SQDIFF, dot_f: OP_DOT}
+# elementary node functions of the op codes, leaves get a sum node
+OP_FUNCTIONS = {OP_LEAF: (sum_f, sum_pd), OP_SUM: (sum_f, sum_pd),
+                OP_SQDIFF: (sqdiff_f, sqdiff_pd), OP_DOT: (dot_f, dot_pd)}
+
+
+class FlatCGraph:
+    """ compact array-backed form of a SimpleCGraph with float values,
+    in compressed sparse row layout:
+    parents of v_i are parents[offsets[i]:offsets[i+1]],
+    vals[i] is the value of v_i and ops[i] its op code.
+    nodes with op code OP_NODE keep their node in custom[i].
+    alg61, alg62 and value_and_grad run directly on this form.
+
+    graphs whose op nodes average fewer than NARROW_FANIN parents
+    (chains, mlps up to about 60 wide) are swept on plain lists, as
+    numpy slicing per node costs more than it saves on few parents;
+    wider graphs with one vectorized numpy op per node.
+    """
+
+    NARROW_FANIN = 64
+
+    def __init__(self, offsets, parents, ops, custom=None):
+        self.ops = np.asarray(ops, dtype=np.int8)
+        index_dtype = np.int32 if len(self.ops) < 2**31 else np.int64
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.parents = np.asarray(parents, dtype=index_dtype)
+        self.n = len(self.ops)
+        self.vals = np.zeros(self.n)
+        self.custom = custom if custom is not None else {}
+        self.leaf_indices = np.flatnonzero(self.ops == OP_LEAF)
+        self.op_indices = np.flatnonzero(self.ops != OP_LEAF)
+        self._narrow_plan = None
+
+    def narrow_plan(self):
+        """ (i, op, parent list) of the op nodes if the graph is narrow
+        enough to sweep on lists, else None """
+        if self._narrow_plan is None:
+            n_ops = len(self.op_indices)
+            if len(self.parents) >= self.NARROW_FANIN * max(n_ops, 1):
+                self._narrow_plan = False
+            else:
+                offsets = self.offsets.tolist()
+                parents, ops = self.parents.tolist(), self.ops.tolist()
+                self._narrow_plan = [
+                    (i, ops[i], parents[offsets[i]:offsets[i + 1]])
+                    for i in self.op_indices.tolist()]
+        return self._narrow_plan or None
+
+    @classmethod
+    def from_cgraph(cls, cgraph):
+        n = len(cgraph.nodes)
+        offsets = array('q', [0])
+        parents = array('q')
+        ops = array('b')
+        custom = {}
+        for i in range(n):
+            parent_indices = cgraph.reverse_adj.get(i)
+            if not parent_indices:
+                ops.append(OP_LEAF)
+            else:
+                op = OP_CODES.get(cgraph.nodes[i].f, OP_NODE)
+                if op == OP_NODE:
+                    custom[i] = cgraph.nodes[i]
+                ops.append(op)
+                parents.extend(parent_indices)
+            offsets.append(len(parents))
+        return cls(offsets, parents, ops, custom)
+
+    def to_cgraph(self):
+        """ the graph as a SimpleCGraph, leaves with [] in reverse_adj """
+        offsets, parents = self.offsets.tolist(), self.parents.tolist()
+        reverse_adj = {i: parents[offsets[i]:offsets[i + 1]]
+                       for i in range(self.n)}
+        nodes = [self.custom[i] if op == OP_NODE
+                 else SimpleNode(*OP_FUNCTIONS[op])
+                 for i, op in enumerate(self.ops.tolist())]
+        return SimpleCGraph(reverse_adj, nodes)
+
+
+def _narrow_forward(fgraph, plan, x):
+    # forward sweep on a list of values, copied to fgraph.vals
+    vals = [0.] * fgraph.n
+    for i in fgraph.leaf_indices.tolist():
+        vals[i] = x[i]
+    for i, op, ps in plan:
+        if op == OP_SUM:
+            vals[i] = sum([vals[j] for j in ps])
+        elif op == OP_DOT:
+            m = len(ps) // 2
+            vals[i] = sum([vals[j] * vals[k] for j, k in zip(ps[:m], ps[m:])])
+        elif op == OP_SQDIFF:
+            vals[i] = (vals[ps[0]] - sum([vals[j] for j in ps[1:]])) ** 2
+        else:
+            vals[i] = fgraph.custom[i].f([vals[j] for j in ps])
+    fgraph.vals[:] = vals
+    return vals
+
+
+def flat_alg61(fgraph, x):
+    """ alg61 on a FlatCGraph, one vectorized op per node (narrow
+    graphs on lists) """
+    plan = fgraph.narrow_plan()
+    if plan is not None:
+        return _narrow_forward(fgraph, plan, x)[-1]
+    vals, parents = fgraph.vals, fgraph.parents
+    offsets, ops = fgraph.offsets.tolist(), fgraph.ops.tolist()
+    for i in fgraph.leaf_indices.tolist():
+        vals[i] = x[i]
+    for i in fgraph.op_indices.tolist():
+        op = ops[i]
+        a, b = offsets[i], offsets[i + 1]
+        if op == OP_DOT:
+            m = (b - a) // 2
+            vals[i] = vals[parents[a:a + m]] @ vals[parents[a + m:b]]
+        elif op == OP_SUM:
+            vals[i] = vals[parents[a:b]].sum()
+        elif op == OP_SQDIFF:
+            vals[i] = (vals[parents[a]] - vals[parents[a + 1:b]].sum()) ** 2
+        else:
+            vals[i] = fgraph.custom[i].f(vals[parents[a:b]].tolist())
+    return vals[fgraph.n - 1].item()
+
+
+def flat_value_and_grad(fgraph, x, grad_table=None):
+    """ value_and_grad on a FlatCGraph: grad_table is a float64 array,
+    zeroed and written in place if given """
+    plan = fgraph.narrow_plan()
+    if plan is not None:
+        return _narrow_value_and_grad(fgraph, plan, x, grad_table)
+    root_val = flat_alg61(fgraph, x)
+    vals, parents = fgraph.vals, fgraph.parents
+    offsets, ops = fgraph.offsets.tolist(), fgraph.ops.tolist()
+    if grad_table is None:
+        grad_table = np.zeros(fgraph.n)
+    else:
+        grad_table.fill(0.)
+    grad_table[fgraph.n - 1] = 1.
+    # np.add.at accumulates correctly for repeated parents
+    for i in reversed(fgraph.op_indices.tolist()):
+        g = grad_table[i]
+        op = ops[i]
+        a, b = offsets[i], offsets[i + 1]
+        if op == OP_DOT:
+            m = (b - a) // 2
+            w, xp = parents[a:a + m], parents[a + m:b]
+            np.add.at(grad_table, w, g * vals[xp])
+            np.add.at(grad_table, xp, g * vals[w])
+        elif op == OP_SUM:
+            np.add.at(grad_table, parents[a:b], g)
+        elif op == OP_SQDIFF:
+            d = 2 * (vals[parents[a]] - vals[parents[a + 1:b]].sum())
+            grad_table[parents[a]] += g * d
+            np.add.at(grad_table, parents[a + 1:b], g * -d)
+        else:
+            cx = vals[parents[a:b]].tolist()
+            np.add.at(grad_table, parents[a:b], fgraph.custom[i].vjp(g, cx))
+    return root_val, grad_table
+
+
+def _narrow_value_and_grad(fgraph, plan, x, grad_table):
+    vals = _narrow_forward(fgraph, plan, x)
+    grads = [0.] * fgraph.n
+    grads[-1] = 1.
+    for i, op, ps in reversed(plan):
+        g = grads[i]
+        if op == OP_SUM:
+            for j in ps:
+                grads[j] += g
+        elif op == OP_DOT:
+            m = len(ps) // 2
+            for j, k in zip(ps[:m], ps[m:]):
+                grads[j] += g * vals[k]
+                grads[k] += g * vals[j]
+        elif op == OP_SQDIFF:
+            d = g * 2 * (vals[ps[0]] - sum([vals[j] for j in ps[1:]]))
+            grads[ps[0]] += d
+            for j in ps[1:]:
+                grads[j] -= d
+        else:
+            cx = [vals[j] for j in ps]
+            for j, gj in zip(ps, fgraph.custom[i].vjp(g, cx)):
+                grads[j] += gj
+    if grad_table is None:
+        grad_table = np.array(grads)
+    else:
+        grad_table[:] = grads
+    return vals[-1], grad_table
+
+
+def alg61(cgraph, x, inputs=None, profiler=None):
     """ Computes outputs for a given computational graph
     on inputs x, aka forward-propagation
+    x is indexed by node: leaf v_i takes value x[i]
+    if an inputs list is given, inputs[i] is set to the list of
+    parent values v_i was evaluated on
+    if a profiling.Profiler is given, node evaluations are timed
     """
-    for i, v in enumerate(x):
-        cgraph.nodes[i].val = v
-    k = len(x)
-    n = len(cgraph.nodes)
-    for i in range(k, n):
+    if isinstance(cgraph, FlatCGraph):
+        if profiler is not None:
+            start = time.perf_counter()
+            root_val = flat_alg61(cgraph, x)
+            profiler.add('forward', None, 'flat_alg61',
+                         time.perf_counter() - start)
+            return root_val
+        return flat_alg61(cgraph, x)
+    if profiler is not None:
+        return _profiled_alg61(cgraph, x, inputs, profiler)
+    for i in cgraph.leaf_indices:
+        cgraph.nodes[i].val = x[i]
+    for i in cgraph.op_indices:
         parent_indices = cgraph.reverse_adj[i]
         parent_vals = [cgraph.nodes[ix].val for ix in parent_indices]
+        if inputs is not None:
+            inputs[i] = parent_vals
         cgraph.nodes[i].val = cgraph.nodes[i].f(parent_vals)
     return cgraph.nodes[-1].val
 
 
+class Workspace:
+    """ buffers for value_and_grad and batch_value_and_grad on one
+    graph, reused across calls rather than allocated per call:
+    the parent values recorded by the forward sweep and grad_table.
+    the grad_table returned with a workspace is workspace.grad_table,
+    overwritten by the next call.
+    """
+
+    def __init__(self, cgraph):
+        if isinstance(cgraph, FlatCGraph):
+            self.inputs = None
+            self.grad_table = np.zeros(cgraph.n)
+        else:
+            n = len(cgraph.nodes)
+            self.inputs = [None] * n
+            self.grad_table = [0.] * n
+
+
+def _profiled_alg61(cgraph, x, inputs, profiler):
+    # alg61 timing each node evaluation
+    clock = time.perf_counter
+    nodes = cgraph.nodes
+    for i in cgraph.leaf_indices:
+        nodes[i].val = x[i]
+    for i in cgraph.op_indices:
+        parent_vals = [nodes[ix].val for ix in cgraph.reverse_adj[i]]
+        if inputs is not None:
+            inputs[i] = parent_vals
+        start = clock()
+        nodes[i].val = nodes[i].f(parent_vals)
+        profiler.add('forward', i, op_name(nodes[i]), clock() - start)
+    return nodes[-1].val
+
+
 def alg62(cgraph, x):
     """ back-propagation
     grad_table is list of del root / del node
     """
-    alg61(cgraph, x)  # forward prop., setting vals at nodes.
+    _, grad_table = value_and_grad(cgraph, x)
+    return grad_table
+
+
+def value_and_grad(cgraph, x, grad_root=1., workspace=None, out=None,
+                   profiler=None):
+    """ Fused forward and back-propagation step:
+    a single forward sweep (alg61) followed by the backward sweep,
+    reusing the parent values recorded during the forward sweep.
+    Returns the root value and grad_table.
+    Buffers come from workspace (a Workspace of cgraph) if given;
+    grad_table is written into out if given, a caller-owned list or
+    float64 array of one entry per node (an array for FlatCGraph).
+    If a profiling.Profiler is given, both sweeps are timed.
+    """
+    if out is None and workspace is not None:
+        out = workspace.grad_table
+    if isinstance(cgraph, FlatCGraph):
+        if profiler is not None:
+            start = time.perf_counter()
+            result = flat_value_and_grad(cgraph, x, out)
+            profiler.add('step', None, 'flat_value_and_grad',
+                         time.perf_counter() - start)
+            return result
+        return flat_value_and_grad(cgraph, x, out)
+    if workspace is not None:
+        inputs = workspace.inputs
+    else:
+        inputs = [None] * len(cgraph.nodes)
+    root_val = alg61(cgraph, x, inputs, profiler)
+    return root_val, _backward(cgraph, inputs, grad_root, out, profiler)
+
+
+def _backward(cgraph, inputs, grad_root, grad_table=None, profiler=None):
+    # backward sweep on the parent values recorded by alg61:
+    # each node's grad_table entry is complete once all its
+    # (higher-indexed) children are done, and is then scattered
+    # to its parents through one vjp call
     n = len(cgraph.nodes)
     # partial derivatives of all nodes wrt. root
-    # grad_table[i] = del root del v_i
-    grad_table = [0.] * n
-    grad_table[n-1] = 1.
-    for j in range(n-2, -1, -1):
-        # would be faster with adj list given, not just reverse adj list
-        child_indices = []
-        grad_table_j = 0.
-        for i in cgraph.reverse_adj:
-            if j in cgraph.reverse_adj[i]:
-                child_indices.append(i)
-                parent_vals = [cgraph.nodes[ix].val for ix in cgraph.reverse_adj[i]]
-                pd_ix = cgraph.reverse_adj[i].index(j)
-                grad_table_j += grad_table[i] * cgraph.nodes[i].partial_derivative(pd_ix, parent_vals)
-        grad_table[j] = grad_table_j
+    # grad_table[i] = del root del v_i, zeroed in place if given
+    if grad_table is None:
+        grad_table = [0.] * n
+    elif isinstance(grad_table, np.ndarray):
+        grad_table.fill(0.)
+    else:
+        grad_table[:] = [0.] * n
+    grad_table[n-1] = grad_root
+    reverse_adj = cgraph.reverse_adj
+    nodes = cgraph.nodes
+    if profiler is not None:
+        _profiled_backward_sweep(cgraph, inputs, grad_table, profiler)
+        return grad_table
+    for i in reversed(cgraph.op_indices):
+        contributions = nodes[i].vjp(grad_table[i], inputs[i])
+        for j, c in zip(reverse_adj[i], contributions):
+            grad_table[j] = grad_table[j] + c
     return grad_table
 
 
+def _profiled_backward_sweep(cgraph, inputs, grad_table, profiler):
+    # the backward sweep of _backward timing each vjp call
+    clock = time.perf_counter
+    reverse_adj = cgraph.reverse_adj
+    nodes = cgraph.nodes
+    for i in reversed(cgraph.op_indices):
+        start = clock()
+        contributions = nodes[i].vjp(grad_table[i], inputs[i])
+        profiler.add('backward', i, op_name(nodes[i]), clock() - start)
+        for j, c in zip(reverse_adj[i], contributions):
+            grad_table[j] = grad_table[j] + c
+
+
+def batch_value_and_grad(cgraph, x, mean=True, workspace=None,
+                         profiler=None):
+    """ value_and_grad on a whole minibatch at once:
+    batched leaves hold arrays with a leading batch dimension
+    (x[i][b] the value for example b), the rest of x is shared
+    across the batch, and the root is the per-example loss of shape (B,).
+    Returns the loss and grad_table with each leaf entry summed over
+    the batch to the shape of x[i], or averaged if mean.
+    (entries at non-leaf nodes are left per-example.)
+    Buffers come from workspace and timings go to profiler if given,
+    as for value_and_grad.
+    """
+    if isinstance(cgraph, FlatCGraph):
+        raise Exception("batched evaluation needs a SimpleCGraph, "
+                        "FlatCGraph holds float values only.")
+    if workspace is not None:
+        inputs, grad_table = workspace.inputs, workspace.grad_table
+    else:
+        inputs, grad_table = [None] * len(cgraph.nodes), None
+    root_val = np.asarray(alg61(cgraph, x, inputs, profiler))
+    grad_table = _backward(cgraph, inputs, np.ones_like(root_val), grad_table,
+                           profiler)
+    return _batch_reduce(cgraph.leaf_indices, x, root_val, grad_table, mean)
+
+
+def _batch_reduce(leaf_indices, x, root_val, grad_table, mean):
+    # sum (or average) the per-example loss and leaf gradients
+    # over the batch
+    batch_size = root_val.shape[0]
+    for i in leaf_indices:
+        g = np.asarray(grad_table[i])
+        while g.ndim > np.ndim(x[i]):
+            g = g.sum(axis=0)
+        if mean:
+            g = g / batch_size
+        grad_table[i] = g.item() if g.ndim == 0 else g
+    loss = root_val.sum().item()
+    return (loss / batch_size if mean else loss), grad_table
+
+
 def run_backprop_algorithm(cgraph, x, param_indices,
                            learning_rate=1e-3,
                            n_iterations=10**5,
-                           print_freq=10**4):
+                           print_freq=10**4,
+                           compiled=False,
+                           profiler=None,
+                           metrics=None,
+                           optimizer=None,
+                           stopping=None,
+                           checkpoint=None,
+                           remat=None):
     """ Run the backpropagation algorithm: alternatively call
-    alg61 and alg62.
+    alg61 and alg62, fused into a single value_and_grad step.
     Optimize the subset of leaf values identified as parameters by
-    the param_indices list.
+    the param_indices list, with the optimizer (optimizers.Optimizer),
+    by default SGD(learning_rate).
+    If compiled, steps run through generated code (codegen), or if a
+    remat.Rematerialization is given, with checkpointed activations.
+    If a profiling.Profiler is given, steps and iterations are timed.
+    Iterations are logged to the metrics sink (metrics.MetricsSink),
+    by default printed every print_freq iterations.
+    Runs n_iterations, or until the stopping criteria
+    (stopping.StoppingCriteria) are met.
+    With a checkpoint.Checkpointer, params and optimizer state are
+    checkpointed every checkpoint.every iterations, and a run resumes
+    from an existing checkpoint.
+    Returns a stopping.TrainingResult.
     """
-    for i in range(n_iterations):
-        alg61(cgraph, x)
-        grad_table = alg62(cgraph, x)
-        for ix in param_indices:
-            param_update = -learning_rate * grad_table[ix]
-            x[ix] += param_update
-        if i % print_freq == 0:
-            print(f'param values: {[x[_] for _ in param_indices]}')
-            print(f'loss: {cgraph.nodes[-1].val}')
+    if metrics is None:
+        metrics = PrintSink(print_freq)
+    if optimizer is None:
+        optimizer = SGD(learning_rate)
+    first = 0
+    if checkpoint is not None:
+        first, _ = checkpoint.restore(x, optimizer)
+    params = LeafParams(x, param_indices)
+    step, _ = _step_functions(cgraph, compiled, profiler, remat)
+    run_start = time.perf_counter()
+    if stopping is not None:
+        stopping.start()
+    losses = []
+    reason = None
+    for i in range(first, n_iterations):
+        timed = profiler is not None or i % metrics.every == 0
+        if timed:
+            start = time.perf_counter()
+        loss, grad_table = step(x)
+        grad = params.gradient(grad_table)
+        optimizer.step(params.vector, grad)
+        params.write_back()
+        losses.append(loss)
+        if timed:
+            _end_iteration(i, start, loss, x, param_indices, metrics, profiler)
+        if checkpoint is not None and checkpoint.due(i + 1):
+            checkpoint.save(i + 1, x, param_indices, cgraph, optimizer)
+        if stopping is not None:
+            reason = stopping.check(i, loss, grad, x)
+            if reason is not None:
+                break
+    metrics.flush()
+    return _training_result(x, param_indices, losses, reason, run_start,
+                            stopping)
+
+
+def _training_result(x, param_indices, losses, reason, start, stopping):
+    # TrainingResult of a run started at time start,
+    # with copies of array valued params
+    params = [np.copy(x[ix]) if np.ndim(x[ix]) else x[ix]
+              for ix in param_indices]
+    validation_losses = None
+    if stopping is not None:
+        validation_losses = stopping.validation_losses
+    return TrainingResult(params, losses, reason or 'n_iterations',
+                          len(losses), time.perf_counter() - start,
+                          validation_losses)
+
+
+def _end_iteration(i, start, loss, x, param_indices, metrics, profiler,
+                   **info):
+    # report iteration i, started at time start, to the profiler
+    # and (if due) the metrics sink
+    seconds = time.perf_counter() - start
+    if profiler is not None:
+        profiler.iteration(seconds, loss=None if loss is None else float(loss),
+                           **info)
+    if i % metrics.every == 0:
+        metrics.log(dict(step=i, loss=loss,
+                         params=[x[_] for _ in param_indices],
+                         seconds=seconds, **info))
+
+
+def _step_functions(cgraph, compiled, profiler=None, remat=None):
+    # value_and_grad and batch_value_and_grad on cgraph as functions of x,
+    # through code generated by codegen.compile_cgraph if compiled,
+    # checkpointed by remat (a remat.Rematerialization) if given,
+    # otherwise sharing one Workspace across steps
+    if remat is not None:
+        if compiled or isinstance(cgraph, FlatCGraph):
+            raise Exception("remat needs an uncompiled SimpleCGraph.")
+        step = lambda x: remat.value_and_grad(cgraph, x)
+        batch_step = lambda x: remat.batch_value_and_grad(cgraph, x)
+        if profiler is None:
+            return step, batch_step
+        return (_timed(step, 'remat_value_and_grad', profiler),
+                _timed(batch_step, 'remat_batch_value_and_grad', profiler))
+    if compiled:
+        import codegen
+        before = codegen.cache_info()
+        compiled_graph = codegen.compile_cgraph(cgraph)
+        step = compiled_graph.value_and_grad
+        batch_step = compiled_graph.batch_value_and_grad
+        if profiler is None:
+            return step, batch_step
+        after = codegen.cache_info()
+        profiler.count('codegen_cache_hits', after['hits'] - before['hits'])
+        profiler.count('codegen_cache_misses',
+                       after['misses'] - before['misses'])
+        return (_timed(step, 'compiled_value_and_grad', profiler),
+                _timed(batch_step, 'compiled_batch_value_and_grad', profiler))
+    workspace = Workspace(cgraph)
+    return (lambda x: value_and_grad(cgraph, x, workspace=workspace,
+                                     profiler=profiler),
+            lambda x: batch_value_and_grad(cgraph, x, workspace=workspace,
+                                           profiler=profiler))
+
+
+def _timed(step, op, profiler):
+    # step recording its time as one call of op
+    def timed_step(x):
+        start = time.perf_counter()
+        result = step(x)
+        profiler.add('step', None, op, time.perf_counter() - start)
+        return result
+    return timed_step
+
+
+def _minibatches(xb, batch_size, order):
+    # (x values, y values) per shuffled minibatch of xb, a list of data
+    # points taken in order, a list of their indices shuffled in place,
+    # or a dataset with a batches method
+    if hasattr(xb, 'batches'):
+        yield from xb.batches(batch_size, seed=random.getrandbits(32))
+        return
+    random.shuffle(order)
+    for j in range(0, len(xb), batch_size):
+        xb_minibatch = [xb[t] for t in order[j:j + batch_size]]
+        yield [xb_e[0] for xb_e in xb_minibatch], \
+            [xb_e[1] for xb_e in xb_minibatch]
 
 
 def run_backprop_algorithm_batches(cgraph, xb, x, param_indices,
@@ -102,34 +674,154 @@ def run_backprop_algorithm_batches(cgraph, xb, x, param_indices,
                                    batch_size=10,
                                    learning_rate=1e-3,
                                    n_iterations=10**5,
-                                   print_freq=10**2):
-
-    ns = len(xb)
-    for i in range(n_iterations):
-        random.shuffle(xb)
-        for j in range(0, ns-batch_size, batch_size):
-            xb_minibatch = xb[j:j + batch_size]
-            del_ix = {}
-            for ix in param_indices:
-                del_ix[ix] = 0.
-
-            for xb_e in xb_minibatch:
+                                   print_freq=10**2,
+                                   batched=False,
+                                   compiled=False,
+                                   profiler=None,
+                                   metrics=None,
+                                   optimizer=None,
+                                   stopping=None,
+                                   checkpoint=None,
+                                   remat=None):
+    """ Run minibatch backpropagation over the data points xb,
+    a list of (x values, y value) tuples assigned to the leaves
+    data_indices[:-1] and data_indices[-1] respectively.
+    If batched, each minibatch runs through the graph at once
+    (batch_value_and_grad), otherwise one example at a time.
+    xb may also be a datasets.MemmapDataset, streamed from disk in
+    shuffled minibatches.
+    If compiled, steps run through generated code (codegen), or if a
+    remat.Rematerialization is given, with checkpointed activations.
+    If a profiling.Profiler is given, steps and iterations (epochs)
+    are timed.
+    Iterations are logged to the metrics sink (metrics.MetricsSink),
+    by default printed every print_freq iterations.
+    Params are updated once per minibatch with the mean gradient by the
+    optimizer (optimizers.Optimizer), by default SGD(learning_rate).
+    Runs n_iterations epochs, or until the stopping criteria
+    (stopping.StoppingCriteria) are met, checked after each epoch with
+    its mean loss and the gradient of its last minibatch.
+    With a checkpoint.Checkpointer, params, optimizer state, data order
+    and the state of the random module are checkpointed every
+    checkpoint.every epochs, at the end of the epoch, and a run resumes
+    from an existing checkpoint at the start of the next epoch (steps
+    taken after the last checkpoint are redone).
+    Returns a stopping.TrainingResult.
+    """
+    if metrics is None:
+        metrics = PrintSink(print_freq)
+    if optimizer is None:
+        optimizer = SGD(learning_rate)
+    first, order = 0, None
+    if checkpoint is not None:
+        first, order = checkpoint.restore(x, optimizer, random)
+    if order is None and not hasattr(xb, 'batches'):
+        order = list(range(len(xb)))
+    params = LeafParams(x, param_indices)
+    grad_sum = np.empty_like(params.vector)
+    step, batch_step = _step_functions(cgraph, compiled, profiler, remat)
+    run_start = time.perf_counter()
+    if stopping is not None:
+        stopping.start()
+    losses = []
+    reason = None
+    loss = grad = None
+    for i in range(first, n_iterations):
+        timed = profiler is not None or i % metrics.every == 0
+        if timed:
+            start = time.perf_counter()
+        n_steps = 0
+        loss_sum, n_seen = 0., 0
+        for xs, ys in _minibatches(xb, batch_size, order):
+            n_steps += 1
+            n_seen += len(ys)
+            if batched:
+                xs = np.asarray(xs)
+                for m, xdata_ix in enumerate(data_indices[:-1]):
+                    x[xdata_ix] = xs[:, m]  # x values
+                x[data_indices[-1]] = np.asarray(ys)
+                batch_loss, grad_table = batch_step(x)
+                loss_sum += batch_loss * len(ys)
+                grad = params.gradient(grad_table)
+                optimizer.step(params.vector, grad)
+                params.write_back()
+                continue
+
+            if isinstance(xs, np.ndarray):
+                xs, ys = xs.tolist(), ys.tolist()
+            grad_sum.fill(0.)
+            for xs_e, y in zip(xs, ys):
                 for m, xdata_ix in enumerate(data_indices[:-1]):
-                    x[xdata_ix] = xb_e[0][m]  # x values
-                x[data_indices[-1]] = xb_e[1]  # y value
-                alg61(cgraph, x)
-                grad_table = alg62(cgraph, x)
-                for ix in param_indices:
-                    param_update = -learning_rate * grad_table[ix]
-                    del_ix[ix] += param_update
+                    x[xdata_ix] = xs_e[m]  # x values
+                x[data_indices[-1]] = y  # y value
+                example_loss, grad_table = step(x)
+                loss_sum += example_loss
+                grad_sum += params.gradient(grad_table)
 
             # mini-batch param update
-            for ix in param_indices:
-                x[ix] += del_ix[ix] / batch_size
+            grad_sum /= len(ys)
+            grad = grad_sum
+            optimizer.step(params.vector, grad)
+            params.write_back()
+
+        # mean loss of the epoch's examples, each at the params it
+        # was evaluated with
+        loss = loss_sum / n_seen
+        losses.append(loss)
+        if timed:
+            _end_iteration(i, start, loss, x, param_indices, metrics, profiler,
+                           steps=n_steps)
+        if checkpoint is not None and checkpoint.due(i + 1):
+            checkpoint.save(i + 1, x, param_indices, cgraph, optimizer, order,
+                            random)
+        if stopping is not None:
+            reason = stopping.check(i, loss, grad, x)
+            if reason is not None:
+                break
+    metrics.flush()
+    return _training_result(x, param_indices, losses, reason, run_start,
+                            stopping)
 
-        if i % print_freq == 0:
-            print(f'param values: {[x[_] for _ in param_indices]}')
-            print(f'loss: {cgraph.nodes[-1].val}')
+
+def train_validation_split(xb, validation_fraction=0.2, seed=None):
+    """ shuffled (training, validation) lists of the data points xb,
+    validation_fraction of them held out for validation """
+    xb = list(xb)
+    random.Random(seed).shuffle(xb)
+    n_validation = int(round(len(xb) * validation_fraction))
+    return xb[n_validation:], xb[:n_validation]
+
+
+def validation_loss(cgraph, xb, data_indices, batch_size=10):
+    """ function of the leaf values x to the mean loss of cgraph over
+    the data points xb (a list of (x values, y value) tuples or a
+    datasets.MemmapDataset), evaluated in batches of batch_size points
+    (so a dataset is read a batch at a time), for
+    StoppingCriteria(validation=...) """
+    if isinstance(cgraph, FlatCGraph):
+        raise Exception("validation loss needs a SimpleCGraph, "
+                        "FlatCGraph holds float values only.")
+
+    def chunks():
+        for j in range(0, len(xb), batch_size):
+            if hasattr(xb, 'batches'):
+                rows = np.asarray(xb.data[j:j + batch_size])
+                yield rows[:, :-1], rows[:, -1]
+            else:
+                chunk = xb[j:j + batch_size]
+                yield np.array([xb_e[0] for xb_e in chunk], dtype=float), \
+                    np.array([xb_e[1] for xb_e in chunk], dtype=float)
+
+    def loss(x):
+        x = list(x)
+        loss_sum = 0.
+        for xs, ys in chunks():
+            for m, xdata_ix in enumerate(data_indices[:-1]):
+                x[xdata_ix] = xs[:, m]
+            x[data_indices[-1]] = ys
+            loss_sum += np.sum(alg61(cgraph, x)).item()
+        return loss_sum / len(xb)
+    return loss
 
 
 def sample_graph_structure():
@@ -188,31 +880,34 @@ def mlp_graph_structure(n, k):
     """
     if n % 2 != 0:
         raise Exception("n must be even.")
-    reverse_adj = {}
-    for l in range(k-1):
-        weights_indices = list(range(n*l, int(n*(l + 0.5))))
-        layer_input_indices = list(range(int(n*(l + 0.5)), n*(l+1)))
-        for n1 in weights_indices + layer_input_indices:
-            if n1 not in reverse_adj:
-                reverse_adj[n1] = []
-
-        next_layer_inputs = list(range(int(n*(l+1 + 0.5)), int(n*((l+2)))))
-        for n2 in next_layer_inputs:
-            if n2 not in reverse_adj:
-                reverse_adj[n2] = []
-            for parent_n2 in weights_indices + layer_input_indices:
-                reverse_adj[n2].append(parent_n2)
-
-    # output node f(x)
-    if n*k not in reverse_adj:
-        reverse_adj[n*k] = []
-    for parent_n in range(n*(k-1), n*k):
-        reverse_adj[n*k].append(parent_n)
-    # output target node y
-    reverse_adj[n*k + 1] = []
-    # node (y - f(x))^2, w/ parents as y, f(x)
-    reverse_adj[n*k + 2] = [n*k + 1, n*k]
-    return reverse_adj
+    return _mlp_builder(n, k).reverse_adj()
+
+
+def _mlp_builder(n, k):
+    # mlp_graph_structure(n, k) built layer by layer, see its docstring
+    from graph_builder import LayeredGraphBuilder
+    builder = LayeredGraphBuilder()
+    m = n // 2
+    builder.add_leaves(n)
+    for l in range(k - 1):
+        # weights of layer l + 1, then its inputs <w, z> over layer l
+        builder.add_leaves(m)
+        builder.add_dense_layer(m, np.arange(n*l, n*(l + 1)), OP_DOT)
+    # output node f(x), target leaf y and (y - f(x))^2
+    builder.add_dense_layer(1, np.arange(n*(k - 1), n*k), OP_DOT)
+    builder.add_leaves(1)
+    builder.add_layer([[n*k + 1, n*k]], OP_SQDIFF)
+    return builder
+
+
+def mlp_flat_cgraph(n, k):
+    """
+    mlp_cgraph(n, k) as a FlatCGraph, built directly in csr form
+    without going through reverse_adj
+    """
+    if n % 2 != 0:
+        raise Exception("n must be even.")
+    return _mlp_builder(n, k).flat_cgraph()
 
 
 def example1():
@@ -223,10 +918,8 @@ def example1():
         """
         computational graph f(a,b,c) = a + b + c
         """
-        def f(arr): return sum(arr)
-        def pd(arr): return [1] * len(arr)
         n = 6
-        nodes = [SimpleNode(f, pd, None) for _ in range(n)]
+        nodes = [SimpleNode(sum_f, sum_pd, None) for _ in range(n)]
         cgraph = SimpleCGraph(reverse_adj, nodes)
         return cgraph
 
@@ -243,15 +936,8 @@ def example2():
         """
         computational graph of f(a, b) = ((a-b)^2 - c^2)^2
         """
-
-        def f(arr): return (arr[0] - sum(arr[1:])) ** 2
-
-        def pd(arr):
-            return [2 * (arr[0] - sum(arr[1:]))] + \
-                   [-2 * (arr[0] - sum(arr[1:]))] * (len(arr) - 1)
-
         n = 6
-        nodes = [SimpleNode(f, pd, None) for _ in range(n)]
+        nodes = [SimpleNode(sqdiff_f, sqdiff_pd, None) for _ in range(n)]
         cgraph = SimpleCGraph(reverse_adj, nodes)
         return cgraph
 
@@ -262,71 +948,82 @@ def example2():
     run_backprop_algorithm(cg2, x, param_indices=[0, 1])
 
 
-def mlp_example():
+def mlp_cgraph(n, k):
     """
-    mlp
+    computational graph on mlp_graph_structure(n, k),
+    weight dot products <w, x> as elementary nodes and
+    a final square difference node (y - f(x))^2
     """
-    n, k = 6, 2
     reverse_adj = mlp_graph_structure(n, k)
+    # <w, x> nodes
+    main_nodes = [SimpleNode(dot_f, dot_pd, None) for _ in range(n*k + 1)]
+    y_node = [SimpleNode(dot_f, dot_pd, None)]  # dummy node for y (leaf) variable
+    sq_loss_node = [SimpleNode(sqdiff_f, sqdiff_pd, None)]  # for (y - f(x))^2 node
+    nodes = main_nodes + y_node + sq_loss_node
+    cgraph = SimpleCGraph(reverse_adj, nodes)
+    return cgraph
 
-    def cgraph3():
-
-        def f(arr):
-            # = <w, x>
-            dotp = 0.
-            m = int(len(arr)/2)
-            for i in range(m):
-                dotp += arr[i] * arr[i + m]
-            return dotp
-
-        # for (y-f(x))^2
-        def fb(arr): return (arr[0] - sum(arr[1:])) ** 2
-        def pdb(arr):
-            return [2 * (arr[0] - sum(arr[1:]))] + \
-                   [-2 * (arr[0] - sum(arr[1:]))] * (len(arr) - 1)
-
-        def pd(arr):
-            # y = <w,x>
-            # del y del ni = x_i for first half, w_i for second half
-            m = int(len(arr)/2)
-            return arr[m:] + arr[:m]
-
-        main_nodes = [SimpleNode(f, pd, None) for _ in range(n*k + 1)]
-        y_node = [SimpleNode(f, pd, None)]  # dummy node for y (leaf) variable
-        sq_loss_node = [SimpleNode(fb, pdb, None)]  # for (y - f(x))^2 node
-        nodes = main_nodes + y_node + sq_loss_node
-        cgraph = SimpleCGraph(reverse_adj, nodes)
-        return cgraph
 
-    cgraph_mlp = cgraph3()
-    # all input values plus initial parameter values- aka all leaf values
-    # k layers each n / 2 leaf weights,
+def mlp_leaves(n, k):
+    """
+    initial leaf values x for mlp_cgraph(n, k), indexed by node,
+    with param_indices the weight leaves and data_indices the
+    input leaves followed by the target y leaf
+    """
+    # all input values plus initial parameter values- aka all leaf values,
+    # indexed by node: k layers each n / 2 leaf weights,
     # first layer has n total leaves because of additional n/2 inputs
-    # plus target y as leaf
-    # => (k-1) * n / 2 + n + 1 total # of leaves
+    # plus target y as leaf nk + 1
+    # (entries of x at non-leaf nodes are unused)
     d = int(n/2)  # dim. of input
     x_inputs = [random.normalvariate(0., 1.) for _ in range(d)]
     y_input = 1.
-    x = [random.random() for _ in range(int((k-1) * n/2 + n + 1))]
-    x[-1] = y_input
+    x = [random.random() for _ in range(n*k + 3)]
+    x[n*k + 1] = y_input
     x[d:n] = x_inputs
     # param_indices to train are weights only:
     # nodes nl, ..., n(l + 1/2) - 1 for l = 0,...., k-1
     param_indices = [e for l in range(k) for
                      e in list(range(n*l, int(n*(l + 0.5))))]
+    data_indices = list(range(d, n)) + [n*k + 1]  # y leaf
+    return x, param_indices, data_indices
+
+
+def mlp_data(n, ns):
+    """
+    ns training points (x, y), half around 1. with y = 1.,
+    half around -1. with y = -1.
+    """
+    return [([random.normalvariate(1., 1.) for dim in range(n)], 1.) for _ \
+            in range(ns//2)] + \
+           [([random.normalvariate(-1., 1.) for dim in range(n)], -1.) for _ \
+            in range(ns // 2)]
+
+
+def mlp_example():
+    """
+    mlp
+    """
+    n, k = 6, 2
+    cgraph_mlp = mlp_cgraph(n, k)
+    x, param_indices, data_indices = mlp_leaves(n, k)
 
     ns = 100  # of training points
-    xy_batch = [([random.normalvariate(1., 1.) for dim in range(n)], 1.) for _ \
-                in range(ns//2)] + \
-               [([random.normalvariate(-1., 1.) for dim in range(n)], -1.) for _ \
-                in range(ns // 2)]
-
-    data_indices = list(range(d, n)) + [len(x)-2]  # 2nd to last index = y
-    run_backprop_algorithm_batches(cgraph_mlp,
-                                   xb=xy_batch,
-                                   x=x,
-                                   param_indices=param_indices,
-                                   data_indices=data_indices)
+    xy_batch = mlp_data(n, ns)
+    # stop once the loss on held out points stops improving
+    xy_train, xy_validation = train_validation_split(xy_batch, 0.2)
+    stopping = StoppingCriteria(
+        validation=validation_loss(cgraph_mlp, xy_validation, data_indices),
+        patience=20)
+
+    result = run_backprop_algorithm_batches(cgraph_mlp,
+                                            xb=xy_train,
+                                            x=x,
+                                            param_indices=param_indices,
+                                            data_indices=data_indices,
+                                            batched=True,
+                                            stopping=stopping)
+    print(result)
 
 
 if __name__ == "__main__":
@@ -81,7 +81,11 @@ ref. https://www.redwrasse.io/notes/backpropagation
 
 
 """
-import sys
+import time
+
+from metrics import PrintSink
+from optimizers import SGD, NodeParams
+from stopping import StoppingCriteria, TrainingResult
 
 
 def functional(x):
@@ -116,48 +120,166 @@ def direct_gradient_descent():
     assert abs(a - (-1 / 8.)) < 10e-4, "a did not converge to -1 / 8."
 
 
+class GraphError(Exception):
+    """ invalid or incomplete graph """
+
+
 class NodeFunction(object):
 
     def __init__(self, name, n_inputs):
         self.name = name
         self.n_inputs = n_inputs
         self.children = []
+        self.parents = []
         self.is_complete = False
+        # flat schedule of the graph below this node, children first,
+        # compiled by set_complete
+        self.schedule = None
         self.direct_params = set()
-        self.indirect_params = set()
-
-    def set_complete(self):
-        print('registering nodes ...')
-        self._register()
-        print('finished registering nodes.')
-        print('registering param dependencies with nodes ...')
-        self.build_indirect_params()
-        print('finished registering params with nodes.')
+        # param -> position of the params of the graph below this (root)
+        # node in schedule order, and the nodes with a param at or below
+        # them, built by set_complete. nodes keep no param sets of their
+        # own: a set per node of its dependency cone is quadratic in depth
+        # on chains with a param per node.
+        self.param_index = None
+        self._param_nodes = None
+        # (params, wanted, nodes) of the last subset of params asked for
+        # by backward_all, as training asks for the same ones each step
+        self._subset_nodes = None
+        # all_params of a complete node, built on first use
+        self._all_params = None
+        # schedule of infer, built on first use
+        self._inference_plan = None
+
+    def set_complete(self, verbose=False):
+        # compile the schedule and param sets, printing each
+        # registration if verbose
+        if verbose:
+            print('registering nodes ...')
+        self._register(verbose)
+        if verbose:
+            print('finished registering nodes.')
+            print('registering param dependencies with nodes ...')
+        self.build_indirect_params(verbose)
+        if verbose:
+            print('finished registering params with nodes.')
+
+    def _topological_order(self, skip=None):
+        """ nodes of the graph below this node, each once, children
+        before parents and this node last, by iterative depth-first
+        search. nodes for which skip(node) is true are left out
+        along with their descendants """
+        order = []
+        visited = {self}
+        stack = [(self, 0)]
+        while stack:
+            node, i = stack[-1]
+            if i < len(node.children):
+                stack[-1] = (node, i + 1)
+                child = node.children[i]
+                if child not in visited and not (skip and skip(child)):
+                    visited.add(child)
+                    stack.append((child, 0))
+            else:
+                stack.pop()
+                order.append(node)
+        return order
 
     def all_params(self):
-        return self.direct_params.union(self.indirect_params)
-
-    def _add_indirect_param(self, param):
-        self.indirect_params.add(param)
-
-    def build_indirect_params(self):
-        for child in self.children:
-            child_indirect_params = child.build_indirect_params()
-            self.indirect_params = self.indirect_params.union(child_indirect_params)
-        print(f'built indirect param set {[_.name for _ in self.indirect_params]} for node [{self.name}]')
-        return self.direct_params.union(self.indirect_params)
-
-    def _register(self):
-        all_names = set()
-        for i, child in enumerate(self.children):
-            c_all_names = child._register()
-            if not all_names.isdisjoint(c_all_names):
-                print('error: duplicate node names. exiting')
-                sys.exit(0)
-            all_names = all_names.union(c_all_names)
-            print(f'registered: child [{child.name}] of [{self.name}] at index {i}.')
-        self.is_complete = True
-        return all_names
+        # params of this node and its descendants, cached once the node
+        # is complete
+        if self._all_params is not None:
+            return self._all_params
+        if self.param_index is not None:
+            params = frozenset(self.param_index)
+        else:
+            params = set()
+            for node in self._topological_order():
+                params.update(node.direct_params)
+            params = frozenset(params)
+        if self.is_complete:
+            self._all_params = params
+        return params
+
+    def has_param(self, param):
+        # whether param is a direct or indirect param of this node
+        return param in self.all_params()
+
+    def build_indirect_params(self, verbose=False):
+        # number the params of the graph below this (root) node in
+        # schedule order into param_index, and collect the nodes with a
+        # param at or below them for pruning backward_all
+        schedule = self.schedule or self._topological_order()
+        param_index = {}
+        param_nodes = set()
+        for node in schedule:
+            for param in node.direct_params:
+                param_index.setdefault(param, len(param_index))
+            if node.direct_params or \
+                    any(child in param_nodes for child in node.children):
+                param_nodes.add(node)
+        self.param_index = param_index
+        self._param_nodes = param_nodes
+        self._subset_nodes = None
+        if verbose:
+            below = {}
+            for node in schedule:
+                indirect_params = set()
+                for child in node.children:
+                    indirect_params.update(below[child])
+                below[node] = indirect_params | node.direct_params
+                print(f'built indirect param set {[_.name for _ in indirect_params]} for node [{node.name}]')
+        return param_index
+
+    def _params_below(self, params=None):
+        # params asked for (default all, a mapping in schedule order) and
+        # the nodes of this (root) graph with any of them at or below,
+        # for pruning backward_all
+        if params is None:
+            return self.param_index, self._param_nodes
+        wanted = frozenset(params)
+        if self._subset_nodes is None or self._subset_nodes[0] != wanted:
+            nodes = set()
+            for node in self.schedule:
+                if not wanted.isdisjoint(node.direct_params) or \
+                        any(child in nodes for child in node.children):
+                    nodes.add(node)
+            self._subset_nodes = (wanted, nodes)
+        return self._subset_nodes
+
+    def _invalidate(self):
+        # mark this node and all its ancestors incomplete and drop their
+        # schedules and param sets. a complete node has complete
+        # descendants, and only complete nodes cache, so stop at an
+        # invalidated one.
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if not node.is_complete and node.param_index is None:
+                continue
+            node.is_complete = False
+            node.schedule = None
+            node._inference_plan = None
+            node.param_index = None
+            node._param_nodes = None
+            node._subset_nodes = None
+            node._all_params = None
+            stack.extend(node.parents)
+
+    def _register(self, verbose=False):
+        # compile the graph below this (root) node into a flat schedule,
+        # children before parents, checking node names are unique
+        schedule = self._topological_order()
+        nodes_by_name = {}
+        for node in schedule:
+            if nodes_by_name.setdefault(node.name, node) is not node:
+                raise GraphError(f'duplicate node name [{node.name}].')
+            for i, child in enumerate(node.children):
+                if verbose:
+                    print(f'registered: child [{child.name}] of [{node.name}] at index {i}.')
+            node.is_complete = True
+        self.schedule = schedule
+        return set(nodes_by_name)
 
     def evaluate(self, xi):
         # value
@@ -174,65 +296,176 @@ class NodeFunction(object):
 
     def add_child(self, child):
         self.children.append(child)
+        child.parents.append(self)
+        self._invalidate()
 
     # get evaluation points by forward prop
     # and store in dict forward_store
-    def forward_prop(self, leaf_x, forward_store):
+    def forward_prop(self, leaf_x, forward_store, workspace=None,
+                     profiler=None):
+        # node evaluations are timed if a profiling.Profiler is given
         if not self.is_complete:
-            print('error: graph not complete. exiting')
-            sys.exit(0)
-        if not self.children:
-            forward_store[self.name] = leaf_x
-            return self.evaluate(leaf_x)
+            raise GraphError('graph not complete, call set_complete.')
+        schedule = self.schedule or self._topological_order()
+        if workspace is not None:
+            outputs = workspace.outputs
+            outputs.clear()
         else:
-            xi = []
-            for child in self.children:
-                xc = child.forward_prop(leaf_x, forward_store)
-                xi.append(xc)
+            outputs = {}
+        if profiler is not None:
+            self._profiled_forward(schedule, leaf_x, forward_store, outputs,
+                                   profiler)
+            return outputs[self]
+        for node in schedule:
+            if not node.children:
+                forward_store[node.name] = leaf_x
+                outputs[node] = node.evaluate(leaf_x)
+                continue
+            xi = [outputs[child] for child in node.children]
             if len(xi) == 1:
-                forward_store[self.name] = xi[0]
-                return self.evaluate(xi[0])
-            forward_store[self.name] = xi
-            return [self.evaluate(xc) for xc in xi]
-
-    def _compute_beta(self, param, forward_store, ksi_store,
-                      k_store):
-        beta = 0.
-        xi = forward_store[self.name]
-        # cache lookup
-        if self.name in ksi_store:
-            ksi = ksi_store[self.name]
+                forward_store[node.name] = xi[0]
+                outputs[node] = node.evaluate(xi[0])
+            else:
+                forward_store[node.name] = xi
+                outputs[node] = [node.evaluate(xc) for xc in xi]
+        return outputs[self]
+
+    def infer(self, leaf_x):
+        """ value of this (root) node at leaf_x, as forward_prop but
+        without a forward_store: each output is dropped once its last
+        parent has run, and no state is kept between calls, so
+        concurrent calls (from several threads) are safe """
+        if not self.is_complete:
+            raise GraphError('graph not complete, call set_complete.')
+        plan = self._inference_plan or self._build_inference_plan()
+        outputs = {}
+        for node, children, release in plan:
+            if not children:
+                outputs[node] = node.evaluate(leaf_x)
+            elif len(children) == 1:
+                outputs[node] = node.evaluate(outputs[children[0]])
+            else:
+                outputs[node] = [node.evaluate(outputs[child])
+                                 for child in children]
+            for child in release:
+                del outputs[child]
+        return outputs[self]
+
+    def _build_inference_plan(self):
+        # (node, children, children whose last parent is node)
+        # in schedule order
+        schedule = self.schedule or self._topological_order()
+        last_parent = {}
+        for node in schedule:
+            for child in node.children:
+                last_parent[child] = node
+        plan = []
+        for node in schedule:
+            release = tuple(child for child in dict.fromkeys(node.children)
+                            if last_parent[child] is node)
+            plan.append((node, tuple(node.children), release))
+        self._inference_plan = plan
+        return plan
+
+    def backward_all(self, forward_store, params=None, workspace=None,
+                     out=None, profiler=None):
+        """ reverse traversal from this (root) node computing the
+        derivative of the root wrt. every param (or just params, if
+        given) in one pass: dict param -> derivative, accumulating
+        ksi of each node into its direct params.
+        the dicts come from workspace if given, the returned one being
+        workspace.grads (or out, a caller-owned dict, if given),
+        cleared and refilled by each call.
+        derivative evaluations are timed and pruned subgraphs counted
+        if a profiling.Profiler is given """
+        if not self.is_complete:
+            raise GraphError('graph not complete, call set_complete.')
+        wanted, relevant = self._params_below(params)
+        schedule = self.schedule or self._topological_order()
+        if workspace is not None:
+            adjoints = workspace.adjoints
+            adjoints.clear()
+            if out is None:
+                out = workspace.grads
+        else:
+            adjoints = {}
+        if out is not None:
+            grads = out
+            grads.clear()
         else:
-            ksi = self.param_derivative(xi)
-            ksi_store[self.name] = ksi
-        beta += ksi
-        #print(f'ksi for node [{self.name}]: {ksi}')
-        for input_index, child in enumerate(self.children):
-            if param in child.all_params():
-                # cache lookup
-                if child.name in k_store:
-                    k = k_store[child.name]
+            grads = {}
+        # adjoints[node] = del root / del node output, complete once
+        # all the node's parents (later in the schedule) have run
+        adjoints[self] = 1.
+        if profiler is not None:
+            self._profiled_backward(schedule, forward_store, wanted, relevant,
+                                    adjoints, grads, profiler)
+            return grads
+        for node in reversed(schedule):
+            adjoint = adjoints.pop(node, None)
+            if adjoint is None:
+                continue
+            xi = forward_store[node.name]
+            ksi = node.param_derivative(xi)
+            for param in node.direct_params:
+                if param in wanted:
+                    grads[param] = grads.get(param, 0.) + adjoint * ksi
+            for input_index, child in enumerate(node.children):
+                # skip subgraphs without any of the params asked for
+                if child in relevant:
+                    k = node.derivative(xi, input_index)
+                    adjoints[child] = adjoints.get(child, 0.) + adjoint * k
+        return grads
+
+    def _profiled_forward(self, schedule, leaf_x, forward_store, outputs,
+                          profiler):
+        # forward_prop loop timing each node's evaluations
+        clock = time.perf_counter
+        for node in schedule:
+            if not node.children:
+                xi = leaf_x
+            else:
+                xi = [outputs[child] for child in node.children]
+                if len(xi) == 1:
+                    xi = xi[0]
+            forward_store[node.name] = xi
+            start = clock()
+            if len(node.children) > 1:
+                outputs[node] = [node.evaluate(xc) for xc in xi]
+            else:
+                outputs[node] = node.evaluate(xi)
+            profiler.add('forward', node.name, type(node).__name__,
+                         clock() - start)
+
+    def _profiled_backward(self, schedule, forward_store, wanted, relevant,
+                           adjoints, grads, profiler):
+        # backward_all loop timing each node's derivative evaluations
+        clock = time.perf_counter
+        for node in reversed(schedule):
+            adjoint = adjoints.pop(node, None)
+            if adjoint is None:
+                profiler.count('backward_unreached_nodes')
+                continue
+            xi = forward_store[node.name]
+            start = clock()
+            ksi = node.param_derivative(xi)
+            ks = []
+            for input_index, child in enumerate(node.children):
+                if child in relevant:
+                    ks.append((child, node.derivative(xi, input_index)))
                 else:
-                    k = self.derivative(xi, input_index)
-                    k_store[child.name] = k
-                #print(f'k[{self.name}][{child.name}]: {k}')
-                beta_c = child._compute_beta(param, forward_store,
-                                             ksi_store, k_store)
-                beta += k * beta_c
-        #print(f'beta for node [{self.name}]: {beta}')
-        return beta
+                    profiler.count('backward_pruned_subgraphs')
+            profiler.add('backward', node.name, type(node).__name__,
+                         clock() - start)
+            for param in node.direct_params:
+                if param in wanted:
+                    grads[param] = grads.get(param, 0.) + adjoint * ksi
+            for child, k in ks:
+                adjoints[child] = adjoints.get(child, 0.) + adjoint * k
 
     def backward_prop(self, param, forward_store):
-        #print(f"running backprop from root node [{self.name}] on param '{param.name}' ... ")
-        if not self.is_complete:
-            print('error: graph not complete. exiting')
-            sys.exit(0)
-        #print('finished backprop.')
-        ksi_store = {}
-        k_store = {}
-        return self._compute_beta(param, forward_store,
-                                  ksi_store,
-                                  k_store)
+        # derivative of the root wrt. a single param
+        return self.backward_all(forward_store, [param]).get(param, 0.)
 
 
 class Add(NodeFunction):
@@ -269,6 +502,19 @@ class Mult(NodeFunction):
         return xi
 
 
+class Workspace(object):
+    """ dicts for forward_prop and backward_all, created once by a
+    training loop and reused across iterations instead of allocated
+    per call. forward_store is refilled with the same keys each
+    forward_prop on the same graph. """
+
+    def __init__(self):
+        self.forward_store = {}
+        self.outputs = {}
+        self.adjoints = {}
+        self.grads = {}
+
+
 class Param(object):
 
     def __init__(self, name, init_value):
@@ -282,7 +528,7 @@ class Param(object):
         self.value = value
 
 
-def sample_graph():
+def sample_graph(verbose=False):
     # build computation graph
     params = []
     a = Param('a', 1.)
@@ -293,13 +539,16 @@ def sample_graph():
     mult.add_child(mult2)
     add.add_child(mult)
     graph = add
-    graph.set_complete()
+    graph.set_complete(verbose)
     return params, graph
 
 
-def run_forwardprop_iter(graph, x):
-    forward_store = {}
-    graph.forward_prop(x, forward_store)
+def run_forwardprop_iter(graph, x, workspace=None):
+    if workspace is not None:
+        forward_store = workspace.forward_store
+    else:
+        forward_store = {}
+    graph.forward_prop(x, forward_store, workspace)
     return forward_store
 
 
@@ -308,32 +557,78 @@ def run_backprop_iter(graph, param, forward_store):
     return graph.backward_prop(param, forward_store)
 
 
-def run_backprop_algorithm():
+def run_backprop_algorithm(metrics=None, optimizer=None, stopping=None):
+    if stopping is not None and stopping.validation is not None:
+        raise Exception("validation stopping needs leaf values x, "
+                        "run_backprop_algorithm trains Param nodes.")
 
     # build graph and initial parameter values
-    params, graph = sample_graph()
-    # learning rate
-    eta = 1e-3
-    # number of iterations
+    params, graph = sample_graph(verbose=True)
+    # default optimizer, learning rate 1e-3
+    if optimizer is None:
+        optimizer = SGD(1e-3)
+    # at most n_iter iterations, by default until the gradient vanishes
     n_iter = 10**4
+    if stopping is None:
+        stopping = StoppingCriteria(grad_tol=1e-6)
+    workspace = Workspace()
+    node_params = NodeParams(params)
+    if metrics is None:
+        metrics = PrintSink(1000, format=format_updated_params)
+    start = time.perf_counter()
+    stopping.start()
+    losses = []
+    reason = None
     for i in range(n_iter):
-        run_iteration(i, params, graph)
+        value, grad = run_iteration(i, node_params, graph, optimizer,
+                                    workspace, metrics)
+        losses.append(value)
+        reason = stopping.check(i, value, grad)
+        if reason is not None:
+            break
+    metrics.flush()
 
     a = params[0].value
     assert abs(a - (-1 / 8.)) < 10e-4, "a did not converge to -1 / 8."
-
-
-def run_iteration(i, params, graph):
+    return TrainingResult({param.name: param.value for param in params},
+                          losses, reason or 'n_iterations', len(losses),
+                          time.perf_counter() - start,
+                          stopping.validation_losses)
+
+
+def format_updated_params(record):
+    # PrintSink format of run_iteration records
+    return '\n'.join(f"updated params: '{name}': {value}"
+                     for name, value in record['params'].items())
+
+
+def run_iteration(i, node_params, graph, optimizer, workspace=None,
+                  metrics=None):
+    # updates the params of node_params (an optimizers.NodeParams, kept
+    # across iterations) with the optimizer, logs the iteration to the
+    # metrics sink if given and due, returns the value and the param
+    # gradient vector
+    log = metrics is not None and i % metrics.every == 0
+    if log:
+        start = time.perf_counter()
     # run forward_prop iteration
     x = 4.
-    forward_store = run_forwardprop_iter(graph, x)
+    if workspace is not None:
+        forward_store = workspace.forward_store
+    else:
+        forward_store = {}
+    value = graph.forward_prop(x, forward_store, workspace)
     # run backward prop iteration
-    eta = 1e-3
-    for param in params:
-        del_p = run_backprop_iter(graph, param, forward_store)
-        param.set_value(param.get_value() - eta * del_p)
-        if i % 1000 == 0:
-            print(f"updated params: '{param.name}': {param.value}")
+    grads = graph.backward_all(forward_store, workspace=workspace)
+    grad = node_params.gradient(grads)
+    optimizer.step(node_params.vector, grad)
+    node_params.write_back()
+    if log:
+        metrics.log(dict(step=i, loss=value,
+                         params={param.name: param.value
+                                 for param in node_params.params},
+                         seconds=time.perf_counter() - start))
+    return value, grad
 
 
 if __name__ == "__main__":
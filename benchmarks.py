@@ -0,0 +1,380 @@
+# benchmarks.py
+"""
+benchmark harness for the forward/backward passes and training loops
+
+times graph construction, alg61, alg62 (value_and_grad), training
+epochs of run_backprop_algorithm_batches (serial, batched, and
+data-parallel against serial), time to a target loss per optimizer
+(optimizers), checkpointed activations (remat) against stored ones and
+NodeFunction.backward_prop over
+parameterized graph sizes: mlp_graph_structure(n, k) graphs, in object
+(SimpleCGraph) and flat (FlatCGraph) form, and deep chains.
+
+each measurement is a record with calls per second, ns per edge and
+peak memory (tracemalloc, from a separate untimed call), written as
+json so runs can be compared across changes. graphs are also timed as
+generated code (codegen), with its compile time:
+
+    python benchmarks.py --out bench.json
+    python benchmarks.py --quick
+
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import algorithms61_62 as alg
+import backprop_ex
+import codegen
+import optimizers
+import parallel
+from metrics import NullSink
+from remat import Rematerialization
+from stopping import StoppingCriteria
+
+
+def _best_time(fn, repeat):
+    # best of repeat wall clock timings of fn(), in seconds
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _peak_memory(fn):
+    # peak traced memory allocated during fn(), in bytes
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak - base
+
+
+def _record(benchmark, graph, fn, repeat, n_edges, **params):
+    seconds = _best_time(fn, repeat)
+    return dict(benchmark=benchmark,
+                graph=graph,
+                edges=n_edges,
+                seconds=seconds,
+                ops_per_sec=1. / seconds if seconds > 0 else float('inf'),
+                ns_per_edge=seconds * 1e9 / n_edges if n_edges else None,
+                peak_memory_bytes=_peak_memory(fn),
+                **params)
+
+
+def _compiled_records(graph, cgraph, x, repeat, n_edges, **params):
+    # alg61 and alg62 records for the generated code of cgraph,
+    # with the (untimed) code generation and compile time
+    start = time.perf_counter()
+    compiled = codegen.compile_cgraph(cgraph)
+    # forward is generated lazily, compile it here outside the timed calls
+    compiled.compile_forward()
+    params = dict(params, form='compiled',
+                  compile_seconds=time.perf_counter() - start)
+    return [_record('alg61', graph, lambda: compiled.forward(x),
+                    repeat, n_edges, **params),
+            _record('alg62', graph, lambda: compiled.value_and_grad(x)[1],
+                    repeat, n_edges, **params)]
+
+
+def _time_to_loss(train, target):
+    # iterations and seconds until train(stopping) reaches a loss of at
+    # most target, iterations None if it never does
+    result = train(StoppingCriteria(target_loss=target))
+    steps = result.iterations if result.reason == 'target_loss' else None
+    return steps, result.seconds
+
+
+def _optimizers():
+    # the default SGD and the alternatives, at typical learning rates
+    return [('sgd', optimizers.SGD(1e-3)),
+            ('momentum', optimizers.Momentum(1e-3)),
+            ('nesterov', optimizers.Nesterov(1e-3)),
+            ('adam', optimizers.Adam(1e-2)),
+            ('rmsprop', optimizers.RMSProp(1e-2))]
+
+
+def chain_cgraph(depth):
+    """
+    chain of depth sum nodes over a single leaf,
+    v_i = v_i-1 + v_0 for i = 1, ..., depth
+    """
+    reverse_adj = {i: [i - 1, 0] for i in range(1, depth + 1)}
+    nodes = [alg.SimpleNode(alg.sum_f, alg.sum_pd) for _ in range(depth + 1)]
+    return alg.SimpleCGraph(reverse_adj, nodes)
+
+
+def mult_chain(depth, distinct_params=False):
+    """
+    NodeFunction chain of depth Mult nodes on a single param under an
+    Add root, as backprop_ex.sample_graph for depth 2, or with a param
+    per node if distinct_params
+    """
+    params = [backprop_ex.Param('a', 1.)]
+    root = backprop_ex.Add('addition node', params[0])
+    node = root
+    for i in range(depth):
+        if distinct_params:
+            params.append(backprop_ex.Param(f'a{i + 1}', 1.))
+        child = backprop_ex.Mult(f'multiplication node {i + 1}', params[-1])
+        node.add_child(child)
+        node = child
+    root.set_complete()
+    return params, root
+
+
+def bench_mlp(n, k, repeat):
+    results = []
+    cgraph = alg.mlp_cgraph(n, k)
+    x, _, _ = alg.mlp_leaves(n, k)
+    n_edges = sum(len(p) for p in cgraph.reverse_adj.values())
+    graphs = [('object', cgraph), ('flat', alg.FlatCGraph.from_cgraph(cgraph))]
+    for form, g in graphs:
+        params = dict(n=n, k=k, nodes=len(cgraph.nodes), form=form)
+        results.append(_record('alg61', 'mlp', lambda: alg.alg61(g, x),
+                               repeat, n_edges, **params))
+        results.append(_record('alg62', 'mlp', lambda: alg.alg62(g, x),
+                               repeat, n_edges, **params))
+    results.extend(_compiled_records('mlp', cgraph, x, repeat, n_edges,
+                                     n=n, k=k, nodes=len(cgraph.nodes)))
+    builds = [('dict', lambda: alg.mlp_graph_structure(n, k)),
+              ('flat', lambda: alg.mlp_flat_cgraph(n, k))]
+    for form, build in builds:
+        results.append(_record('build', 'mlp', build, repeat, n_edges, n=n,
+                               k=k, nodes=len(cgraph.nodes), form=form))
+    return results
+
+
+def bench_chain(depth, repeat):
+    results = []
+    cgraph = chain_cgraph(depth)
+    x = [1e-3]
+    n_edges = sum(len(p) for p in cgraph.reverse_adj.values())
+    graphs = [('object', cgraph), ('flat', alg.FlatCGraph.from_cgraph(cgraph))]
+    for form, g in graphs:
+        params = dict(depth=depth, nodes=len(cgraph.nodes), form=form)
+        results.append(_record('alg61', 'chain', lambda: alg.alg61(g, x),
+                               repeat, n_edges, **params))
+        results.append(_record('alg62', 'chain', lambda: alg.alg62(g, x),
+                               repeat, n_edges, **params))
+    results.extend(_compiled_records('chain', cgraph, x, repeat, n_edges,
+                                     depth=depth, nodes=len(cgraph.nodes)))
+    return results
+
+
+def bench_training(n, k, ns, batch_size, repeat):
+    results = []
+    cgraph = alg.mlp_cgraph(n, k)
+    x, param_indices, data_indices = alg.mlp_leaves(n, k)
+    xb = alg.mlp_data(n, ns)
+    n_edges = sum(len(p) for p in cgraph.reverse_adj.values())
+    for batched in (False, True):
+        # small learning rate so larger untrained graphs do not diverge
+        def epoch():
+            alg.run_backprop_algorithm_batches(cgraph, xb, list(x),
+                                               param_indices, data_indices,
+                                               batch_size=batch_size,
+                                               learning_rate=1e-9,
+                                               n_iterations=1,
+                                               batched=batched,
+                                               metrics=NullSink())
+        results.append(_record('epoch', 'mlp', epoch, repeat,
+                               n_edges * ns, n=n, k=k,
+                               nodes=len(cgraph.nodes), samples=ns,
+                               batch_size=batch_size, batched=batched))
+    return results
+
+
+def bench_parallel(n, k, ns, batch_size, n_workers):
+    cgraph = alg.mlp_cgraph(n, k)
+    x, param_indices, data_indices = alg.mlp_leaves(n, k)
+    xb = alg.mlp_data(n, ns)
+    report = parallel.parallel_speedup(
+        cgraph, xb, x, param_indices, data_indices, n_workers=n_workers,
+        batch_size=batch_size, learning_rate=1e-9, metrics=NullSink())
+    return [dict(benchmark='parallel_epoch', graph='mlp', n=n, k=k,
+                 samples=ns, batch_size=batch_size, **report)]
+
+
+def sqdiff_cgraph():
+    """
+    computational graph of example2,
+    f(a, b) = ((a-b)^2 - c^2)^2
+    """
+    nodes = [alg.SimpleNode(alg.sqdiff_f, alg.sqdiff_pd) for _ in range(6)]
+    return alg.SimpleCGraph(alg.sample_graph_structure(), nodes)
+
+
+def bench_optimizers(n, k, ns, batch_size, seed=0):
+    """ steps and seconds to a target loss per optimizer, on example2
+    (full steps) and on the mlp (batched minibatch epochs, to a target
+    on the epoch mean loss, which levels off at about 0.25 for the 6x2
+    mlp on 100 points) """
+    results = []
+    cgraph = sqdiff_cgraph()
+    for name, optimizer in _optimizers():
+        target = 1e-6
+        steps, seconds = _time_to_loss(
+            lambda stopping: alg.run_backprop_algorithm(
+                cgraph, [0.5, 0.1, 0.3], [0, 1], n_iterations=10**5,
+                metrics=NullSink(), optimizer=optimizer, stopping=stopping),
+            target)
+        results.append(dict(benchmark='time_to_loss', graph='example2',
+                            optimizer=name, target=target, steps=steps,
+                            seconds=seconds))
+    cgraph = alg.mlp_cgraph(n, k)
+    for name, optimizer in _optimizers():
+        # same initial params and data per optimizer
+        random.seed(seed)
+        x, param_indices, data_indices = alg.mlp_leaves(n, k)
+        xb = alg.mlp_data(n, ns)
+        target = 0.3
+        steps, seconds = _time_to_loss(
+            lambda stopping: alg.run_backprop_algorithm_batches(
+                cgraph, xb, x, param_indices, data_indices,
+                batch_size=batch_size, n_iterations=1000, batched=True,
+                metrics=NullSink(), optimizer=optimizer, stopping=stopping),
+            target)
+        results.append(dict(benchmark='time_to_loss', graph='mlp', n=n, k=k,
+                            samples=ns, batch_size=batch_size,
+                            optimizer=name, target=target, steps=steps,
+                            seconds=seconds))
+    return results
+
+
+def bench_remat(depth, batch_size, repeat):
+    """ value_and_grad on a deep chain of batch arrays and backward_all
+    on a Mult chain, storing every value and checkpointed (remat, by
+    default and at a budget of a quarter of the nodes), with the peak
+    memory against the extra node evaluations """
+    results = []
+    cgraph = chain_cgraph(depth)
+    x = [np.ones(batch_size)] + [0.] * depth
+    params, root = mult_chain(depth)
+    leaf_x = np.ones(batch_size)
+
+    def node_function_step():
+        forward_store = {}
+        root.forward_prop(leaf_x, forward_store)
+        return root.backward_all(forward_store)
+
+    results.append(_record('value_and_grad', 'chain',
+                           lambda: alg.value_and_grad(cgraph, x), repeat,
+                           depth, depth=depth, batch_size=batch_size))
+    results.append(_record('backward_all', 'mult_chain', node_function_step,
+                           repeat, depth, depth=depth, batch_size=batch_size))
+    for budget in (None, depth // 4):
+        remat = Rematerialization(budget=budget)
+        record = _record('value_and_grad', 'chain',
+                         lambda: remat.value_and_grad(cgraph, x), repeat,
+                         depth, depth=depth, batch_size=batch_size,
+                         form='remat', budget=budget)
+        results.append(dict(record, **remat.stats))
+        record = _record('backward_all', 'mult_chain',
+                         lambda: remat.backward_all(root, leaf_x), repeat,
+                         depth, depth=depth, batch_size=batch_size,
+                         form='remat', budget=budget)
+        results.append(dict(record, **remat.stats))
+    return results
+
+
+def bench_node_function(depth, repeat):
+    params, graph = mult_chain(depth)
+    forward_store = {}
+    graph.forward_prop(4., forward_store)
+    compiled = codegen.compile_node_function(graph)
+    _, chain = mult_chain(depth, distinct_params=True)
+    chain_store = {}
+    chain.forward_prop(4., chain_store)
+    return [
+        _record('forward_prop', 'mult_chain',
+                lambda: graph.forward_prop(4., {}), repeat, depth,
+                depth=depth, nodes=depth + 1),
+        _record('backward_prop', 'mult_chain',
+                lambda: graph.backward_prop(params[0], forward_store),
+                repeat, depth, depth=depth, nodes=depth + 1),
+        _record('backward_prop', 'mult_chain',
+                lambda: compiled.value_and_grad(4.), repeat, depth,
+                depth=depth, nodes=depth + 1, form='compiled'),
+        _record('build', 'mult_chain', lambda: mult_chain(depth), repeat,
+                depth, depth=depth, nodes=depth + 1),
+        _record('build', 'mult_chain_params',
+                lambda: mult_chain(depth, distinct_params=True), repeat,
+                depth, depth=depth, nodes=depth + 1),
+        _record('backward_all', 'mult_chain_params',
+                lambda: chain.backward_all(chain_store), repeat, depth,
+                depth=depth, nodes=depth + 1),
+    ]
+
+
+def run_benchmarks(mlp_sizes, chain_depths, training_sizes, repeat,
+                   parallel_sizes=(), optimizer_sizes=(), remat_sizes=()):
+    random.seed(0)
+    results = []
+    for n, k in mlp_sizes:
+        results.extend(bench_mlp(n, k, repeat))
+    for depth in chain_depths:
+        results.extend(bench_chain(depth, repeat))
+        results.extend(bench_node_function(depth, repeat))
+    for n, k, ns, batch_size in training_sizes:
+        results.extend(bench_training(n, k, ns, batch_size, repeat))
+    for n, k, ns, batch_size, n_workers in parallel_sizes:
+        results.extend(bench_parallel(n, k, ns, batch_size, n_workers))
+    for n, k, ns, batch_size in optimizer_sizes:
+        results.extend(bench_optimizers(n, k, ns, batch_size))
+    for depth, batch_size in remat_sizes:
+        results.extend(bench_remat(depth, batch_size, repeat))
+    return dict(python=platform.python_version(),
+                numpy=np.__version__,
+                platform=platform.platform(),
+                time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                repeat=repeat,
+                results=results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='time graph forward/backward passes and training epochs')
+    parser.add_argument('--out', help='json output path (default stdout)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timed calls per measurement, best is kept')
+    parser.add_argument('--quick', action='store_true',
+                        help='small sizes only')
+    args = parser.parse_args(argv)
+    if args.quick:
+        mlp_sizes = [(6, 2), (40, 4)]
+        chain_depths = [100, 1000]
+        training_sizes = [(6, 2, 100, 10)]
+        parallel_sizes = []
+        optimizer_sizes = [(6, 2, 100, 10)]
+        remat_sizes = [(1000, 1000)]
+    else:
+        mlp_sizes = [(6, 2), (40, 4), (100, 6), (200, 8)]
+        chain_depths = [100, 1000, 10000, 100000]
+        training_sizes = [(6, 2, 100, 10), (6, 2, 1000, 100), (40, 3, 1000, 100)]
+        parallel_sizes = [(40, 3, 2000, 500, 2), (40, 3, 2000, 500, 4)]
+        optimizer_sizes = [(6, 2, 100, 10)]
+        remat_sizes = [(1000, 1000), (10000, 1000)]
+    report = run_benchmarks(mlp_sizes, chain_depths, training_sizes,
+                            args.repeat, parallel_sizes, optimizer_sizes,
+                            remat_sizes)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+# checkpoint.py
+"""
+binary checkpoints of graphs, params and optimizer state
+
+a checkpoint file is a 24 byte header (magic, length of a json
+metadata block, offset of the array data), the metadata and then
+named arrays, each 64 byte aligned, listed in the metadata with dtype,
+shape and offset:
+
+    offsets, parents, ops   graph structure in FlatCGraph (csr) form:
+                            op codes for the known elementary nodes
+                            (sum, sqdiff, dot), no custom nodes
+    x                       leaf values indexed by node, if all floats
+    param_indices, params   param values as one vector, laid out as
+                            optimizers.LeafParams
+    optimizer.<name>        optimizer state arrays (with its step count
+                            and class name in the metadata)
+    order                   data point order of the minibatch loops
+    random_state            Mersenne Twister state of the shuffling rng
+
+load_checkpoint maps the file (read-only memmap) rather than reading
+it, so arrays are views into the file and a FlatCGraph comes up
+without rebuilding or copying its structure (its parents are checked
+to be lower-indexed, in one vectorized pass):
+
+    save_checkpoint('mlp.ckpt', x, param_indices, cgraph=cgraph)
+    ckpt = load_checkpoint('mlp.ckpt')
+    fgraph = ckpt.flat_cgraph()
+
+the training loops take checkpoint=Checkpointer(path, every), saving
+every `every` iterations (epochs for the minibatch loops) and, if the
+file exists, resuming from it: params, optimizer state, data order and
+rng state are restored, so a resumed run ends with the same params as
+an uninterrupted one. the minibatch loops save at epoch boundaries
+only, so a run stopped mid-epoch resumes at the start of the epoch
+after its last checkpoint and redoes the steps since.
+
+"""
+import json
+import os
+import struct
+
+import numpy as np
+
+from algorithms61_62 import FlatCGraph
+from graph_builder import check_topological
+from optimizers import LeafParams
+
+
+MAGIC = b'BPCK0001'
+HEADER = struct.Struct('<8sqq')
+ALIGN = 64
+
+
+def _aligned(n):
+    return -(-n // ALIGN) * ALIGN
+
+
+def save_checkpoint(path, x, param_indices, cgraph=None, optimizer=None,
+                    step=0, order=None, rng=None):
+    """ write a checkpoint of the params x[ix], ix in param_indices, and
+    optionally of the structure of cgraph (a SimpleCGraph or FlatCGraph),
+    the optimizer state, the iteration step, the data order and the
+    state of rng (a random.Random or the random module).
+    the file is written to a temporary path and then renamed over path,
+    so an interrupted save leaves the previous checkpoint intact. """
+    arrays = {}
+    if cgraph is not None:
+        fgraph = cgraph if isinstance(cgraph, FlatCGraph) \
+            else FlatCGraph.from_cgraph(cgraph)
+        if fgraph.custom:
+            raise Exception("graphs with custom nodes cannot be checkpointed.")
+        arrays.update(offsets=fgraph.offsets, parents=fgraph.parents,
+                      ops=fgraph.ops)
+    if all(np.ndim(v) == 0 for v in x):
+        arrays['x'] = np.asarray(x, dtype=np.float64)
+    params = LeafParams(list(x), param_indices)
+    arrays['param_indices'] = np.asarray(param_indices, dtype=np.int64)
+    arrays['params'] = params.vector
+    metadata = dict(step=step)
+    if optimizer is not None:
+        metadata['optimizer'] = dict(type=type(optimizer).__name__,
+                                     t=optimizer.t)
+        for name, value in optimizer.state.items():
+            arrays['optimizer.' + name] = value
+    if order is not None:
+        arrays['order'] = np.asarray(order, dtype=np.int64)
+    if rng is not None:
+        version, state, gauss_next = rng.getstate()
+        metadata['random'] = dict(version=version, gauss_next=gauss_next)
+        arrays['random_state'] = np.asarray(state, dtype=np.uint64)
+
+    offset = 0
+    table = {}
+    for name, value in arrays.items():
+        value = np.ascontiguousarray(value)
+        table[name] = dict(dtype=value.dtype.str, shape=list(value.shape),
+                           offset=offset)
+        offset = _aligned(offset + value.nbytes)
+    metadata['arrays'] = table
+    meta = json.dumps(metadata).encode()
+    data_start = _aligned(HEADER.size + len(meta))
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(meta), data_start))
+        f.write(meta)
+        for name, value in arrays.items():
+            f.seek(data_start + table[name]['offset'])
+            f.write(np.ascontiguousarray(value).tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+    return Checkpoint(path)
+
+
+class Checkpoint:
+    """ checkpoint file mapped read-only, arrays[name] views into it """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, meta_size, data_start = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise Exception(f"{path} is not a checkpoint file.")
+            self.metadata = json.loads(f.read(meta_size))
+        self.step = self.metadata['step']
+        self.arrays = {}
+        table = self.metadata['arrays']
+        if table:
+            buffer = np.memmap(path, dtype=np.uint8, mode='r',
+                               offset=data_start)
+        for name, entry in table.items():
+            dtype = np.dtype(entry['dtype'])
+            count = int(np.prod(entry['shape']))
+            start = entry['offset']
+            self.arrays[name] = buffer[start:start + count * dtype.itemsize] \
+                .view(dtype).reshape(entry['shape'])
+
+    @property
+    def x(self):
+        return self.arrays.get('x')
+
+    @property
+    def param_indices(self):
+        return self.arrays['param_indices'].tolist()
+
+    def flat_cgraph(self):
+        """ the checkpointed structure as a FlatCGraph on the mapped
+        arrays, checked to have lower-indexed parents """
+        if 'ops' not in self.arrays:
+            raise Exception(f"{self.path} holds no graph structure.")
+        check_topological(self.arrays['offsets'], self.arrays['parents'])
+        return FlatCGraph(self.arrays['offsets'], self.arrays['parents'],
+                          self.arrays['ops'])
+
+    def cgraph(self):
+        """ the checkpointed structure as a SimpleCGraph """
+        return self.flat_cgraph().to_cgraph()
+
+    def restore(self, x, optimizer=None, rng=None):
+        """ write the params into x (their shapes in x unchanged), load
+        the optimizer state (of an optimizer of the same class) and the
+        rng state. returns the data order, or None. """
+        param_indices = self.param_indices
+        params = LeafParams(x, param_indices)
+        saved = self.arrays['params']
+        if saved.shape != params.vector.shape:
+            raise Exception("checkpointed params do not match x.")
+        params.vector[:] = saved
+        params.write_back()
+        if optimizer is not None:
+            info = self.metadata.get('optimizer')
+            if info is None or info['type'] != type(optimizer).__name__:
+                raise Exception(f"checkpoint has no {type(optimizer).__name__} "
+                                f"optimizer state.")
+            state = {name[len('optimizer.'):]: value
+                     for name, value in self.arrays.items()
+                     if name.startswith('optimizer.')}
+            optimizer.load_state_dict(dict(state, t=info['t']))
+        if rng is not None and 'random_state' in self.arrays:
+            info = self.metadata['random']
+            rng.setstate((info['version'],
+                          tuple(self.arrays['random_state'].tolist()),
+                          info['gauss_next']))
+        order = self.arrays.get('order')
+        return None if order is None else order.tolist()
+
+
+class Checkpointer:
+    """ checkpoint=Checkpointer(path, every) for the training loops:
+    saves every `every` iterations (whole epochs for the minibatch
+    loops), resumes from path if it exists (and resume). with
+    save_graph the graph structure is saved too, unless it has custom
+    nodes """
+
+    def __init__(self, path, every=1000, resume=True, save_graph=True):
+        if every < 1:
+            raise Exception("every must be at least 1.")
+        self.path = path
+        self.every = every
+        self.resume = resume
+        self.save_graph = save_graph
+        self._fgraph = None
+
+    def restore(self, x, optimizer, rng=None):
+        """ the iteration to start at and the data order (None if not
+        checkpointed), after restoring x, optimizer and rng from path """
+        if not self.resume or not os.path.exists(self.path):
+            return 0, None
+        checkpoint = load_checkpoint(self.path)
+        order = checkpoint.restore(x, optimizer, rng)
+        return checkpoint.step, order
+
+    def due(self, step):
+        # step iterations done
+        return step % self.every == 0
+
+    def save(self, step, x, param_indices, cgraph, optimizer, order=None,
+             rng=None):
+        if self.save_graph and self._fgraph is None:
+            # structure converted once per run, a structure with custom
+            # nodes is left out and only the params are saved
+            fgraph = cgraph if isinstance(cgraph, FlatCGraph) \
+                else FlatCGraph.from_cgraph(cgraph)
+            self._fgraph = False if fgraph.custom else fgraph
+        save_checkpoint(self.path, x, param_indices, self._fgraph or None,
+                        optimizer, step, order, rng)
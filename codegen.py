@@ -0,0 +1,332 @@
+# codegen.py
+"""
+graph compilation to straight-line python for algorithms 61 and 62
+
+compile_cgraph turns a SimpleCGraph or FlatCGraph into generated,
+exec'd functions forward(x) and value_and_grad(x, grad_root=1.) with
+one local variable per node value v_i and per grad_table entry g_i and
+all parent indices written in as constants: the sum, square difference
+and dot product nodes are inlined as arithmetic, other nodes are called
+through their own f and vjp. results match alg61 and value_and_grad
+exactly (the same operations in the same order), but node values are
+not stored on the nodes.
+
+compile_node_function does the same for a backprop_ex NodeFunction
+graph, inlining Add and Mult nodes.
+
+generated code depends on the graph structure only (parent lists and
+node kinds); the graph's own nodes and params are bound per graph. code
+is cached by a hash of the structure, so recompiling a graph of the
+same structure (new params, rebuilt graph, repeated runs) skips code
+generation and python compilation. the cache keeps the CACHE_SIZE most
+recently used code objects.
+
+"""
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+from algorithms61_62 import FlatCGraph, OP_LEAF, OP_SUM, OP_SQDIFF, \
+    OP_DOT, _batch_reduce
+import backprop_ex
+
+
+# (structure hash, function name) -> code object defining the function,
+# least recently used first
+_code_cache = OrderedDict()
+_cache_stats = dict(hits=0, misses=0, evictions=0)
+CACHE_SIZE = 64
+
+# longest operand chain written out as a + b + ..., longer sums are
+# sum((a, b, ...)), which adds in the same order
+MAX_CHAIN = 32
+
+
+def cache_info():
+    """ code cache hits, misses, evictions and size """
+    return dict(_cache_stats, size=len(_code_cache))
+
+
+def clear_cache():
+    _code_cache.clear()
+    _cache_stats.update(hits=0, misses=0, evictions=0)
+
+
+def _function(key, name, make_source, namespace):
+    # function name generated by make_source(name) for the structure
+    # hash key, defined in namespace
+    code = _code_cache.get((key, name))
+    if code is None:
+        _cache_stats['misses'] += 1
+        code = compile(make_source(name), f'<compiled graph {key[:12]}>',
+                       'exec')
+        _code_cache[key, name] = code
+        while len(_code_cache) > CACHE_SIZE:
+            _code_cache.popitem(last=False)
+            _cache_stats['evictions'] += 1
+    else:
+        _cache_stats['hits'] += 1
+        _code_cache.move_to_end((key, name))
+    exec(code, namespace)
+    return namespace[name]
+
+
+def _sum_expr(terms):
+    if not terms:
+        return '0'
+    if len(terms) > MAX_CHAIN:
+        return f'sum(({", ".join(terms)},))'
+    return ' + '.join(terms)
+
+
+class Compiled:
+    """ generated forward and backward functions of a graph.
+    forward is generated on first use, as python compile time
+    grows with the graph and training needs value_and_grad only """
+
+    def __init__(self, key, make_source, namespace):
+        self.key = key
+        self._make_source = make_source
+        self._namespace = namespace
+        self._forward = None
+        self.value_and_grad = _function(key, 'value_and_grad', make_source,
+                                        namespace)
+
+    def compile_forward(self):
+        """ generate forward now rather than on first use """
+        if self._forward is None:
+            self._forward = _function(self.key, 'forward', self._make_source,
+                                      self._namespace)
+        return self._forward
+
+    @property
+    def forward(self):
+        return self.compile_forward()
+
+
+class CompiledGraph(Compiled):
+    """ Compiled SimpleCGraph or FlatCGraph """
+
+    def __init__(self, key, make_source, namespace, leaf_indices):
+        super().__init__(key, make_source, namespace)
+        self.leaf_indices = leaf_indices
+
+    def batch_value_and_grad(self, x, mean=True):
+        # as algorithms61_62.batch_value_and_grad
+        root_val, grad_table = self.value_and_grad(x, np.ones_like)
+        return _batch_reduce(self.leaf_indices, x, np.asarray(root_val),
+                             grad_table, mean)
+
+
+def structure_key(fgraph):
+    """ hash of the parent lists and op codes of a FlatCGraph """
+    h = hashlib.sha1()
+    for arr in (fgraph.ops, fgraph.offsets, fgraph.parents.astype(np.int64)):
+        h.update(arr.tobytes())
+        h.update(b'|')
+    return h.hexdigest()
+
+
+def _cgraph_source(fgraph, name):
+    offsets = fgraph.offsets.tolist()
+    parents = fgraph.parents.tolist()
+    ops = fgraph.ops.tolist()
+    n = len(ops)
+    root = n - 1
+
+    forward = []
+    for i in range(n):
+        p = [f'v{j}' for j in parents[offsets[i]:offsets[i + 1]]]
+        op = ops[i]
+        if op == OP_LEAF:
+            forward.append(f'v{i} = x[{i}]')
+        elif op == OP_SUM:
+            forward.append(f'v{i} = {_sum_expr(p)}')
+        elif op == OP_SQDIFF:
+            forward.append(f'v{i} = ({p[0]} - ({_sum_expr(p[1:])})) ** 2')
+        elif op == OP_DOT:
+            m = len(p) // 2
+            terms = [f'{p[k]} * {p[k + m]}' for k in range(m)]
+            forward.append(f'v{i} = {_sum_expr(terms) if terms else "0."}')
+        else:
+            forward.append(f'v{i} = nodes[{i}].f([{", ".join(p)}])')
+
+    # backward sweep in reverse node order; g_j is assigned on the first
+    # contribution, and nodes never reached from the root are skipped
+    backward = [f'g{root} = grad_root(v{root}) if callable(grad_root) '
+                f'else grad_root']
+    reached = {root}
+
+    def add(j, expr):
+        if j in reached:
+            backward.append(f'g{j} = g{j} + {expr}')
+        else:
+            backward.append(f'g{j} = {expr}')
+            reached.add(j)
+
+    for i in reversed(range(n)):
+        op = ops[i]
+        if op == OP_LEAF or i not in reached:
+            continue
+        pix = parents[offsets[i]:offsets[i + 1]]
+        p = [f'v{j}' for j in pix]
+        if op == OP_SUM:
+            for j in pix:
+                add(j, f'g{i}')
+        elif op == OP_SQDIFF:
+            backward.append(f'd{i} = 2 * ({p[0]} - ({_sum_expr(p[1:])}))')
+            add(pix[0], f'g{i} * d{i}')
+            for j in pix[1:]:
+                add(j, f'g{i} * -d{i}')
+        elif op == OP_DOT:
+            m = len(pix) // 2
+            for k, j in enumerate(pix):
+                add(j, f'g{i} * {p[k + m] if k < m else p[k - m]}')
+        else:
+            backward.append(f'c = nodes[{i}].vjp(g{i}, [{", ".join(p)}])')
+            for s, j in enumerate(pix):
+                add(j, f'c[{s}]')
+
+    if name == 'forward':
+        lines = ['def forward(x):']
+        lines += ['    ' + line for line in forward]
+        lines.append(f'    return v{root}')
+    else:
+        grads = ', '.join(f'g{i}' if i in reached else '0.' for i in range(n))
+        lines = ['def value_and_grad(x, grad_root=1.):']
+        lines += ['    ' + line for line in forward + backward]
+        lines.append(f'    return v{root}, [{grads}]')
+    return '\n'.join(lines) + '\n'
+
+
+def compile_cgraph(cgraph):
+    """ CompiledGraph of a SimpleCGraph or FlatCGraph, with
+    forward(x) the root value as alg61(cgraph, x),
+    value_and_grad(x, grad_root=1.) as value_and_grad(cgraph, x, grad_root)
+    (grad_root may also be a function of the root value) and
+    batch_value_and_grad(x, mean=True) as batch_value_and_grad(cgraph, x, mean)
+    """
+    if isinstance(cgraph, FlatCGraph):
+        fgraph, nodes = cgraph, cgraph.custom
+    else:
+        fgraph, nodes = FlatCGraph.from_cgraph(cgraph), cgraph.nodes
+    return CompiledGraph(structure_key(fgraph),
+                         lambda name: _cgraph_source(fgraph, name),
+                         {'nodes': nodes}, fgraph.leaf_indices.tolist())
+
+
+def _node_function_structure(root):
+    # schedule of the graph below root, params in order of first use, and
+    # per node (kind, schedule position of its child, param slots)
+    if not root.is_complete:
+        raise backprop_ex.GraphError('graph not complete, call set_complete.')
+    param_index, relevant = root._params_below()
+    schedule = root.schedule or root._topological_order()
+    position = {node: s for s, node in enumerate(schedule)}
+    params = []
+    slots = {}
+    structure = []
+    for node in schedule:
+        if len(node.children) > 1:
+            raise backprop_ex.GraphError(
+                f"node [{node.name}] has more than one child, "
+                f"only single input nodes compile.")
+        kind = type(node).__name__ if type(node) in (backprop_ex.Add,
+                                                     backprop_ex.Mult) else 'node'
+        direct = sorted(node.direct_params, key=param_index.get)
+        if kind != 'node':
+            direct = [node.param]
+        for param in direct:
+            if param not in slots:
+                slots[param] = len(params)
+                params.append(param)
+        child = position[node.children[0]] if node.children else None
+        has_params = bool(node.children) and node.children[0] in relevant
+        structure.append((kind, child, has_params,
+                          tuple(slots[param] for param in direct)))
+    return schedule, params, structure
+
+
+def _node_function_source(structure, n_params, name):
+    root = len(structure) - 1
+    forward = [f'a{s} = params[{s}].value' for s in range(n_params)]
+    inputs = []
+    for k, (kind, child, _, param_slots) in enumerate(structure):
+        xi = 'leaf_x' if child is None else f'o{child}'
+        inputs.append(xi)
+        if kind == 'Add':
+            forward.append(f'o{k} = {xi} + a{param_slots[0]}')
+        elif kind == 'Mult':
+            forward.append(f'o{k} = {xi} * a{param_slots[0]}')
+        else:
+            forward.append(f'o{k} = nodes[{k}].evaluate({xi})')
+
+    # adjoints j_k and param derivatives d_s, accumulated in the order
+    # of NodeFunction.backward_all
+    backward = [f'j{root} = 1.']
+    assigned = {f'j{root}'}
+    grads = []
+
+    def add(name, expr):
+        if name in assigned:
+            backward.append(f'{name} = {name} + {expr}')
+        else:
+            backward.append(f'{name} = 0. + {expr}')
+            assigned.add(name)
+
+    for k in reversed(range(len(structure))):
+        if f'j{k}' not in assigned:
+            continue
+        kind, child, has_params, param_slots = structure[k]
+        xi = inputs[k]
+        if kind == 'Add':
+            ksi = '1.'
+        elif kind == 'Mult':
+            ksi = xi
+        else:
+            ksi = f'nodes[{k}].param_derivative({xi})'
+        for s in param_slots:
+            add(f'd{s}', f'j{k} * {ksi}')
+            if s not in grads:
+                grads.append(s)
+        # skip subgraphs without params, as backward_all
+        if child is not None and has_params:
+            if kind == 'Add':
+                derivative = '1.'
+            elif kind == 'Mult':
+                derivative = f'a{param_slots[0]}'
+            else:
+                derivative = f'nodes[{k}].derivative({xi}, 0)'
+            add(f'j{child}', f'j{k} * {derivative}')
+
+    if name == 'forward':
+        lines = ['def forward(leaf_x):']
+        lines += ['    ' + line for line in forward]
+        lines.append(f'    return o{root}')
+    else:
+        grads_dict = ', '.join(f'params[{s}]: d{s}' for s in grads)
+        lines = ['def value_and_grad(leaf_x):']
+        lines += ['    ' + line for line in forward + backward]
+        lines.append(f'    return o{root}, {{{grads_dict}}}')
+    return '\n'.join(lines) + '\n'
+
+
+class CompiledNodeFunction(Compiled):
+    """ Compiled NodeFunction graph: forward(leaf_x) the root value as
+    forward_prop, and value_and_grad(leaf_x) the root value and the dict
+    param -> derivative of backward_all, reading current param values """
+
+    def __init__(self, key, make_source, namespace, params):
+        super().__init__(key, make_source, namespace)
+        self.params = params
+
+
+def compile_node_function(root):
+    """ CompiledNodeFunction of the (complete) NodeFunction graph below
+    root, whose nodes each have at most one child """
+    schedule, params, structure = _node_function_structure(root)
+    key = hashlib.sha1(repr(structure).encode()).hexdigest()
+    return CompiledNodeFunction(
+        key, lambda name: _node_function_source(structure, len(params), name),
+        {'nodes': schedule, 'params': params}, params)
@@ -0,0 +1,126 @@
+# datasets.py
+"""
+memory-mapped datasets for minibatch training
+
+a dataset file is a fixed-width binary table: a 32 byte header
+(magic, number of points ns, number of x values d) followed by an
+ns x (d + 1) float64 matrix in row-major order, each row the x values
+of one data point followed by its y value.
+
+MemmapDataset maps the file rather than reading it, so datasets need
+not fit in memory. batches() shuffles by an index permutation instead
+of reordering data points, and reads the next minibatch on a
+background thread while the current one is trained on.
+
+write_dataset writes a list of data points to a file, and
+MemmapDataset.create returns a new file's rows as a writable memmap
+to fill in chunks.
+
+run_backprop_algorithm_batches takes a MemmapDataset in place of the
+list xb; data_indices still decide which leaves take the x and y values.
+
+"""
+import queue
+import struct
+import threading
+
+import numpy as np
+
+
+MAGIC = b'BPDS0001'
+HEADER = struct.Struct('<8sqq8x')
+
+
+class MemmapDataset:
+    """ read-only float64 dataset mapped from a file written by
+    write_dataset or MemmapDataset.create """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, ns, d = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise Exception(f"{path} is not a dataset file.")
+        self.n_features = d
+        self.data = np.memmap(path, dtype=np.float64, mode='r',
+                              offset=HEADER.size, shape=(ns, d + 1))
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @staticmethod
+    def create(path, ns, n_features):
+        """ new dataset file for ns points of n_features x values,
+        returned as a writable memmap of its ns x (n_features + 1) rows
+        to be filled in place (in chunks, for large datasets) """
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, ns, n_features))
+            f.truncate(HEADER.size + ns * (n_features + 1) * 8)
+        return np.memmap(path, dtype=np.float64, mode='r+',
+                         offset=HEADER.size, shape=(ns, n_features + 1))
+
+    def _read(self, indices):
+        # rows in file order for sequential page access; the order of
+        # points within a minibatch does not change its gradient
+        rows = self.data[np.sort(indices)]
+        return rows[:, :-1], rows[:, -1]
+
+    def batches(self, batch_size, seed=None, prefetch=1):
+        """ minibatches (x values, y values) as (B, n_features) and (B,)
+        arrays, over a random permutation of all ns points (seeded by
+        seed), the last minibatch possibly short. up to prefetch
+        minibatches are read ahead on a background thread. """
+        order = np.random.default_rng(seed).permutation(len(self))
+        starts = range(0, len(order), batch_size)
+        if not prefetch:
+            for j in starts:
+                yield self._read(order[j:j + batch_size])
+            return
+
+        ready = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read_ahead():
+            try:
+                for j in starts:
+                    if not put(self._read(order[j:j + batch_size])):
+                        return
+            except Exception as e:
+                put(e)
+            put(done)
+
+        reader = threading.Thread(target=read_ahead, daemon=True)
+        reader.start()
+        try:
+            while True:
+                item = ready.get()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            reader.join()
+
+
+def write_dataset(path, xb):
+    """ write data points xb, a list of (x values, y value) tuples,
+    to a dataset file at path """
+    n_features = len(xb[0][0])
+    data = MemmapDataset.create(path, len(xb), n_features)
+    for t, (xs, y) in enumerate(xb):
+        data[t, :n_features] = xs
+        data[t, n_features] = y
+    data.flush()
+    return MemmapDataset(path)
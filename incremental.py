@@ -0,0 +1,153 @@
+# incremental.py
+"""
+incremental forward evaluation of a SimpleCGraph
+
+alg61 recomputes every node on each call. an IncrementalGraph caches
+node values (and the parent values backward sweeps need) and tracks
+which leaves changed since the last evaluation: set_leaf(i, v) and
+mark_dirty(i) flag leaves directly, evaluate(x) flags the leaves of x
+whose value differs from the cached one (floats by value, arrays by
+identity, so arrays changed in place need mark_dirty), checking only
+the leaves listed in changed= if given. re-evaluation then recomputes,
+in index order, only the nodes a parent of which actually changed
+value: the consumers of the flagged leaves, and the consumers of every
+recomputed node whose value differs from its cached one, so a
+recomputed float equal to its cached value stops the walk along its
+edges. the rest of the graph is not visited.
+
+    graph = IncrementalGraph(cgraph)
+    graph.evaluate(x)       # full evaluation
+    x[3] = 0.5
+    graph.evaluate(x)       # only the descendants of leaf 3
+    graph.evaluate(x, changed=[3])  # the same, checking leaf 3 only
+    graph.counters          # evaluations, nodes evaluated and skipped
+
+counters accumulate over calls, last_evaluated and last_skipped are of
+the last call; with a profiling.Profiler they are also counted as
+incremental_nodes_evaluated / incremental_nodes_skipped.
+value_and_grad runs the backward sweep on the cached parent values.
+
+"""
+import heapq
+
+import numpy as np
+
+from algorithms61_62 import _backward
+
+
+def _same(a, b):
+    # unchanged value: the same object, or equal floats
+    if a is b:
+        return True
+    if np.ndim(a) or np.ndim(b) or a is None or b is None:
+        return False
+    return a == b
+
+
+class IncrementalGraph:
+    """ node values of cgraph cached across evaluations, recomputed
+    for the descendants of changed leaves only """
+
+    def __init__(self, cgraph):
+        self.cgraph = cgraph
+        n = len(cgraph.nodes)
+        self.vals = [None] * n
+        # parent values of each op node, as recorded by alg61
+        self.inputs = [None] * n
+        # consumers[j]: the op nodes with parent j, in index order
+        consumers = [[] for _ in range(n)]
+        for i in cgraph.op_indices:
+            for j in dict.fromkeys(cgraph.reverse_adj[i]):
+                consumers[j].append(i)
+        self._consumers = consumers
+        self._dirty = set()
+        self._valid = False
+        self.counters = dict(evaluations=0, nodes_evaluated=0,
+                             nodes_skipped=0)
+        self.last_evaluated = 0
+        self.last_skipped = 0
+
+    def set_leaf(self, i, value):
+        self.vals[i] = value
+        self._dirty.add(i)
+
+    def mark_dirty(self, i):
+        # leaf i changed in place
+        self._dirty.add(i)
+
+    def invalidate(self):
+        # evaluate everything on the next call
+        self._valid = False
+
+    def update(self, x, changed=None):
+        """ take the leaf values from x, flagging the changed ones;
+        only the leaves in changed if given """
+        vals = self.vals
+        for i in self.cgraph.leaf_indices if changed is None else changed:
+            v = x[i]
+            if not _same(v, vals[i]):
+                vals[i] = v
+                self._dirty.add(i)
+
+    def evaluate(self, x=None, profiler=None, changed=None):
+        """ root value, after taking the leaf values from x if given
+        (only those of the leaves in changed, if given) """
+        if x is not None:
+            self.update(x, changed)
+        if not self._valid:
+            n_evaluated = self._evaluate_all()
+        else:
+            n_evaluated = self._evaluate_changed()
+        self._dirty.clear()
+        n_skipped = len(self.cgraph.op_indices) - n_evaluated
+        self.last_evaluated = n_evaluated
+        self.last_skipped = n_skipped
+        self.counters['evaluations'] += 1
+        self.counters['nodes_evaluated'] += n_evaluated
+        self.counters['nodes_skipped'] += n_skipped
+        if profiler is not None:
+            profiler.count('incremental_nodes_evaluated', n_evaluated)
+            profiler.count('incremental_nodes_skipped', n_skipped)
+        return self.vals[-1]
+
+    def _evaluate_all(self):
+        vals, inputs = self.vals, self.inputs
+        reverse_adj, nodes = self.cgraph.reverse_adj, self.cgraph.nodes
+        for i in self.cgraph.op_indices:
+            parent_vals = [vals[j] for j in reverse_adj[i]]
+            inputs[i] = parent_vals
+            vals[i] = nodes[i].f(parent_vals)
+        self._valid = True
+        return len(self.cgraph.op_indices)
+
+    def _evaluate_changed(self):
+        if not self._dirty:
+            return 0
+        # parents precede children in index order, so popping the
+        # lowest index recomputes a node after all its changed parents
+        consumers = self._consumers
+        heap = sorted({i for j in self._dirty for i in consumers[j]})
+        queued = set(heap)
+        vals, inputs = self.vals, self.inputs
+        reverse_adj, nodes = self.cgraph.reverse_adj, self.cgraph.nodes
+        n_evaluated = 0
+        while heap:
+            i = heapq.heappop(heap)
+            parent_vals = [vals[j] for j in reverse_adj[i]]
+            inputs[i] = parent_vals
+            val = nodes[i].f(parent_vals)
+            n_evaluated += 1
+            if not _same(val, vals[i]):
+                vals[i] = val
+                for c in consumers[i]:
+                    if c not in queued:
+                        queued.add(c)
+                        heapq.heappush(heap, c)
+        return n_evaluated
+
+    def value_and_grad(self, x=None, grad_root=1., out=None, profiler=None,
+                       changed=None):
+        """ value_and_grad with the incremental forward evaluation """
+        root_val = self.evaluate(x, profiler, changed)
+        return root_val, _backward(self.cgraph, self.inputs, grad_root, out,
+                                   profiler)
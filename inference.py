@@ -0,0 +1,104 @@
+# inference.py
+"""
+read-only inference on trained graphs
+
+alg61 stores every node value on the node objects (node.val) and
+keeps them all until the next call, so it cannot run concurrently on
+one graph and holds every intermediate of a batch at once. a
+FrozenGraph instead compiles a SimpleCGraph (scalar or tensor nodes)
+with its non-input leaves frozen at their current values into an
+evaluation plan:
+
+    - only the nodes the output depends on are evaluated
+    - nodes depending on frozen leaves only are evaluated once, when
+      freezing, and kept as constants
+    - each call evaluates into a list of its own, dropping every value
+      as soon as its last consumer has run
+
+so calls share no mutable state and may run concurrently from several
+threads, and a batch (input leaves holding arrays with a leading batch
+dimension) keeps only the values still needed in memory.
+
+    frozen = FrozenGraph(cgraph, x, data_indices[:-1], output=n * k)
+    y_hat = frozen.predict(xs)    # xs of shape (B, d)
+
+NodeFunction.infer in backprop_ex is the same for NodeFunction graphs,
+without a forward_store.
+
+"""
+import numpy as np
+
+
+class FrozenGraph:
+    """ evaluation plan of cgraph from the input leaves input_indices
+    to the node output (default the root), with the other leaves fixed
+    at their values in x """
+
+    def __init__(self, cgraph, x, input_indices, output=None):
+        n = len(cgraph.nodes)
+        self.output = n - 1 if output is None else output
+        self.input_indices = list(input_indices)
+        inputs = set(self.input_indices)
+        reverse_adj = cgraph.reverse_adj
+
+        # nodes the output depends on
+        needed = [False] * n
+        needed[self.output] = True
+        for i in range(self.output, -1, -1):
+            if needed[i]:
+                for j in reverse_adj.get(i) or ():
+                    needed[j] = True
+
+        # values of the nodes not depending on the inputs
+        constants = [None] * n
+        dynamic = [False] * n
+        steps = []
+        for i in range(self.output + 1):
+            if not needed[i]:
+                continue
+            parents = reverse_adj.get(i)
+            if not parents:
+                if i in inputs:
+                    dynamic[i] = True
+                else:
+                    constants[i] = np.copy(x[i]) if np.ndim(x[i]) else x[i]
+                continue
+            if any(dynamic[j] for j in parents):
+                dynamic[i] = True
+                steps.append((i, cgraph.nodes[i].f, tuple(parents)))
+            else:
+                constants[i] = cgraph.nodes[i].f([constants[j]
+                                                  for j in parents])
+
+        # release each dynamic value after its last consumer
+        last_use = {}
+        for s, (i, f, parents) in enumerate(steps):
+            for j in parents:
+                if dynamic[j]:
+                    last_use[j] = s
+        release = [[] for _ in steps]
+        for j, s in last_use.items():
+            if j != self.output:
+                release[s].append(j)
+        self._steps = [(i, f, parents, tuple(r))
+                       for (i, f, parents), r in zip(steps, release)]
+        self._constants = constants
+        self.n_evaluated = len(steps)
+
+    def __call__(self, inputs):
+        """ output value with inputs[m] the value of leaf
+        input_indices[m] (arrays for a batch) """
+        vals = self._constants.copy()
+        for ix, v in zip(self.input_indices, inputs):
+            vals[ix] = v
+        for i, f, parents, release in self._steps:
+            vals[i] = f([vals[j] for j in parents])
+            for j in release:
+                vals[j] = None
+        return vals[self.output]
+
+    def predict(self, xs):
+        """ outputs for a batch xs, xs[b] the input leaf values of
+        example b """
+        xs = np.asarray(xs, dtype=float)
+        return self([xs[:, m] for m in range(len(self.input_indices))])
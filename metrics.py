@@ -0,0 +1,172 @@
+# metrics.py
+"""
+metrics sinks for the training loops
+
+the training loops (run_backprop_algorithm, run_backprop_algorithm_batches,
+run_backprop_algorithm_parallel and backprop_ex.run_backprop_algorithm)
+take metrics=, a sink whose log(record) they call every sink.every
+iterations with a dict record of the iteration:
+
+    step        iteration index
+    loss        loss of the last step
+    params      param values
+    seconds     wall clock time of the iteration
+
+(plus loop-specific entries), and whose flush() they call on return.
+records are only built on logged iterations.
+
+    PrintSink       prints param values and loss, the default, every
+                    print_freq iterations
+    CallbackSink    calls a function with each record
+    FileSink        json lines file, buffered, or written by a background
+                    thread if asynchronous
+    NullSink        discards records
+
+graph construction (backprop_ex NodeFunction.set_complete) prints its
+progress only with verbose=True, and graph errors raise
+backprop_ex.GraphError rather than being printed.
+
+"""
+import json
+import queue
+import sys
+import threading
+
+
+def _to_json(value):
+    # numpy scalars and arrays for json.dumps
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+class MetricsSink:
+    """ receives a record every `every` iterations """
+
+    def __init__(self, every=1):
+        if every < 1:
+            raise Exception("every must be at least 1.")
+        self.every = every
+
+    def log(self, record):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class NullSink(MetricsSink):
+    """ discards records """
+
+    def __init__(self):
+        super().__init__(every=sys.maxsize)
+
+    def log(self, record):
+        pass
+
+
+class PrintSink(MetricsSink):
+    """ prints records with format(record), by default
+    the param values and loss lines of the training loops """
+
+    def __init__(self, every=1, format=None, file=None):
+        super().__init__(every)
+        self.format = format or self.format_record
+        self.file = file
+
+    @staticmethod
+    def format_record(record):
+        return f'param values: {record["params"]}\nloss: {record["loss"]}'
+
+    def log(self, record):
+        print(self.format(record), file=self.file)
+
+
+class CallbackSink(MetricsSink):
+    """ calls fn(record) """
+
+    def __init__(self, fn, every=1):
+        super().__init__(every)
+        self.fn = fn
+
+    def log(self, record):
+        self.fn(record)
+
+
+class FileSink(MetricsSink):
+    """ appends records as json lines to path. lines are serialized
+    when logged (param values may be updated in place afterwards) and
+    written buffer_size at a time, or if asynchronous by a background
+    thread, so the training loop does not wait on the file """
+
+    def __init__(self, path, every=1, buffer_size=100, asynchronous=False):
+        super().__init__(every)
+        self.path = path
+        self.buffer_size = buffer_size
+        self._file = open(path, 'a')
+        self._buffer = []
+        self._queue = None
+        if asynchronous:
+            self._queue = queue.Queue()
+            self._writer = threading.Thread(target=self._write_lines,
+                                            daemon=True)
+            self._writer.start()
+
+    def log(self, record):
+        line = json.dumps(record, default=_to_json)
+        if self._queue is not None:
+            self._queue.put(line)
+            return
+        self._buffer.append(line)
+        if len(self._buffer) >= self.buffer_size:
+            self._write(self._buffer)
+            self._buffer = []
+
+    def _write(self, lines):
+        self._file.write('\n'.join(lines) + '\n')
+
+    def _write_lines(self):
+        # background writer: batches of queued lines until a None
+        while True:
+            lines = [self._queue.get()]
+            while not self._queue.empty():
+                lines.append(self._queue.get())
+            stop = None in lines
+            lines = [line for line in lines if line is not None]
+            if lines:
+                self._write(lines)
+            for _ in range(len(lines) + stop):
+                self._queue.task_done()
+            if stop:
+                self._file.flush()
+                return
+
+    def flush(self):
+        if self._file.closed:
+            return
+        if self._queue is not None:
+            # wait for the writer to catch up
+            self._queue.join()
+        elif self._buffer:
+            self._write(self._buffer)
+            self._buffer = []
+        self._file.flush()
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self._queue is not None:
+            self._queue.put(None)
+            self._writer.join()
+        else:
+            self.flush()
+        self._file.close()
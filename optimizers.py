@@ -0,0 +1,246 @@
+# optimizers.py
+"""
+optimizers for the training loops
+
+params are handled as one contiguous float64 vector:
+
+    LeafParams(x, param_indices)    the leaf values x[ix] of a graph,
+                                    array valued ones replaced in x by
+                                    views into the vector
+    NodeParams(params)              backprop_ex Param objects
+
+each gathers gradients (from a grad_table, or a param -> derivative
+dict) into a vector of the same layout, and an optimizer updates the
+param vector from it in place with vectorized numpy ops, keeping its
+state (velocities, moment estimates) in arrays of the same size:
+
+    SGD, Momentum, Nesterov, Adam, RMSProp
+
+    optimizer.step(params.vector, params.gradient(grad_table))
+    params.write_back()
+
+learning_rate is a float or a schedule, a function of the step count
+t = 0, 1, ... to the learning rate (constant, step_decay,
+exponential_decay, inverse_time_decay, cosine_decay).
+
+"""
+import math
+
+import numpy as np
+
+
+def constant(learning_rate):
+    return lambda t: learning_rate
+
+
+def step_decay(learning_rate, factor, every):
+    """ learning_rate * factor^(t // every) """
+    return lambda t: learning_rate * factor ** (t // every)
+
+
+def exponential_decay(learning_rate, rate):
+    """ learning_rate * rate^t """
+    return lambda t: learning_rate * rate ** t
+
+
+def inverse_time_decay(learning_rate, decay):
+    """ learning_rate / (1 + decay * t) """
+    return lambda t: learning_rate / (1. + decay * t)
+
+
+def cosine_decay(learning_rate, n_steps, min_learning_rate=0.):
+    """ from learning_rate to min_learning_rate over n_steps along a
+    half cosine, then min_learning_rate """
+    def schedule(t):
+        if t >= n_steps:
+            return min_learning_rate
+        cos = 0.5 * (1. + math.cos(math.pi * t / n_steps))
+        return min_learning_rate + (learning_rate - min_learning_rate) * cos
+    return schedule
+
+
+class LeafParams:
+    """ the param leaf values x[ix], ix in param_indices, as one float64
+    vector. array valued params are reshaped views into the vector
+    (x[ix] is replaced by the view), float params are copied back into
+    x by write_back. """
+
+    def __init__(self, x, param_indices):
+        self.x = x
+        self.param_indices = list(param_indices)
+        shapes = [np.shape(x[ix]) for ix in self.param_indices]
+        sizes = [int(np.prod(shape)) for shape in shapes]
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(int)
+        self.vector = np.empty(self.offsets[-1])
+        self.grad = np.empty_like(self.vector)
+        self._arrays = []  # (slice, ix, shape) of array params
+        scalars = []
+        for p, (ix, shape) in enumerate(zip(self.param_indices, shapes)):
+            a, b = self.offsets[p], self.offsets[p + 1]
+            if shape:
+                self.vector[a:b] = np.ravel(x[ix])
+                x[ix] = self.vector[a:b].reshape(shape)
+                self._arrays.append((slice(a, b), ix, shape))
+            else:
+                self.vector[a] = x[ix]
+                scalars.append((a, ix))
+        self._scalar_offsets = np.array([a for a, _ in scalars], dtype=int)
+        self._scalar_indices = [ix for _, ix in scalars]
+
+    def gradient(self, grad_table):
+        """ grad_table entries of the params, as a vector laid out as
+        self.vector (self.grad, overwritten by the next call) """
+        if not self._arrays:
+            if isinstance(grad_table, np.ndarray):
+                # FlatCGraph grad table
+                np.take(grad_table, self._scalar_indices, out=self.grad)
+            else:
+                self.grad[:] = [grad_table[ix] for ix
+                                in self._scalar_indices]
+            return self.grad
+        if self._scalar_indices:
+            self.grad[self._scalar_offsets] = [grad_table[ix] for ix
+                                               in self._scalar_indices]
+        for s, ix, _ in self._arrays:
+            self.grad[s] = np.ravel(grad_table[ix])
+        return self.grad
+
+    def write_back(self):
+        # float params from the vector into x
+        values = self.vector if not self._arrays \
+            else self.vector[self._scalar_offsets]
+        x = self.x
+        for ix, v in zip(self._scalar_indices, values.tolist()):
+            x[ix] = v
+
+
+class NodeParams:
+    """ values of backprop_ex Param objects (anything with float
+    get_value / set_value) as one float64 vector """
+
+    def __init__(self, params):
+        self.params = list(params)
+        self.vector = np.array([param.get_value() for param in self.params],
+                               dtype=float)
+        self.grad = np.empty_like(self.vector)
+
+    def gradient(self, grads):
+        """ vector of grads.get(param, 0.), grads a param -> derivative
+        dict as returned by NodeFunction.backward_all """
+        self.grad[:] = [grads.get(param, 0.) for param in self.params]
+        return self.grad
+
+    def write_back(self):
+        for param, v in zip(self.params, self.vector.tolist()):
+            param.set_value(v)
+
+
+class Optimizer:
+    """ updates a param vector in place from its gradient, with state
+    arrays allocated on the first step. t counts the steps taken. """
+
+    # names of the state arrays, for state_dict
+    state_names = ()
+
+    def __init__(self, learning_rate=1e-3):
+        self.learning_rate = learning_rate
+        self.t = 0
+        self.state = {}
+
+    def lr(self):
+        # learning rate of the current step
+        if callable(self.learning_rate):
+            return self.learning_rate(self.t)
+        return self.learning_rate
+
+    def step(self, vector, grad):
+        if not self.state and self.state_names:
+            for name in self.state_names:
+                self.state[name] = np.zeros_like(vector)
+        self._update(vector, grad, self.lr())
+        self.t += 1
+
+    def _update(self, vector, grad, lr):
+        raise NotImplementedError
+
+    def state_dict(self):
+        """ step count and copies of the state arrays """
+        state = {name: array.copy() for name, array in self.state.items()}
+        return dict(t=self.t, **state)
+
+    def load_state_dict(self, state):
+        self.t = int(state['t'])
+        self.state = {name: np.array(state[name], dtype=float)
+                      for name in self.state_names if name in state}
+
+
+class SGD(Optimizer):
+    """ p -= lr * g """
+
+    def _update(self, vector, grad, lr):
+        vector -= lr * grad
+
+
+class Momentum(Optimizer):
+    """ v = momentum * v + g, p -= lr * v """
+
+    state_names = ('velocity',)
+
+    def __init__(self, learning_rate=1e-3, momentum=0.9):
+        super().__init__(learning_rate)
+        self.momentum = momentum
+
+    def _update(self, vector, grad, lr):
+        v = self.state['velocity']
+        v *= self.momentum
+        v += grad
+        vector -= lr * v
+
+
+class Nesterov(Momentum):
+    """ v = momentum * v + g, p -= lr * (g + momentum * v) """
+
+    def _update(self, vector, grad, lr):
+        v = self.state['velocity']
+        v *= self.momentum
+        v += grad
+        vector -= lr * (grad + self.momentum * v)
+
+
+class Adam(Optimizer):
+    """ Adam with bias-corrected first and second moment estimates """
+
+    state_names = ('m', 'v')
+
+    def __init__(self, learning_rate=1e-3, beta1=0.9, beta2=0.999, eps=1e-8):
+        super().__init__(learning_rate)
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.eps = eps
+
+    def _update(self, vector, grad, lr):
+        m, v = self.state['m'], self.state['v']
+        m *= self.beta1
+        m += (1. - self.beta1) * grad
+        v *= self.beta2
+        v += (1. - self.beta2) * np.square(grad)
+        t = self.t + 1
+        step_size = lr * math.sqrt(1. - self.beta2 ** t) / (1. - self.beta1 ** t)
+        vector -= step_size * m / (np.sqrt(v) + self.eps)
+
+
+class RMSProp(Optimizer):
+    """ s = decay * s + (1 - decay) * g^2, p -= lr * g / (sqrt(s) + eps) """
+
+    state_names = ('square_avg',)
+
+    def __init__(self, learning_rate=1e-3, decay=0.9, eps=1e-8):
+        super().__init__(learning_rate)
+        self.decay = decay
+        self.eps = eps
+
+    def _update(self, vector, grad, lr):
+        s = self.state['square_avg']
+        s *= self.decay
+        s += (1. - self.decay) * np.square(grad)
+        vector -= lr * grad / (np.sqrt(s) + self.eps)
@@ -0,0 +1,378 @@
+# parallel.py
+"""
+data-parallel minibatch training for algorithms 61 and 62
+
+each minibatch is split into n_workers contiguous shards, one per
+worker process of a pool. every worker holds its own copy of the
+SimpleCGraph and leaf values x, set once by the pool initializer.
+per step the parent broadcasts the current param values with the
+shards, each worker returns the gradient sum over its shard, and the
+parent reduces the shard sums in shard order and updates the params.
+
+shuffling uses a random.Random(seed) permutation of indices into xb,
+so for a given seed and n_workers runs are deterministic.
+
+graph nodes must be picklable (module-level f/pd, as in the examples)
+unless the platform starts workers by fork.
+
+parallel_speedup times an epoch of the parallel loop against the
+serial run_backprop_algorithm_batches.
+
+with shared=True the dataset, the param values and the per-shard
+gradient accumulators live in multiprocessing.shared_memory arrays
+(SharedArrays): workers read data rows and params and write gradient
+sums in place, and the per-step messages are only shard bounds. the
+parent writes the dataset rows in shuffled order into the shared
+array once per epoch, so each shard is a contiguous view of it rather
+than a gathered copy.
+
+"""
+import multiprocessing
+import random
+import time
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from algorithms61_62 import Workspace, value_and_grad, batch_value_and_grad, \
+    run_backprop_algorithm_batches, mlp_cgraph, mlp_leaves, mlp_data, \
+    _end_iteration, _training_result
+from metrics import PrintSink
+from optimizers import SGD, LeafParams
+
+
+class SharedArray(np.ndarray):
+    """ numpy array over a shared memory block, keeping the block
+    (and so the mapping) alive for as long as it or any view of it is """
+
+
+def _shared_array(block, shape, dtype):
+    array = np.ndarray(shape, dtype=dtype, buffer=block.buf).view(SharedArray)
+    array.block = block
+    return array
+
+
+class SharedArrays:
+    """ named numpy arrays backed by shared memory blocks, created in
+    the parent and attached by name in workers (attach_shared).
+    block names are unlinked by unlink(), on leaving a with block (also
+    on error), or at the latest when the object is collected or the
+    interpreter exits; if the parent is killed outright the
+    multiprocessing resource tracker unlinks them. each mapping is
+    released with the last array viewing it.
+    """
+
+    def __init__(self):
+        self.arrays = {}
+        self._blocks = []
+        self._finalizer = weakref.finalize(self, SharedArrays._release,
+                                           self._blocks)
+
+    def create(self, name, shape, dtype=np.float64):
+        # new zeroed shared array
+        dtype = np.dtype(dtype)
+        size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        block = shared_memory.SharedMemory(create=True, size=size)
+        self._blocks.append(block)
+        array = _shared_array(block, shape, dtype)
+        array[...] = 0
+        self.arrays[name] = array
+        return array
+
+    def spec(self):
+        # picklable description for attach_shared
+        return {name: (array.block.name, array.shape, array.dtype.str)
+                for name, array in self.arrays.items()}
+
+    @staticmethod
+    def _release(blocks):
+        for block in blocks:
+            try:
+                block.unlink()
+            except FileNotFoundError:
+                pass
+        blocks.clear()
+
+    def unlink(self):
+        self.arrays.clear()
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.unlink()
+
+
+def attach_shared(spec):
+    """ attach to SharedArrays by spec(): dict of name -> SharedArray """
+    arrays = {}
+    for name, (block_name, shape, dtype) in spec.items():
+        # pool workers share the parent's resource tracker, so attaching
+        # does not hand the block's lifetime to this process
+        block = shared_memory.SharedMemory(name=block_name)
+        arrays[name] = _shared_array(block, shape, dtype)
+    return arrays
+
+
+# per-process worker state, set by _init_worker
+_worker = {}
+
+
+def _init_worker(cgraph, x, param_indices, data_indices, batched,
+                 shared_spec=None):
+    _worker['cgraph'] = cgraph
+    _worker['x'] = list(x)
+    _worker['param_indices'] = param_indices
+    _worker['data_indices'] = data_indices
+    _worker['batched'] = batched
+    _worker['workspace'] = Workspace(cgraph)
+    if shared_spec is not None:
+        _worker['shared'] = attach_shared(shared_spec)
+
+
+def _set_data(x, data_indices, xb_e):
+    for m, xdata_ix in enumerate(data_indices[:-1]):
+        x[xdata_ix] = xb_e[0][m]  # x values
+    x[data_indices[-1]] = xb_e[1]  # y value
+
+
+def shard_gradient(cgraph, x, param_indices, data_indices, shard,
+                   batched=False, workspace=None):
+    """ sums over the data points of shard of the loss and of
+    del loss / del x[ix] for ix in param_indices
+    (buffers from workspace, a Workspace of cgraph, if given) """
+    grad_sum = [0.] * len(param_indices)
+    loss_sum = 0.
+    if not shard:
+        return grad_sum, loss_sum
+    if batched:
+        xs = np.array([xb_e[0] for xb_e in shard])
+        for m, xdata_ix in enumerate(data_indices[:-1]):
+            x[xdata_ix] = xs[:, m]
+        x[data_indices[-1]] = np.array([xb_e[1] for xb_e in shard])
+        loss_sum, grad_table = batch_value_and_grad(cgraph, x, mean=False,
+                                                    workspace=workspace)
+        return [grad_table[ix] for ix in param_indices], loss_sum
+    for xb_e in shard:
+        _set_data(x, data_indices, xb_e)
+        loss, grad_table = value_and_grad(cgraph, x, workspace=workspace)
+        loss_sum += loss
+        for p, ix in enumerate(param_indices):
+            grad_sum[p] += grad_table[ix]
+    return grad_sum, loss_sum
+
+
+def _worker_shard_gradient(args):
+    param_values, shard = args
+    x = _worker['x']
+    param_indices = _worker['param_indices']
+    for ix, v in zip(param_indices, param_values):
+        x[ix] = v
+    return shard_gradient(_worker['cgraph'], x, param_indices,
+                          _worker['data_indices'], shard,
+                          _worker['batched'], _worker['workspace'])
+
+
+def _worker_shared_shard_gradient(args):
+    # shard of rows start:stop of the shared dataset (in this epoch's
+    # order), writing its gradient and loss sums to row / entry slot of
+    # the accumulators
+    slot, start, stop = args
+    shared = _worker['shared']
+    x = _worker['x']
+    param_indices = _worker['param_indices']
+    for ix, v in zip(param_indices, shared['params'].tolist()):
+        x[ix] = v
+    rows = shared['data'][start:stop]
+    if _worker['batched']:
+        shard = [(row[:-1], row[-1]) for row in rows]
+    else:
+        shard = [(row[:-1], row[-1]) for row in rows.tolist()]
+    grad_sum, loss_sum = shard_gradient(_worker['cgraph'], x, param_indices,
+                                        _worker['data_indices'], shard,
+                                        _worker['batched'],
+                                        _worker['workspace'])
+    shared['grads'][slot] = grad_sum
+    shared['losses'][slot] = loss_sum
+
+
+def split_shards(items, n_shards):
+    """ n_shards contiguous, near equal-size pieces of items """
+    q, r = divmod(len(items), n_shards)
+    bounds = [0]
+    for s in range(n_shards):
+        bounds.append(bounds[-1] + q + (1 if s < r else 0))
+    return [items[bounds[s]:bounds[s + 1]] for s in range(n_shards)]
+
+
+def run_backprop_algorithm_parallel(cgraph, xb, x, param_indices,
+                                    data_indices,
+                                    n_workers=None,
+                                    batch_size=10,
+                                    learning_rate=1e-3,
+                                    n_iterations=10**5,
+                                    print_freq=10**2,
+                                    seed=0,
+                                    batched=False,
+                                    shared=False,
+                                    profiler=None,
+                                    metrics=None,
+                                    optimizer=None,
+                                    stopping=None,
+                                    checkpoint=None):
+    """ run_backprop_algorithm_batches with each minibatch sharded
+    across a pool of n_workers processes (default: cpu count).
+    If shared, data, params and gradient accumulators are shared
+    memory arrays rather than sent to the workers each step
+    (data points must then have float x values; the parent keeps a
+    second copy of the data to permute from).
+    If a profiling.Profiler is given, steps (the sharded gradient and
+    the update, as a whole) and epochs are timed.
+    Epochs are logged to the metrics sink (metrics.MetricsSink),
+    by default printed every print_freq epochs.
+    Updates the params in x in place with the optimizer
+    (optimizers.Optimizer), by default SGD(learning_rate).
+    Runs n_iterations epochs, or until the stopping criteria
+    (stopping.StoppingCriteria) are met, checked after each epoch with
+    its mean loss and the gradient of its last minibatch.
+    With a checkpoint.Checkpointer, params, optimizer state, data order
+    and rng state are checkpointed every checkpoint.every epochs, at the
+    end of the epoch, and a run resumes from an existing checkpoint at
+    the start of the next epoch.
+    Returns a stopping.TrainingResult.
+    """
+    n_workers = n_workers or multiprocessing.cpu_count()
+    if metrics is None:
+        metrics = PrintSink(print_freq)
+    if optimizer is None:
+        optimizer = SGD(learning_rate)
+    rng = random.Random(seed)
+    first, order = 0, None
+    if checkpoint is not None:
+        first, order = checkpoint.restore(x, optimizer, rng)
+    if order is None:
+        order = list(range(len(xb)))
+    leaf_params = LeafParams(x, param_indices)
+    grad_sum = np.empty_like(leaf_params.vector)
+    n_params = len(param_indices)
+    run_start = time.perf_counter()
+    if stopping is not None:
+        stopping.start()
+    losses = []
+    reason = None
+    loss = None
+    with SharedArrays() as arrays:
+        shared_spec = None
+        if shared:
+            n_features = len(data_indices) - 1
+            rows = np.empty((len(xb), n_features + 1))
+            for t, xb_e in enumerate(xb):
+                rows[t, :n_features] = xb_e[0][:n_features]
+                rows[t, n_features] = xb_e[1]
+            data = arrays.create('data', rows.shape)
+            params = arrays.create('params', (n_params,))
+            params[:] = [x[ix] for ix in param_indices]
+            shard_grads = arrays.create('grads', (n_workers, n_params))
+            shard_losses = arrays.create('losses', (n_workers,))
+            shared_spec = arrays.spec()
+        with multiprocessing.Pool(n_workers, _init_worker,
+                                  (cgraph, x, param_indices, data_indices,
+                                   batched, shared_spec)) as pool:
+            for i in range(first, n_iterations):
+                start = time.perf_counter()
+                n_steps = 0
+                epoch_loss_sum = 0.
+                rng.shuffle(order)
+                if shared:
+                    np.take(rows, order, axis=0, out=data)
+                for j in range(0, len(order), batch_size):
+                    if profiler is not None:
+                        step_start = time.perf_counter()
+                    stop = min(j + batch_size, len(order))
+                    if shared:
+                        bounds = split_shards(range(j, stop), n_workers)
+                        pool.map(_worker_shared_shard_gradient,
+                                 [(slot, r.start, r.stop)
+                                  for slot, r in enumerate(bounds)])
+                        results = zip(shard_grads.tolist(),
+                                      shard_losses.tolist())
+                    else:
+                        minibatch = [xb[t] for t in order[j:stop]]
+                        param_values = [x[ix] for ix in param_indices]
+                        results = pool.map(_worker_shard_gradient,
+                                           [(param_values, shard) for shard
+                                            in split_shards(minibatch, n_workers)])
+                    # reduce in shard order
+                    grad_sum.fill(0.)
+                    loss_sum = 0.
+                    for shard_grad, shard_loss in results:
+                        loss_sum += shard_loss
+                        grad_sum += shard_grad
+                    grad_sum /= stop - j
+                    optimizer.step(leaf_params.vector, grad_sum)
+                    leaf_params.write_back()
+                    if shared:
+                        # broadcast by writing the shared params
+                        params[:] = leaf_params.vector
+                    epoch_loss_sum += loss_sum
+                    n_steps += 1
+                    if profiler is not None:
+                        profiler.add('step', None, 'parallel_step',
+                                     time.perf_counter() - step_start)
+
+                loss = epoch_loss_sum / len(order)
+                losses.append(loss)
+                _end_iteration(i, start, loss, x, param_indices, metrics,
+                               profiler, steps=n_steps)
+                if checkpoint is not None and checkpoint.due(i + 1):
+                    checkpoint.save(i + 1, x, param_indices, cgraph,
+                                    optimizer, order, rng)
+                if stopping is not None:
+                    reason = stopping.check(i, loss, grad_sum, x)
+                    if reason is not None:
+                        break
+    metrics.flush()
+    return _training_result(x, param_indices, losses, reason, run_start,
+                            stopping)
+
+
+def parallel_speedup(cgraph, xb, x, param_indices, data_indices,
+                     n_workers=None, n_iterations=1, **kwargs):
+    """ wall clock seconds of the serial loop
+    (run_backprop_algorithm_batches) and the parallel loop on copies of
+    x for the same settings, and serial / parallel speedup """
+    start = time.perf_counter()
+    run_backprop_algorithm_batches(cgraph, list(xb), list(x), param_indices,
+                                   data_indices, n_iterations=n_iterations,
+                                   **kwargs)
+    serial = time.perf_counter() - start
+    # pool start up is counted in the parallel time
+    parallel = run_backprop_algorithm_parallel(
+        cgraph, xb, list(x), param_indices, data_indices,
+        n_workers=n_workers, n_iterations=n_iterations, **kwargs).seconds
+    return dict(serial_seconds=serial, parallel_seconds=parallel,
+                speedup=serial / parallel, n_workers=n_workers)
+
+
+def mlp_example():
+    """
+    mlp, data-parallel: speedup of one epoch versus the serial loop
+    """
+    random.seed(0)
+    n, k = 40, 3
+    cgraph = mlp_cgraph(n, k)
+    x, param_indices, data_indices = mlp_leaves(n, k)
+    xb = mlp_data(n, 2000)
+    for n_workers in (2, 4):
+        report = parallel_speedup(cgraph, xb, x, param_indices, data_indices,
+                                  n_workers=n_workers, batch_size=500,
+                                  learning_rate=1e-9)
+        print(f'{n_workers} workers: serial {report["serial_seconds"]:.3f}s '
+              f'parallel {report["parallel_seconds"]:.3f}s '
+              f'speedup {report["speedup"]:.2f}x')
+
+
+if __name__ == "__main__":
+    mlp_example()
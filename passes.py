@@ -0,0 +1,289 @@
+# passes.py
+"""
+optimization passes over SimpleCGraph and NodeFunction graphs
+
+optimize runs a pipeline of passes over a SimpleCGraph, given the
+leaf values x and the live leaves (params and data, the leaves that
+change between calls):
+
+    fold_constants          leaves outside live are constants, and op
+                            nodes all of whose parents are constants
+                            are evaluated once and become constant
+                            leaves
+    fuse_chains             an op node whose only parent is an op node
+                            used by it alone is fused with it into one
+                            FusedNode, evaluating the chain in one step
+                            with the chain rule for its vjp
+    eliminate_dead_nodes    nodes with no path to the root are removed
+                            (live leaves are kept)
+
+the result is renumbered compactly, parents still lower-indexed:
+
+    opt = optimize(cgraph, x, param_indices + data_indices)
+    x_opt = opt.leaf_values(x)
+    run_backprop_algorithm(opt.cgraph, x_opt, opt.indices(param_indices))
+    opt.write_back(x_opt, x, param_indices)
+
+constants are taken from x when optimizing, so the optimized graph is
+valid for as long as they are unchanged. the gradients wrt. the live
+leaves are those of the original graph.
+
+optimize_node_function does the same for a backprop_ex graph: it
+copies the graph below the root, fusing chains of single-input nodes
+on the same param into one FusedNodeFunction (e.g. the Mult, Mult,
+Add chain of sample_graph becomes one node). nodes not below the root
+are not part of a NodeFunction graph, and its leaves read the input,
+so there is nothing to prune or fold.
+
+"""
+import copy
+
+from algorithms61_62 import SimpleCGraph, Node
+from backprop_ex import NodeFunction, GraphError
+
+
+class FusedNode(Node):
+    """ chain of nodes, chain[0] on the parents and each later node on
+    the value of the one before, as one node """
+
+    __slots__ = ('chain',)
+
+    def __init__(self, chain, val=None):
+        self.chain = chain
+        self.val = val
+
+    def f(self, arr):
+        v = self.chain[0].f(arr)
+        for node in self.chain[1:]:
+            v = node.f([v])
+        return v
+
+    def vjp(self, g, arr):
+        # inputs of the chain recomputed, then its vjps in reverse
+        inputs = [arr]
+        for node in self.chain[:-1]:
+            inputs.append([node.f(inputs[-1])])
+        for node, cx in zip(reversed(self.chain[1:]), reversed(inputs[1:])):
+            g = node.vjp(g, cx)[0]
+        return self.chain[0].vjp(g, arr)
+
+
+class Rewrite:
+    """ a SimpleCGraph being rewritten by the passes, on its original
+    indices: reverse_adj and nodes of the remaining nodes, the values
+    of constant leaves and counts of what each pass did """
+
+    def __init__(self, cgraph, x, live_indices):
+        n = len(cgraph.nodes)
+        self.reverse_adj = {i: list(cgraph.reverse_adj.get(i) or ())
+                            for i in range(n)}
+        self.nodes = dict(enumerate(cgraph.nodes))
+        self.x = x
+        self.live = set(live_indices)
+        self.root = n - 1
+        self.constants = {}
+        self.stats = dict(nodes=n, folded=0, fused=0, removed=0)
+
+
+def fold_constants(rewrite):
+    reverse_adj, constants = rewrite.reverse_adj, rewrite.constants
+    for i in sorted(rewrite.nodes):
+        parents = reverse_adj[i]
+        if not parents:
+            if i not in rewrite.live:
+                constants[i] = rewrite.x[i]
+        elif all(j in constants for j in parents):
+            constants[i] = rewrite.nodes[i].f([constants[j] for j in parents])
+            reverse_adj[i] = []
+            rewrite.stats['folded'] += 1
+
+
+def fuse_chains(rewrite):
+    reverse_adj, nodes = rewrite.reverse_adj, rewrite.nodes
+    n_consumers = dict.fromkeys(nodes, 0)
+    for parents in reverse_adj.values():
+        for j in parents:
+            n_consumers[j] += 1
+    for i in sorted(nodes):
+        parents = reverse_adj[i]
+        if len(parents) != 1:
+            continue
+        j = parents[0]
+        if not reverse_adj[j] or n_consumers[j] != 1:
+            continue
+        # nodes[j] is the chain fused so far if j was fused
+        chain = nodes[j].chain if isinstance(nodes[j], FusedNode) \
+            else [nodes[j]]
+        nodes[i] = FusedNode(chain + [nodes[i]])
+        reverse_adj[i] = reverse_adj.pop(j)
+        del nodes[j]
+        rewrite.stats['fused'] += 1
+
+
+def eliminate_dead_nodes(rewrite):
+    reverse_adj = rewrite.reverse_adj
+    reached = {rewrite.root}
+    stack = [rewrite.root]
+    while stack:
+        for j in reverse_adj[stack.pop()]:
+            if j not in reached:
+                reached.add(j)
+                stack.append(j)
+    for i in list(rewrite.nodes):
+        if i not in reached and i not in rewrite.live:
+            del rewrite.nodes[i], reverse_adj[i]
+            rewrite.constants.pop(i, None)
+            rewrite.stats['removed'] += 1
+
+
+PASSES = (fold_constants, fuse_chains, eliminate_dead_nodes)
+
+
+class OptimizedGraph:
+    """ optimized cgraph, node_map[i] the index in cgraph of node i of
+    the original graph (None if removed or fused away) """
+
+    def __init__(self, cgraph, node_map, origin, constants, stats):
+        self.cgraph = cgraph
+        self.node_map = node_map
+        self._origin = origin
+        self._constants = constants
+        self.stats = stats
+
+    def indices(self, indices):
+        """ indices in cgraph of the original nodes indices """
+        mapped = [self.node_map[i] for i in indices]
+        if None in mapped:
+            raise Exception("indices include nodes removed by optimization.")
+        return mapped
+
+    def leaf_values(self, x):
+        """ leaf values for cgraph from the original leaf values x, with
+        the constants folded in (None at op nodes) """
+        reverse_adj = self.cgraph.reverse_adj
+        return [None if reverse_adj[m] else
+                self._constants[i] if i in self._constants else x[i]
+                for m, i in enumerate(self._origin)]
+
+    def write_back(self, x_opt, x, indices):
+        """ copy the values of the original nodes indices (params after
+        training) from x_opt, for cgraph, into x """
+        for i in indices:
+            x[i] = x_opt[self.node_map[i]]
+
+    def grad_table(self, grad_table):
+        """ grad_table of cgraph on the original indices, 0. at removed
+        nodes """
+        return [0. if m is None else grad_table[m] for m in self.node_map]
+
+
+def optimize(cgraph, x, live_indices, passes=PASSES):
+    """ cgraph with x[i] for leaves i outside live_indices constant,
+    rewritten by passes, as an OptimizedGraph """
+    rewrite = Rewrite(cgraph, x, live_indices)
+    for graph_pass in passes:
+        graph_pass(rewrite)
+    origin = sorted(rewrite.nodes)
+    node_map = [None] * len(cgraph.nodes)
+    for m, i in enumerate(origin):
+        node_map[i] = m
+    reverse_adj = {m: [node_map[j] for j in rewrite.reverse_adj[i]]
+                   for m, i in enumerate(origin)}
+    # own node objects, alg61 keeps values on them
+    nodes = [copy.copy(rewrite.nodes[i]) for i in origin]
+    stats = dict(rewrite.stats, nodes_after=len(origin))
+    return OptimizedGraph(SimpleCGraph(reverse_adj, nodes), node_map, origin,
+                          rewrite.constants, stats)
+
+
+class FusedNodeFunction(NodeFunction):
+    """ chain of single-input NodeFunctions on the same param as one
+    node, chain[0] the lowest. derivatives follow the chain rule on
+    the recomputed inputs of the chain. """
+
+    def __init__(self, chain):
+        super().__init__(' o '.join(node.name for node in reversed(chain)),
+                         chain[0].n_inputs)
+        self.chain = chain
+        self.direct_params.update(chain[0].direct_params)
+
+    def _inputs(self, xi):
+        inputs = [xi]
+        for node in self.chain[:-1]:
+            inputs.append(node.evaluate(inputs[-1]))
+        return inputs
+
+    def evaluate(self, xi):
+        for node in self.chain:
+            xi = node.evaluate(xi)
+        return xi
+
+    def derivative(self, xi, input_index):
+        inputs = self._inputs(xi)
+        k = self.chain[0].derivative(xi, input_index)
+        for node, x in zip(self.chain[1:], inputs[1:]):
+            k = k * node.derivative(x, 0)
+        return k
+
+    def param_derivative(self, xi):
+        # each node's param derivative times the derivatives above it
+        ksi, k = 0., 1.
+        for node, x in zip(reversed(self.chain), reversed(self._inputs(xi))):
+            ksi = ksi + k * node.param_derivative(x)
+            k = k * node.derivative(x, 0)
+        return ksi
+
+
+def _fusable(node, child):
+    # child the only input of node, used by node alone, on the same
+    # (at most one) param
+    return (len(node.children) == 1 and len(child.parents) == 1
+            and len(child.children) <= 1
+            and child.direct_params == node.direct_params
+            and len(node.direct_params) <= 1)
+
+
+def _detached_copy(node):
+    # node without edges or compiled state, sharing its params
+    node = copy.copy(node)
+    node.children, node.parents = [], []
+    node.is_complete = False
+    node.schedule = None
+    node.direct_params = set(node.direct_params)
+    node.param_index = None
+    node._param_nodes = None
+    node._subset_nodes = None
+    node._all_params = None
+    node._inference_plan = None
+    return node
+
+
+def optimize_node_function(root, verbose=False):
+    """ copy of the complete graph below root with single-input chains
+    fused, set complete. params are shared with the original graph, so
+    gradients are keyed by the same Params. """
+    if not root.is_complete:
+        raise GraphError('graph not complete, call set_complete.')
+    schedule = root.schedule or root._topological_order()
+    # chains top down from each node not absorbed by a node above it
+    copies = {}
+    bottoms = {}
+    for node in reversed(schedule):
+        if node in copies:
+            continue
+        chain = [node]
+        while chain[-1].children and _fusable(chain[-1], chain[-1].children[0]):
+            chain.append(chain[-1].children[0])
+        new = _detached_copy(node) if len(chain) == 1 \
+            else FusedNodeFunction(chain[::-1])
+        for member in chain:
+            copies[member] = new
+        bottoms[new] = chain[-1]
+    for node in schedule:
+        new = copies[node]
+        if bottoms.get(new) is node:
+            for child in node.children:
+                new.add_child(copies[child])
+    new_root = copies[root]
+    new_root.set_complete(verbose)
+    return new_root
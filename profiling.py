@@ -0,0 +1,132 @@
+# profiling.py
+"""
+opt-in profiling of graph execution and training
+
+a Profiler is passed as profiler= to alg61, value_and_grad,
+batch_value_and_grad, the training loops in algorithms61_62 and
+NodeFunction.forward_prop / backward_all in backprop_ex. those then run
+instrumented sweeps recording, per phase (forward or backward, or
+step for fused whole passes):
+
+    per node    call count and cumulative seconds
+    per op      the same summed over nodes of one kind (the elementary
+                function or node class)
+
+plus named counters (e.g. pruned subgraphs in backward_all, codegen
+cache hits and misses) and per-iteration timings of the training
+loops. without a profiler the uninstrumented code runs, so profiling
+costs nothing when disabled.
+
+    profiler = Profiler()
+    run_backprop_algorithm(cgraph, x, param_indices, profiler=profiler)
+    print(profiler.table())
+    profiler.to_json('profile.json')
+
+FlatCGraph sweeps and compiled (codegen) steps are timed as a whole,
+as ops without per-node records.
+
+"""
+import json
+import types
+
+
+def op_name(node):
+    """ op type of a node: its elementary function's name for nodes
+    holding a plain function f (SimpleNode), otherwise its class name """
+    f = getattr(node, 'f', None)
+    if isinstance(f, types.FunctionType):
+        return f.__name__
+    return type(node).__name__
+
+
+class Profiler:
+    """ call counts and cumulative times per node and per op,
+    named counters and per-iteration timings """
+
+    def __init__(self):
+        # (phase, node) -> [op, calls, seconds]
+        self.nodes = {}
+        # (phase, op) -> [calls, seconds]
+        self.ops = {}
+        self.counters = {}
+        self.iterations = []
+
+    def add(self, phase, node, op, seconds):
+        # one call of node (an index or name, None for a whole pass)
+        # of op type op in phase
+        if node is not None:
+            entry = self.nodes.get((phase, node))
+            if entry is None:
+                entry = self.nodes[phase, node] = [op, 0, 0.]
+            entry[1] += 1
+            entry[2] += seconds
+        entry = self.ops.get((phase, op))
+        if entry is None:
+            entry = self.ops[phase, op] = [0, 0.]
+        entry[0] += 1
+        entry[1] += seconds
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def iteration(self, seconds, **info):
+        # timing of one training loop iteration
+        self.iterations.append(dict(iteration=len(self.iterations),
+                                    seconds=seconds, **info))
+
+    def reset(self):
+        self.__init__()
+
+    def to_dict(self):
+        """ json-serializable profile, nodes and ops by time descending """
+        ops = [dict(phase=phase, op=op, calls=calls, seconds=seconds)
+               for (phase, op), (calls, seconds) in self.ops.items()]
+        nodes = [dict(phase=phase, node=node, op=op, calls=calls,
+                      seconds=seconds)
+                 for (phase, node), (op, calls, seconds) in self.nodes.items()]
+        ops.sort(key=lambda r: -r['seconds'])
+        nodes.sort(key=lambda r: -r['seconds'])
+        return dict(ops=ops, nodes=nodes, counters=dict(self.counters),
+                    iterations=list(self.iterations))
+
+    def to_json(self, path=None, indent=1):
+        """ profile as a json string, also written to path if given """
+        text = json.dumps(self.to_dict(), indent=indent)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+    def table(self, top=10):
+        """ text table of the ops and the top nodes by time, counters
+        and iteration timing summary """
+        profile = self.to_dict()
+        lines = []
+        total = sum(r['seconds'] for r in profile['ops']) or 1.
+        header = f'{"phase":<9} {"op":<30} {"calls":>9} {"seconds":>10} ' \
+                 f'{"us/call":>9} {"share":>6}'
+        lines.append(header)
+        for r in profile['ops']:
+            lines.append(f'{r["phase"]:<9} {str(r["op"]):<30} {r["calls"]:>9} '
+                         f'{r["seconds"]:>10.4f} '
+                         f'{r["seconds"] * 1e6 / r["calls"]:>9.2f} '
+                         f'{r["seconds"] / total:>6.1%}')
+        if profile['nodes']:
+            lines.append('')
+            lines.append(f'{"phase":<9} {"node":<20} {"calls":>9} '
+                         f'{"seconds":>10} {"op":<12}')
+            for r in profile['nodes'][:top]:
+                lines.append(f'{r["phase"]:<9} {str(r["node"]):<20} '
+                             f'{r["calls"]:>9} {r["seconds"]:>10.4f} '
+                             f'{str(r["op"]):<12}')
+        if profile['counters']:
+            lines.append('')
+            for name, n in sorted(profile['counters'].items()):
+                lines.append(f'{name:<30} {n:>9}')
+        if profile['iterations']:
+            seconds = [r['seconds'] for r in profile['iterations']]
+            lines.append('')
+            lines.append(f'iterations {len(seconds)}: total {sum(seconds):.4f}s '
+                         f'mean {sum(seconds) / len(seconds):.6f}s '
+                         f'min {min(seconds):.6f}s max {max(seconds):.6f}s')
+        return '\n'.join(lines)
@@ -0,0 +1,264 @@
+# remat.py
+"""
+memory-bounded backward passes by activation checkpointing
+(rematerialization)
+
+value_and_grad keeps the parent values of every node for the
+backward sweep (and alg61 every node's val), backward_all a
+forward_store entry per node, so memory grows with depth. here the
+nodes, in evaluation order, are split into segments (by default of
+about sqrt(n) nodes): the forward sweep keeps only the values used
+across segments (and the leaves, which are read from x), and the
+backward sweep recomputes each segment's values from them just before
+running backward through it. a memory budget, in node values, keeps
+whole segments from the end of the graph beyond the minimum, which
+the backward sweep then does not recompute.
+
+    remat = Rematerialization(budget=2000)
+    loss, grad_table = remat.value_and_grad(cgraph, x)
+    remat.stats     # peak live values against extra node evaluations
+
+Rematerialization also runs batch_value_and_grad and backward_all
+(NodeFunction graphs), and is taken by the training loops as remat=.
+the segments are planned on the first call for a graph and reused
+while the same graph is passed.
+grad_table entries at non-leaf nodes are released (0.) once used, so
+only the leaf entries are returned.
+
+"""
+import math
+
+import numpy as np
+
+from algorithms61_62 import _batch_reduce
+from backprop_ex import GraphError
+
+
+def plan_segments(consumers, segment_size=None, budget=None):
+    """ segments of positions 0, ..., n-1 of a topological order,
+    consumers[p] the positions using the value at p: the segment size,
+    the boundary positions (values used by a later segment) and the set
+    of segments kept whole within budget """
+    n = len(consumers)
+    size = segment_size or max(1, math.isqrt(n - 1) + 1 if n else 1)
+    boundary = {p for p in range(n)
+                if any(c // size != p // size for c in consumers[p])}
+    n_segments = -(-n // size)
+    kept = set()
+    if budget is not None:
+        # stored values plus one segment recomputed at a time
+        minimum = len(boundary) + min(size, n)
+        if budget < minimum:
+            raise Exception(f"memory budget of {budget} values is below the "
+                            f"{minimum} needed with segments of {size} nodes.")
+        room = budget - minimum
+        # the backward sweep reaches the last segments first
+        for k in reversed(range(n_segments)):
+            extra = sum(1 for p in range(k * size, min(n, (k + 1) * size))
+                        if p not in boundary)
+            if extra > room:
+                break
+            room -= extra
+            kept.add(k)
+    return size, boundary, kept
+
+
+class Rematerialization:
+    """ checkpointed value_and_grad, batch_value_and_grad and
+    backward_all with segments of segment_size nodes (default about
+    sqrt(n)) and optionally a budget of live node values. stats holds
+    the counts of the last call:
+
+        nodes           nodes evaluated by a forward sweep
+        segments        number of segments
+        segment_size
+        stored_values   values kept across segments (peak)
+        peak_values     node values alive at once (peak)
+        recomputed      node evaluations repeated by the backward sweep
+        extra_compute   recomputed / nodes
+    """
+
+    def __init__(self, segment_size=None, budget=None):
+        self.segment_size = segment_size
+        self.budget = budget
+        self.stats = {}
+        self._graph_plan = None
+        self._node_plan = None
+
+    def _stats(self, n, size, stored, peak, recomputed):
+        self.stats = dict(nodes=n, segments=-(-n // size), segment_size=size,
+                          stored_values=stored, peak_values=peak,
+                          recomputed=recomputed,
+                          extra_compute=recomputed / n if n else 0.)
+
+    def _plan(self, order, parents):
+        # segments of order, boundary items and kept segments, consumers
+        # taken from parents(item) rather than a forward adjacency list
+        position = {item: p for p, item in enumerate(order)}
+        consumers = [[] for _ in order]
+        for p, item in enumerate(order):
+            for parent in parents(item):
+                if parent in position:
+                    consumers[position[parent]].append(p)
+        size, boundary, kept = plan_segments(consumers, self.segment_size,
+                                             self.budget)
+        segments = [order[a:a + size] for a in range(0, len(order), size)]
+        return segments, {order[p] for p in boundary}, kept, size
+
+    def _cgraph_plan(self, cgraph):
+        # planned once per graph, the plan of the last graph kept
+        if self._graph_plan is None or self._graph_plan[0] is not cgraph:
+            reverse_adj = cgraph.reverse_adj
+            self._graph_plan = (cgraph,) + self._plan(
+                cgraph.op_indices, lambda i: reverse_adj[i])
+        return self._graph_plan[1:]
+
+    def _node_function_plan(self, root, schedule):
+        # as _cgraph_plan, replanned once set_complete rebuilds the schedule
+        if self._node_plan is None or self._node_plan[0] is not root \
+                or self._node_plan[1] is not schedule:
+            self._node_plan = (root, schedule) + self._plan(
+                schedule, lambda node: node.children)
+        return self._node_plan[2:]
+
+    def value_and_grad(self, cgraph, x, grad_root=1.):
+        """ value_and_grad on a SimpleCGraph, grad_root a value or a
+        function of the root value """
+        nodes, reverse_adj = cgraph.nodes, cgraph.reverse_adj
+        segments, boundary, kept, size = self._cgraph_plan(cgraph)
+
+        def evaluate(segment, stored):
+            # values and parent values of the nodes of segment
+            vals, inputs = {}, {}
+            for i in segment:
+                parent_vals = []
+                for j in reverse_adj[i]:
+                    if j in vals:
+                        parent_vals.append(vals[j])
+                    elif j in stored:
+                        parent_vals.append(stored[j])
+                    else:
+                        parent_vals.append(x[j])  # leaf
+                inputs[i] = parent_vals
+                vals[i] = nodes[i].f(parent_vals)
+            return vals, inputs
+
+        # forward: keep boundary values, and kept segments whole
+        stored, kept_inputs = {}, {}
+        peak = 0
+        for k, segment in enumerate(segments):
+            vals, inputs = evaluate(segment, stored)
+            peak = max(peak, len(stored) + len(vals))
+            for i, val in vals.items():
+                if k in kept or i in boundary:
+                    stored[i] = val
+            if k in kept:
+                kept_inputs.update(inputs)
+        n_stored = len(stored)
+        root = len(nodes) - 1
+        root_val = stored[root] if root in stored else vals[root]
+        del vals, inputs
+
+        # backward, recomputing segments not kept
+        grad_table = [0.] * len(nodes)
+        grad_table[root] = grad_root(root_val) if callable(grad_root) \
+            else grad_root
+        recomputed = 0
+        for k in reversed(range(len(segments))):
+            segment = segments[k]
+            if k in kept:
+                inputs = kept_inputs
+            else:
+                vals, inputs = evaluate(segment, stored)
+                recomputed += len(segment)
+                peak = max(peak, len(stored) + len(vals))
+                del vals
+            for i in reversed(segment):
+                contributions = nodes[i].vjp(grad_table[i], inputs[i])
+                for j, c in zip(reverse_adj[i], contributions):
+                    grad_table[j] = grad_table[j] + c
+                grad_table[i] = 0.
+                stored.pop(i, None)
+                kept_inputs.pop(i, None)
+            del inputs
+        self._stats(len(cgraph.op_indices), size, n_stored, peak, recomputed)
+        return root_val, grad_table
+
+    def batch_value_and_grad(self, cgraph, x, mean=True):
+        """ batch_value_and_grad on a SimpleCGraph """
+        root_val, grad_table = self.value_and_grad(cgraph, x, np.ones_like)
+        return _batch_reduce(cgraph.leaf_indices, x, np.asarray(root_val),
+                             grad_table, mean)
+
+    def backward_all(self, root, leaf_x, params=None):
+        """ value of a NodeFunction graph at leaf_x and its derivatives
+        wrt. its params (or just params, if given), as forward_prop
+        followed by backward_all, without a forward_store """
+        if not root.is_complete:
+            raise GraphError('graph not complete, call set_complete.')
+        wanted, relevant = root._params_below(params)
+        schedule = root.schedule or root._topological_order()
+        segments, boundary, kept, size = self._node_function_plan(root,
+                                                                  schedule)
+
+        def evaluate(segment, stored):
+            # outputs and inputs xi of the nodes of segment
+            outputs, xis = {}, {}
+            for node in segment:
+                if not node.children:
+                    xi = leaf_x
+                else:
+                    xi = [outputs[child] if child in outputs
+                          else stored[child] for child in node.children]
+                    if len(xi) == 1:
+                        xi = xi[0]
+                xis[node] = xi
+                if len(node.children) > 1:
+                    outputs[node] = [node.evaluate(xc) for xc in xi]
+                else:
+                    outputs[node] = node.evaluate(xi)
+            return outputs, xis
+
+        stored, kept_xis = {}, {}
+        peak = 0
+        for k, segment in enumerate(segments):
+            outputs, xis = evaluate(segment, stored)
+            peak = max(peak, len(stored) + len(outputs))
+            for node, output in outputs.items():
+                if k in kept or node in boundary:
+                    stored[node] = output
+            if k in kept:
+                kept_xis.update(xis)
+        n_stored = len(stored)
+        value = stored[root] if root in stored else outputs[root]
+        del outputs, xis
+
+        grads = {}
+        adjoints = {root: 1.}
+        recomputed = 0
+        for k in reversed(range(len(segments))):
+            segment = segments[k]
+            if k in kept:
+                xis = kept_xis
+            else:
+                outputs, xis = evaluate(segment, stored)
+                recomputed += len(segment)
+                peak = max(peak, len(stored) + len(outputs))
+                del outputs
+            for node in reversed(segment):
+                stored.pop(node, None)
+                xi = xis.pop(node)
+                adjoint = adjoints.pop(node, None)
+                if adjoint is None:
+                    continue
+                ksi = node.param_derivative(xi)
+                for param in node.direct_params:
+                    if param in wanted:
+                        grads[param] = grads.get(param, 0.) + adjoint * ksi
+                for input_index, child in enumerate(node.children):
+                    if child in relevant:
+                        k_child = node.derivative(xi, input_index)
+                        adjoints[child] = adjoints.get(child, 0.) + \
+                            adjoint * k_child
+        self._stats(len(schedule), size, n_stored, peak, recomputed)
+        return value, grads
@@ -0,0 +1,123 @@
+# stopping.py
+"""
+stopping criteria for the training loops
+
+run_backprop_algorithm, run_backprop_algorithm_batches and
+backprop_ex.run_backprop_algorithm take stopping=, a StoppingCriteria
+checked after every iteration (epoch for the minibatch loop), and stop
+on the first criterion met:
+
+    target_loss     loss at most target_loss
+    loss_tol        loss changed by at most loss_tol since the last
+                    iteration
+    grad_tol        gradient norm (of the last step) at most grad_tol
+    validation      validation(x), a validation loss (see
+                    algorithms61_62.validation_loss), not improved by
+                    more than min_delta for patience evaluations,
+                    evaluated every validation_every iterations. with
+                    restore_best, x is then set back to a copy of the
+                    leaf values of the best evaluation
+    time_budget     wall clock seconds since the run started
+
+otherwise the loop runs n_iterations. the minibatch loops check the
+mean loss over the epoch. backprop_ex.run_backprop_algorithm trains
+Param nodes rather than leaf values and rejects validation. the loops
+return a TrainingResult: final params, loss history (one loss per iteration),
+validation losses, the reason they stopped, iterations and seconds.
+
+    result = run_backprop_algorithm(cgraph, x, param_indices,
+                                    stopping=StoppingCriteria(loss_tol=1e-12))
+    print(result.reason, result.iterations, result.loss)
+
+the mlp examples stop on validation patience, and
+backprop_ex.run_backprop_algorithm once the gradient vanishes.
+
+"""
+import math
+import time
+
+import numpy as np
+
+
+class TrainingResult:
+    """ outcome of a training run """
+
+    def __init__(self, params, losses, reason, iterations, seconds,
+                 validation_losses=None):
+        self.params = params
+        self.losses = losses
+        self.reason = reason
+        self.iterations = iterations
+        self.seconds = seconds
+        self.validation_losses = validation_losses or []
+
+    @property
+    def loss(self):
+        # loss of the last iteration
+        return self.losses[-1] if self.losses else None
+
+    def __repr__(self):
+        return f'TrainingResult(reason={self.reason!r}, ' \
+               f'iterations={self.iterations}, loss={self.loss}, ' \
+               f'seconds={self.seconds:.4f})'
+
+
+class StoppingCriteria:
+    """ stopping criteria, all optional; state is reset by start() """
+
+    def __init__(self, target_loss=None, loss_tol=None, grad_tol=None,
+                 validation=None, patience=10, min_delta=0.,
+                 validation_every=1, time_budget=None, restore_best=True):
+        if patience < 1 or validation_every < 1:
+            raise Exception("patience and validation_every must be at least 1.")
+        self.target_loss = target_loss
+        self.loss_tol = loss_tol
+        self.grad_tol = grad_tol
+        self.validation = validation
+        self.patience = patience
+        self.min_delta = min_delta
+        self.validation_every = validation_every
+        self.time_budget = time_budget
+        self.restore_best = restore_best
+        self.start()
+
+    def start(self):
+        # called by the loop as the run starts
+        self.start_time = time.perf_counter()
+        self.previous_loss = None
+        self.best_validation_loss = math.inf
+        self.bad_evaluations = 0
+        self.validation_losses = []
+        self.best_x = None
+
+    def check(self, i, loss, grad=None, x=None):
+        """ reason to stop after iteration i with loss, grad the gradient
+        vector of its last step and x the leaf values, or None """
+        if loss is not None:
+            if self.target_loss is not None and loss <= self.target_loss:
+                return 'target_loss'
+            if self.loss_tol is not None and self.previous_loss is not None \
+                    and abs(loss - self.previous_loss) <= self.loss_tol:
+                return 'loss_tol'
+            self.previous_loss = loss
+        if self.grad_tol is not None and grad is not None and \
+                math.sqrt(float(grad @ grad)) <= self.grad_tol:
+            return 'grad_tol'
+        if self.validation is not None and i % self.validation_every == 0:
+            validation_loss = self.validation(x)
+            self.validation_losses.append(validation_loss)
+            if validation_loss < self.best_validation_loss - self.min_delta:
+                self.best_validation_loss = validation_loss
+                self.bad_evaluations = 0
+                if self.restore_best:
+                    self.best_x = [np.copy(v) if np.ndim(v) else v for v in x]
+            else:
+                self.bad_evaluations += 1
+                if self.bad_evaluations >= self.patience:
+                    if self.best_x is not None:
+                        x[:] = self.best_x
+                    return 'patience'
+        if self.time_budget is not None and \
+                time.perf_counter() - self.start_time >= self.time_budget:
+            return 'time_budget'
+        return None
@@ -0,0 +1,255 @@
+# tensor_graph.py
+"""
+layer-level graph mode for algorithms 61 and 62
+
+nodes hold numpy arrays rather than floats, and elementary nodes are
+matmul, elementwise and reduction ops with array vector-Jacobian
+products (vjp): given g = del root / del v for node v, vjp returns
+del root / del parent for each parent, shaped as that parent.
+
+the graphs are ordinary SimpleCGraphs, so alg61, alg62 and
+value_and_grad from algorithms61_62 move whole tensors per node.
+
+"""
+import random
+
+import numpy as np
+
+from algorithms61_62 import SimpleCGraph, Node, value_and_grad, \
+    run_backprop_algorithm_batches, mlp_cgraph, mlp_leaves, mlp_data, \
+    train_validation_split, validation_loss
+from stopping import StoppingCriteria
+
+
+def _unbroadcast(g, shape):
+    """ sum g over the axes numpy broadcasting added to get from
+    shape to g's shape """
+    g = np.asarray(g)
+    while g.ndim > len(shape):
+        g = g.sum(axis=0)
+    for axis, d in enumerate(shape):
+        if d == 1 and g.shape[axis] != 1:
+            g = g.sum(axis=axis, keepdims=True)
+    return g
+
+
+class TensorNode(Node):
+    """ Operates with array function f on parent node values
+    to hold an evaluated array val, with vjp giving the
+    gradient contributions to all parents """
+
+    __slots__ = ()
+
+
+class Leaf(TensorNode):
+    """ input node, value given in x """
+
+    __slots__ = ()
+
+
+class MatMul(TensorNode):
+    """ a @ b, with numpy matmul conventions for 1d operands """
+
+    __slots__ = ()
+
+    def f(self, arr):
+        return np.matmul(arr[0], arr[1])
+
+    def vjp(self, g, arr):
+        a, b = np.asarray(arr[0]), np.asarray(arr[1])
+        g = np.asarray(g)
+        # promote 1d operands to matrices as matmul does
+        a2 = a[np.newaxis, :] if a.ndim == 1 else a
+        b2 = b[:, np.newaxis] if b.ndim == 1 else b
+        if b.ndim == 1:
+            g = np.expand_dims(g, -1)
+        if a.ndim == 1:
+            g = np.expand_dims(g, -2)
+        ga = np.matmul(g, np.swapaxes(b2, -1, -2))
+        gb = np.matmul(np.swapaxes(a2, -1, -2), g)
+        if a.ndim == 1:
+            ga = ga.squeeze(-2)
+        if b.ndim == 1:
+            gb = gb.squeeze(-1)
+        return [_unbroadcast(ga, a.shape), _unbroadcast(gb, b.shape)]
+
+
+class Add(TensorNode):
+    """ elementwise a + b """
+
+    __slots__ = ()
+
+    def f(self, arr):
+        return np.add(arr[0], arr[1])
+
+    def vjp(self, g, arr):
+        return [_unbroadcast(g, np.shape(arr[0])),
+                _unbroadcast(g, np.shape(arr[1]))]
+
+
+class Sub(TensorNode):
+    """ elementwise a - b """
+
+    __slots__ = ()
+
+    def f(self, arr):
+        return np.subtract(arr[0], arr[1])
+
+    def vjp(self, g, arr):
+        return [_unbroadcast(g, np.shape(arr[0])),
+                _unbroadcast(np.negative(g), np.shape(arr[1]))]
+
+
+class Mul(TensorNode):
+    """ elementwise a * b """
+
+    __slots__ = ()
+
+    def f(self, arr):
+        return np.multiply(arr[0], arr[1])
+
+    def vjp(self, g, arr):
+        return [_unbroadcast(np.multiply(g, arr[1]), np.shape(arr[0])),
+                _unbroadcast(np.multiply(g, arr[0]), np.shape(arr[1]))]
+
+
+class Square(TensorNode):
+    """ elementwise a^2 """
+
+    __slots__ = ()
+
+    def f(self, arr):
+        return np.square(arr[0])
+
+    def vjp(self, g, arr):
+        return [np.multiply(g, 2. * np.asarray(arr[0]))]
+
+
+class Sum(TensorNode):
+    """ sum of a over axis (all axes if None) """
+
+    __slots__ = ('axis',)
+
+    def __init__(self, axis=None, val=None):
+        super().__init__(val)
+        self.axis = axis
+
+    def f(self, arr):
+        return np.sum(arr[0], axis=self.axis)
+
+    def vjp(self, g, arr):
+        a = np.asarray(arr[0])
+        if self.axis is not None:
+            g = np.expand_dims(g, self.axis)
+        return [np.broadcast_to(g, a.shape).copy()]
+
+
+class ExpandDims(TensorNode):
+    """ a with a new axis of length 1 inserted at axis """
+
+    __slots__ = ('axis',)
+
+    def __init__(self, axis=-1, val=None):
+        super().__init__(val)
+        self.axis = axis
+
+    def f(self, arr):
+        return np.expand_dims(arr[0], self.axis)
+
+    def vjp(self, g, arr):
+        return [np.squeeze(g, self.axis)]
+
+
+def mlp_tensor_graph(n, k):
+    """
+    layer-level counterpart of mlp_cgraph(n, k), one node per layer
+    rather than per unit. with m = n / 2:
+
+    nodes 0, ..., k-1 weight leaves w_l, shape (m,)
+          k input leaf x, shape (..., m)
+          k + 1 target leaf y, shape (...)
+          k + 2 constant leaf of ones, shape (m,)
+
+    then for l = 0, ..., k-2, with z_0 = x:
+        s_l = z_l @ w_l                         (matmul)
+        z_l+1 = expand_dims(s_l) * ones         (every unit of layer l + 1
+                                                 holds <w_l, z_l>, as in
+                                                 mlp_graph_structure)
+    and finally f(x) = z_k-1 @ w_k-1, root (y - f(x))^2.
+    """
+    if n % 2 != 0:
+        raise Exception("n must be even.")
+    nodes = [Leaf() for _ in range(k + 3)]
+    reverse_adj = {i: [] for i in range(k + 3)}
+    x_ix, ones_ix = k, k + 2
+
+    def add_node(node, parents):
+        reverse_adj[len(nodes)] = parents
+        nodes.append(node)
+        return len(nodes) - 1
+
+    z = x_ix
+    for l in range(k - 1):
+        s = add_node(MatMul(), [z, l])
+        s = add_node(ExpandDims(-1), [s])
+        z = add_node(Mul(), [s, ones_ix])
+    fx = add_node(MatMul(), [z, k - 1])
+    diff = add_node(Sub(), [k + 1, fx])
+    add_node(Square(), [diff])
+    return SimpleCGraph(reverse_adj, nodes)
+
+
+def mlp_tensor_leaves(x, n, k):
+    """
+    leaf values for mlp_tensor_graph(n, k) from the per-node leaf values x
+    of mlp_cgraph(n, k), with the matching param_indices and data_indices.
+    data leaves are (x, y): a data point is given as ([x_vector], y).
+    """
+    m = n // 2
+    xt = [np.array(x[n*l:n*l + m], dtype=float) for l in range(k)]
+    xt.append(np.array(x[m:n], dtype=float))
+    xt.append(np.float64(x[n*k + 1]))
+    xt.append(np.ones(m))
+    param_indices = list(range(k))
+    data_indices = [k, k + 1]
+    return xt, param_indices, data_indices
+
+
+def mlp_example():
+    """
+    layer-level mlp: checks root value and weight gradients against the
+    scalar mlp_cgraph, then trains on the same kind of data
+    """
+    n, k = 6, 2
+    m = n // 2
+    x, param_indices, _ = mlp_leaves(n, k)
+    root, grad_table = value_and_grad(mlp_cgraph(n, k), x)
+
+    cgraph_t = mlp_tensor_graph(n, k)
+    xt, param_indices_t, data_indices_t = mlp_tensor_leaves(x, n, k)
+    root_t, grad_table_t = value_and_grad(cgraph_t, xt)
+    grads = np.array([grad_table[ix] for ix in param_indices])
+    grads_t = np.concatenate([grad_table_t[ix] for ix in param_indices_t])
+    print(f'scalar vs tensor root: {root} {float(root_t)}')
+    print(f'max weight gradient difference: {np.max(np.abs(grads - grads_t))}')
+    assert np.isclose(root, root_t) and np.allclose(grads, grads_t)
+
+    ns = 100  # of training points
+    xy_batch = [([np.array(xs[:m])], y) for xs, y in mlp_data(n, ns)]
+    xy_train, xy_validation = train_validation_split(xy_batch, 0.2)
+    stopping = StoppingCriteria(
+        validation=validation_loss(cgraph_t, xy_validation, data_indices_t),
+        patience=20)
+    result = run_backprop_algorithm_batches(cgraph_t,
+                                            xb=xy_train,
+                                            x=xt,
+                                            param_indices=param_indices_t,
+                                            data_indices=data_indices_t,
+                                            batched=True,
+                                            stopping=stopping)
+    print(result)
+
+
+if __name__ == "__main__":
+    random.seed(0)
+    mlp_example()
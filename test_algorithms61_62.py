@@ -0,0 +1,112 @@
+# test_algorithms61_62.py
+"""
+tests of the SimpleCGraph algorithms: batched minibatch evaluation
+against one example at a time, and FlatCGraph against SimpleCGraph
+
+    python -m pytest test_algorithms61_62.py
+"""
+import random
+import unittest
+
+import numpy as np
+
+import algorithms61_62 as alg
+import benchmarks
+from metrics import NullSink
+
+
+def mlp(n=6, k=3, seed=0):
+    random.seed(seed)
+    cgraph = alg.mlp_cgraph(n, k)
+    x, param_indices, data_indices = alg.mlp_leaves(n, k)
+    return cgraph, x, param_indices, data_indices
+
+
+class BatchedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cgraph, self.x, self.param_indices, self.data_indices = mlp()
+        self.xb = alg.mlp_data(6, 12)
+
+    def per_example(self):
+        # summed loss and leaf gradients, one example at a time
+        loss, grads = 0., np.zeros(len(self.x))
+        for xs_e, y in self.xb:
+            x = list(self.x)
+            for m, xdata_ix in enumerate(self.data_indices[:-1]):
+                x[xdata_ix] = xs_e[m]
+            x[self.data_indices[-1]] = y
+            example_loss, grad_table = alg.value_and_grad(self.cgraph, x)
+            loss += example_loss
+            grads[self.param_indices] += [grad_table[ix]
+                                          for ix in self.param_indices]
+        return loss, grads[self.param_indices]
+
+    def batched_x(self):
+        x = list(self.x)
+        xs = np.array([xb_e[0] for xb_e in self.xb], dtype=float)
+        for m, xdata_ix in enumerate(self.data_indices[:-1]):
+            x[xdata_ix] = xs[:, m]
+        x[self.data_indices[-1]] = np.array([xb_e[1] for xb_e in self.xb])
+        return x
+
+    def test_batch_value_and_grad(self):
+        ref_loss, ref_grads = self.per_example()
+        for mean, scale in ((False, 1), (True, len(self.xb))):
+            loss, grad_table = alg.batch_value_and_grad(
+                self.cgraph, self.batched_x(), mean=mean)
+            self.assertAlmostEqual(loss * scale, ref_loss)
+            np.testing.assert_allclose(
+                [grad_table[ix] * scale for ix in self.param_indices],
+                ref_grads, rtol=1e-9, atol=1e-12)
+
+    def test_flat_cgraph_rejected(self):
+        fgraph = alg.FlatCGraph.from_cgraph(self.cgraph)
+        with self.assertRaises(Exception):
+            alg.batch_value_and_grad(fgraph, self.batched_x())
+
+    def test_batched_training(self):
+        # the same mean minibatch gradients, so the same params
+        results = []
+        for batched in (False, True):
+            random.seed(4)
+            x = list(self.x)
+            alg.run_backprop_algorithm_batches(
+                self.cgraph, self.xb, x, self.param_indices,
+                self.data_indices, batch_size=4, n_iterations=5,
+                batched=batched, metrics=NullSink())
+            results.append([x[ix] for ix in self.param_indices])
+        np.testing.assert_allclose(results[1], results[0], rtol=1e-9)
+
+
+class FlatCGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        # all swept on lists but mlp(160, 2), with a fan-in of 160
+        self.graphs = [mlp()[:2], mlp(160, 2)[:2],
+                       (benchmarks.chain_cgraph(200), [1e-3] + [0.] * 200)]
+
+    def test_value_and_grad(self):
+        for cgraph, x in self.graphs:
+            ref_val, ref_grads = alg.value_and_grad(cgraph, x)
+            fgraph = alg.FlatCGraph.from_cgraph(cgraph)
+            self.assertAlmostEqual(alg.alg61(fgraph, x), alg.alg61(cgraph, x))
+            val, grads = alg.value_and_grad(fgraph, x)
+            self.assertAlmostEqual(val, ref_val)
+            np.testing.assert_allclose(grads, ref_grads, rtol=1e-9,
+                                       atol=1e-12)
+
+    def test_narrow_plan(self):
+        narrow = [alg.FlatCGraph.from_cgraph(cgraph).narrow_plan() is not None
+                  for cgraph, _ in self.graphs]
+        self.assertEqual(narrow, [True, False, True])
+
+    def test_to_cgraph(self):
+        for cgraph, x in self.graphs:
+            fgraph = alg.FlatCGraph.from_cgraph(cgraph)
+            self.assertAlmostEqual(alg.alg61(fgraph.to_cgraph(), x),
+                                   alg.alg61(cgraph, x))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+# test_backprop_ex.py
+"""
+tests of the NodeFunction graphs: backward_all against per-param
+backward_prop and finite differences, the param bookkeeping of
+set_complete, and graphs far deeper than the recursion limit
+
+    python -m pytest test_backprop_ex.py
+"""
+import sys
+import unittest
+
+import backprop_ex
+import benchmarks
+from backprop_ex import Add, Mult, Param
+
+
+def multi_param_graph():
+    # params a, b and c each at one or more nodes of the chain
+    a, b, c = Param('a', 0.5), Param('b', 1.5), Param('c', -0.3)
+    nodes = [Add('add a', a), Mult('mult b', b), Mult('mult a', a),
+             Add('add c', c), Mult('mult b 2', b)]
+    for parent, child in zip(nodes, nodes[1:]):
+        parent.add_child(child)
+    root = nodes[0]
+    root.set_complete()
+    return [a, b, c], root
+
+
+def value(root, leaf_x):
+    return root.forward_prop(leaf_x, {})
+
+
+class BackwardAllTest(unittest.TestCase):
+
+    def test_matches_backward_prop(self):
+        params, root = multi_param_graph()
+        forward_store = {}
+        root.forward_prop(0.7, forward_store)
+        grads = root.backward_all(forward_store)
+        self.assertEqual(set(grads), set(params))
+        for param in params:
+            self.assertAlmostEqual(grads[param],
+                                   root.backward_prop(param, forward_store))
+        # a subset of the params
+        subset = root.backward_all(forward_store, [params[2]])
+        self.assertEqual(subset, {params[2]: grads[params[2]]})
+
+    def test_matches_finite_differences(self):
+        params, root = multi_param_graph()
+        forward_store = {}
+        root.forward_prop(0.7, forward_store)
+        grads = root.backward_all(forward_store)
+        eps = 1e-6
+        for param in params:
+            param.value += eps
+            upper = value(root, 0.7)
+            param.value -= 2 * eps
+            lower = value(root, 0.7)
+            param.value += eps
+            self.assertAlmostEqual(grads[param], (upper - lower) / (2 * eps),
+                                   places=6)
+
+    def test_incomplete_graph(self):
+        root = Add('root', Param('a', 1.))
+        with self.assertRaises(backprop_ex.GraphError):
+            root.backward_all({})
+
+
+class ParamsTest(unittest.TestCase):
+
+    def test_all_params(self):
+        (a, b, c), root = multi_param_graph()
+        self.assertEqual(root.all_params(), {a, b, c})
+        self.assertEqual(list(root.param_index), [b, c, a])
+        below = root.children[0].children[0]  # mult a
+        self.assertEqual(below.all_params(), {a, b, c})
+        self.assertTrue(below.has_param(c))
+        self.assertFalse(below.children[0].children[0].has_param(a))
+
+    def test_params_shared_across_graphs(self):
+        # each root numbers its own params
+        (a, b, c), root = multi_param_graph()
+        other = Mult('other', c)
+        other.add_child(Add('other add', a))
+        other.set_complete()
+        self.assertEqual(other.param_index, {a: 0, c: 1})
+        self.assertEqual(root.param_index, {b: 0, c: 1, a: 2})
+        self.assertEqual(root.all_params(), {a, b, c})
+        forward_store = {}
+        other.forward_prop(0.7, forward_store)
+        self.assertEqual(other.backward_all(forward_store),
+                         {a: c.value, c: 0.7 + a.value})
+
+    def test_add_child_invalidates(self):
+        a, b = Param('a', 1.), Param('b', 2.)
+        root = Add('root', a)
+        root.set_complete()
+        self.assertEqual(root.all_params(), {a})
+        root.add_child(Mult('mult b', b))
+        self.assertFalse(root.is_complete)
+        self.assertEqual(root.all_params(), {a, b})
+        root.set_complete()
+        self.assertEqual(root.all_params(), {a, b})
+        forward_store = {}
+        root.forward_prop(3., forward_store)
+        self.assertEqual(root.backward_all(forward_store), {a: 1., b: 3.})
+
+
+class DeepGraphTest(unittest.TestCase):
+
+    def test_chain_without_recursion(self):
+        depth = 100000
+        self.assertLess(sys.getrecursionlimit(), depth)
+        params, root = benchmarks.mult_chain(depth, distinct_params=True)
+        self.assertEqual(len(root.schedule), depth + 1)
+        forward_store = {}
+        value = root.forward_prop(0.9, forward_store)
+        self.assertAlmostEqual(value, 1.9)
+        self.assertEqual(root.infer(0.9), value)
+        grads = root.backward_all(forward_store)
+        self.assertEqual(len(grads), depth + 1)
+        self.assertAlmostEqual(grads[params[0]], 1.)
+        self.assertAlmostEqual(grads[params[-1]], 0.9)
+        self.assertEqual(len(root.all_params()), depth + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+# test_checkpoint.py
+"""
+tests of checkpoints: resumed training against an uninterrupted run,
+the checkpointed structure, and graphs with custom nodes
+
+    python -m pytest test_checkpoint.py
+"""
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+
+import algorithms61_62 as alg
+import tensor_graph
+from checkpoint import Checkpointer, load_checkpoint, save_checkpoint
+from metrics import NullSink
+from optimizers import Adam, Momentum
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'mlp.ckpt')
+        random.seed(0)
+        self.cgraph = alg.mlp_cgraph(6, 3)
+        self.x, self.param_indices, self.data_indices = alg.mlp_leaves(6, 3)
+        self.xb = alg.mlp_data(6, 40)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def train(self, n_iterations, checkpoint=None, seed=5, batched=True):
+        random.seed(seed)
+        x = list(self.x)
+        alg.run_backprop_algorithm_batches(
+            self.cgraph, self.xb, x, self.param_indices, self.data_indices,
+            n_iterations=n_iterations, batched=batched, metrics=NullSink(),
+            optimizer=Momentum(1e-3), checkpoint=checkpoint)
+        return [x[ix] for ix in self.param_indices]
+
+    def test_batches_resume(self):
+        for batched in (True, False):
+            reference = self.train(12, batched=batched)
+            self.train(7, Checkpointer(self.path, 5), batched=batched)
+            # another seed: the rng state comes from the checkpoint
+            resumed = self.train(12, Checkpointer(self.path, 5), seed=99,
+                                 batched=batched)
+            self.assertEqual(resumed, reference)
+            os.remove(self.path)
+
+    def test_full_batch_resume(self):
+        def train(n_iterations, checkpoint=None):
+            x = list(self.x)
+            alg.run_backprop_algorithm(self.cgraph, x, self.param_indices,
+                                       n_iterations=n_iterations,
+                                       metrics=NullSink(),
+                                       optimizer=Momentum(1e-3),
+                                       checkpoint=checkpoint)
+            return [x[ix] for ix in self.param_indices]
+        reference = train(30)
+        train(25, Checkpointer(self.path, 10))
+        self.assertEqual(train(30, Checkpointer(self.path, 10)), reference)
+
+    def test_structure(self):
+        save_checkpoint(self.path, self.x, self.param_indices,
+                        cgraph=self.cgraph)
+        checkpoint = load_checkpoint(self.path)
+        self.assertIsInstance(checkpoint.arrays['parents'], np.memmap)
+        ref_val, _ = alg.value_and_grad(self.cgraph, self.x)
+        self.assertAlmostEqual(
+            alg.value_and_grad(checkpoint.flat_cgraph(), self.x)[0], ref_val)
+        self.assertAlmostEqual(
+            alg.value_and_grad(checkpoint.cgraph(), self.x)[0], ref_val)
+
+    def test_optimizer_state(self):
+        optimizer = Adam(0.1)
+        params = np.zeros(len(self.param_indices))
+        for _ in range(3):
+            optimizer.step(params, np.ones_like(params))
+        save_checkpoint(self.path, self.x, self.param_indices,
+                        optimizer=optimizer, step=3)
+        checkpoint = load_checkpoint(self.path)
+        self.assertEqual(checkpoint.step, 3)
+        restored = Adam(0.1)
+        x = [0.] * len(self.x)
+        checkpoint.restore(x, restored)
+        self.assertEqual([x[ix] for ix in self.param_indices],
+                         [self.x[ix] for ix in self.param_indices])
+        self.assertEqual(restored.t, 3)
+        np.testing.assert_array_equal(restored.state['v'],
+                                      optimizer.state['v'])
+        with self.assertRaises(Exception):
+            checkpoint.restore(x, Momentum())
+        with self.assertRaises(Exception):
+            checkpoint.flat_cgraph()
+
+    def test_custom_nodes(self):
+        # the structure is left out, the params are still checkpointed
+        cgraph = tensor_graph.mlp_tensor_graph(6, 2)
+        xt, param_indices, _ = tensor_graph.mlp_tensor_leaves(
+            alg.mlp_leaves(6, 2)[0], 6, 2)
+        with self.assertRaises(Exception):
+            save_checkpoint(self.path, xt, param_indices, cgraph=cgraph)
+        checkpointer = Checkpointer(self.path, 1)
+        checkpointer.save(1, xt, param_indices, cgraph, Momentum())
+        checkpoint = load_checkpoint(self.path)
+        self.assertNotIn('ops', checkpoint.arrays)
+        x = [np.zeros(3), np.zeros(3)] + xt[2:]
+        checkpoint.restore(x)
+        np.testing.assert_array_equal(x[1], xt[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
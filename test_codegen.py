@@ -0,0 +1,102 @@
+# test_codegen.py
+"""
+tests of graph compilation: generated code against alg61 /
+value_and_grad and NodeFunction forward_prop / backward_all, and the
+code cache
+
+    python -m pytest test_codegen.py
+"""
+import random
+import unittest
+
+import numpy as np
+
+import algorithms61_62 as alg
+import backprop_ex
+import benchmarks
+import codegen
+import tensor_graph
+
+
+class CompileCGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        self.graphs = [(alg.mlp_cgraph(n, k), alg.mlp_leaves(n, k)[0])
+                       for n, k in ((6, 3), (40, 3))]
+        self.graphs.append((benchmarks.chain_cgraph(200),
+                            [1e-3] + [0.] * 200))
+
+    def test_value_and_grad(self):
+        # the same operations in the same order: exact
+        for cgraph, x in self.graphs:
+            ref_val, ref_grads = alg.value_and_grad(cgraph, x)
+            for graph in (cgraph, alg.FlatCGraph.from_cgraph(cgraph)):
+                compiled = codegen.compile_cgraph(graph)
+                self.assertEqual(compiled.forward(x), alg.alg61(cgraph, x))
+                val, grads = compiled.value_and_grad(x)
+                self.assertEqual(val, ref_val)
+                self.assertEqual([grads[i] for i in cgraph.leaf_indices],
+                                 [ref_grads[i] for i in cgraph.leaf_indices])
+
+    def test_custom_nodes(self):
+        # tensor nodes are called through their f and vjp
+        cgraph = tensor_graph.mlp_tensor_graph(6, 2)
+        xt, param_indices, _ = tensor_graph.mlp_tensor_leaves(
+            alg.mlp_leaves(6, 2)[0], 6, 2)
+        ref_val, ref_grads = alg.value_and_grad(cgraph, xt)
+        val, grads = codegen.compile_cgraph(cgraph).value_and_grad(xt)
+        self.assertEqual(val, ref_val)
+        for ix in param_indices:
+            np.testing.assert_array_equal(grads[ix], ref_grads[ix])
+
+    def test_cache(self):
+        codegen.clear_cache()
+        cgraph, x = self.graphs[0]
+        codegen.compile_cgraph(cgraph)
+        self.assertEqual(codegen.cache_info()['misses'], 1)
+        # a rebuilt graph of the same structure reuses the code
+        random.seed(1)
+        compiled = codegen.compile_cgraph(alg.mlp_cgraph(6, 3))
+        info = codegen.cache_info()
+        self.assertEqual((info['hits'], info['misses']), (1, 1))
+        compiled.forward(x)
+        self.assertEqual(codegen.cache_info()['misses'], 2)
+
+    def test_cache_size(self):
+        codegen.clear_cache()
+        for depth in range(codegen.CACHE_SIZE + 5):
+            codegen.compile_cgraph(benchmarks.chain_cgraph(depth + 1))
+        info = codegen.cache_info()
+        self.assertEqual(info['size'], codegen.CACHE_SIZE)
+        self.assertEqual(info['evictions'], 5)
+
+
+class CompileNodeFunctionTest(unittest.TestCase):
+
+    def test_value_and_grad(self):
+        for root in (backprop_ex.sample_graph()[1],
+                     benchmarks.mult_chain(30)[1],
+                     benchmarks.mult_chain(30, distinct_params=True)[1]):
+            forward_store = {}
+            ref_val = root.forward_prop(0.9, forward_store)
+            ref_grads = root.backward_all(forward_store)
+            compiled = codegen.compile_node_function(root)
+            self.assertAlmostEqual(compiled.forward(0.9), ref_val)
+            val, grads = compiled.value_and_grad(0.9)
+            self.assertAlmostEqual(val, ref_val)
+            self.assertEqual(set(grads), set(ref_grads))
+            for param in ref_grads:
+                self.assertAlmostEqual(grads[param], ref_grads[param])
+
+    def test_reads_param_values(self):
+        params, root = benchmarks.mult_chain(3)
+        compiled = codegen.compile_node_function(root)
+        before = compiled.forward(0.9)
+        params[0].value = 2.
+        self.assertNotEqual(compiled.forward(0.9), before)
+        self.assertAlmostEqual(compiled.forward(0.9), root.infer(0.9))
+
+
+if __name__ == '__main__':
+    unittest.main()
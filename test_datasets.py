@@ -0,0 +1,94 @@
+# test_datasets.py
+"""
+tests of memory-mapped datasets: round trip, minibatches with and
+without prefetching, and errors raised by the reader thread
+
+    python -m pytest test_datasets.py
+"""
+import os
+import random
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+import algorithms61_62 as alg
+from datasets import MemmapDataset, write_dataset
+
+
+class FailingDataset(MemmapDataset):
+    """ raises on reading its second minibatch """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.reads = 0
+
+    def _read(self, indices):
+        self.reads += 1
+        if self.reads == 2:
+            raise ValueError('read failed')
+        return super()._read(indices)
+
+
+class MemmapDatasetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'mlp.bin')
+        random.seed(0)
+        self.xb = alg.mlp_data(6, 22)
+        self.dataset = write_dataset(self.path, self.xb)
+
+    def tearDown(self):
+        del self.dataset
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        self.assertEqual(len(self.dataset), 22)
+        self.assertEqual(self.dataset.n_features, 6)
+        np.testing.assert_array_equal(self.dataset.data[:, :-1],
+                                      [xs for xs, _ in self.xb])
+        np.testing.assert_array_equal(self.dataset.data[:, -1],
+                                      [y for _, y in self.xb])
+
+    def test_batches(self):
+        # every point once, the same minibatches with and without prefetch
+        for prefetch in (0, 1, 3):
+            batches = list(self.dataset.batches(5, seed=7, prefetch=prefetch))
+            self.assertEqual([len(ys) for _, ys in batches], [5, 5, 5, 5, 2])
+            ys = np.sort(np.concatenate([ys for _, ys in batches]))
+            np.testing.assert_array_equal(ys, np.sort(self.dataset.data[:, -1]))
+            if prefetch:
+                for (xs, ys), (xs0, ys0) in zip(batches, reference):
+                    np.testing.assert_array_equal(xs, xs0)
+                    np.testing.assert_array_equal(ys, ys0)
+            else:
+                reference = batches
+
+    def test_closed_early(self):
+        # the reader thread stops once the generator is closed
+        threads = threading.active_count()
+        batches = self.dataset.batches(2, seed=1, prefetch=2)
+        next(batches)
+        batches.close()
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_reader_error(self):
+        dataset = FailingDataset(self.path)
+        batches = dataset.batches(5, seed=7, prefetch=1)
+        next(batches)
+        with self.assertRaises(ValueError):
+            next(batches)
+        self.assertEqual(dataset.reads, 2)
+
+    def test_not_a_dataset(self):
+        path = os.path.join(self.directory.name, 'other.bin')
+        with open(path, 'wb') as f:
+            f.write(b'\0' * 64)
+        with self.assertRaises(Exception):
+            MemmapDataset(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# test_graph_builder.py
+"""
+tests of layered graph construction and the topological order check
+
+    python -m pytest test_graph_builder.py
+"""
+import random
+import unittest
+
+import numpy as np
+
+import algorithms61_62 as alg
+import tensor_graph
+from algorithms61_62 import OP_DOT, OP_NODE, OP_SQDIFF, OP_SUM
+from graph_builder import LayeredGraphBuilder, check_topological
+
+
+class BuilderTest(unittest.TestCase):
+
+    def test_mlp_flat_cgraph(self):
+        # the same csr arrays as converting the mlp built node by node
+        fgraph = alg.mlp_flat_cgraph(6, 3)
+        reference = alg.FlatCGraph.from_cgraph(alg.mlp_cgraph(6, 3))
+        for name in ('offsets', 'parents', 'ops'):
+            np.testing.assert_array_equal(getattr(fgraph, name),
+                                          getattr(reference, name))
+
+    def test_mlp_graph_structure(self):
+        reverse_adj = alg.mlp_graph_structure(6, 2)
+        self.assertEqual(len(reverse_adj), 6 * 2 + 3)
+        self.assertEqual(reverse_adj[6 * 2 + 2], [6 * 2 + 1, 6 * 2])
+        # weights 6, 7, 8 leaves, inputs 9, 10, 11 of the first layer
+        self.assertEqual([reverse_adj[i] for i in range(6, 12)],
+                         [[]] * 3 + [[0, 1, 2, 3, 4, 5]] * 3)
+        self.assertEqual(reverse_adj[12], list(range(6, 12)))
+
+    def test_layers(self):
+        builder = LayeredGraphBuilder()
+        x = builder.add_leaves(3)
+        w = builder.add_leaves(3)
+        h = builder.add_dense_layer(2, np.concatenate([w, x]), OP_DOT)
+        pairs = builder.add_layer([[h[0], x[0]], [h[1], x[1]]], OP_SQDIFF)
+        root = builder.add_dense_layer(1, pairs, OP_SUM)
+        self.assertEqual(root.tolist(), [10])
+        reverse_adj = builder.reverse_adj()
+        self.assertEqual(reverse_adj[0], [])
+        self.assertEqual(reverse_adj[6], [3, 4, 5, 0, 1, 2])
+        self.assertEqual(reverse_adj[9], [7, 1])
+        random.seed(0)
+        values = [random.random() for _ in range(6)] + [None] * 5
+        cgraph = alg.SimpleCGraph(reverse_adj, [
+            alg.SimpleNode(*alg.OP_FUNCTIONS[op])
+            if op in alg.OP_FUNCTIONS else None
+            for op in builder.build()[2].tolist()])
+        self.assertAlmostEqual(alg.alg61(builder.flat_cgraph(), values),
+                               alg.alg61(cgraph, values))
+        self.assertAlmostEqual(alg.alg61(builder.cgraph(), values),
+                               alg.alg61(cgraph, values))
+
+    def test_custom_layer(self):
+        builder = LayeredGraphBuilder()
+        a = builder.add_leaves(2)
+        square = tensor_graph.Square()
+        out = builder.add_layer(a[:, None], OP_NODE, square)
+        fgraph = builder.flat_cgraph()
+        self.assertEqual(fgraph.custom, {2: square, 3: square})
+        self.assertEqual(alg.alg61(fgraph, [2., 3., None, None]), 9.)
+        self.assertEqual(out.tolist(), [2, 3])
+
+    def test_invalid_layers(self):
+        builder = LayeredGraphBuilder()
+        builder.add_leaves(2)
+        for parents, op in (([0, 1], OP_SUM),           # not 2d
+                            ([[0, 2]], OP_SUM),         # not yet added
+                            ([[-1, 0]], OP_SUM),
+                            (np.empty((1, 0)), OP_SUM),  # no parents
+                            ([[0]], OP_NODE)):          # no node
+            with self.assertRaises(Exception):
+                builder.add_layer(parents, op)
+        self.assertEqual(builder.n, 2)
+
+
+class CheckTopologicalTest(unittest.TestCase):
+
+    def test_valid(self):
+        fgraph = alg.mlp_flat_cgraph(10, 4)
+        check_topological(fgraph.offsets, fgraph.parents)
+        check_topological([0], [])
+
+    def test_invalid(self):
+        for offsets, parents in (([0, 0, 1], [1]),        # own index
+                                 ([0, 0, 1, 2], [0, 2]),  # later node
+                                 ([0, 0, 1], [-1]),
+                                 ([0, 2, 1], [0]),        # decreasing
+                                 ([0, 0, 2], [0]),        # short parents
+                                 ([1, 1], [])):
+            with self.assertRaises(Exception):
+                check_topological(offsets, parents)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+# test_incremental.py
+"""
+tests of incremental evaluation against alg61 and value_and_grad, and
+of the nodes it evaluates and skips
+
+    python -m pytest test_incremental.py
+"""
+import random
+import unittest
+
+import numpy as np
+
+import algorithms61_62 as alg
+from incremental import IncrementalGraph
+from profiling import Profiler
+
+
+def wide_graph(m):
+    # sum of m square differences of independent leaf pairs
+    reverse_adj = {2 * m + p: [2 * p, 2 * p + 1] for p in range(m)}
+    reverse_adj[3 * m] = list(range(2 * m, 3 * m))
+    nodes = [alg.SimpleNode(alg.sqdiff_f, alg.sqdiff_pd)
+             for _ in range(3 * m)]
+    nodes.append(alg.SimpleNode(alg.sum_f, alg.sum_pd))
+    return alg.SimpleCGraph(reverse_adj, nodes)
+
+
+class IncrementalGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        self.cgraph = alg.mlp_cgraph(6, 3)
+        self.x, self.param_indices, self.data_indices = alg.mlp_leaves(6, 3)
+
+    def test_value_and_grad(self):
+        graph = IncrementalGraph(self.cgraph)
+        graph.evaluate(self.x)
+        self.assertEqual(graph.last_evaluated, len(self.cgraph.op_indices))
+        x = list(self.x)
+        x[self.param_indices[-1]] += 0.25
+        val, grads = graph.value_and_grad(x)
+        self.assertGreater(graph.last_skipped, 0)
+        ref_val, ref_grads = alg.value_and_grad(self.cgraph, x)
+        self.assertEqual(val, ref_val)
+        self.assertEqual(grads, ref_grads)
+
+    def test_y_only(self):
+        # only the loss node depends on y
+        graph = IncrementalGraph(self.cgraph)
+        graph.evaluate(self.x)
+        x = list(self.x)
+        y = self.data_indices[-1]
+        for changed in (None, [y]):
+            x[y] += 1.
+            self.assertEqual(graph.evaluate(x, changed=changed),
+                             alg.alg61(self.cgraph, x))
+            self.assertEqual(graph.last_evaluated, 1)
+        self.assertEqual(graph.evaluate(x), alg.alg61(self.cgraph, x))
+        self.assertEqual(graph.last_evaluated, 0)
+
+    def test_random_changes(self):
+        cgraph = wide_graph(50)
+        x = [random.random() for _ in range(len(cgraph.nodes))]
+        graph = IncrementalGraph(cgraph)
+        profiler = Profiler()
+        graph.evaluate(x, profiler)
+        for _ in range(30):
+            for i in random.sample(cgraph.leaf_indices, 3):
+                x[i] = random.random()
+            self.assertAlmostEqual(graph.evaluate(x, profiler),
+                                   alg.alg61(cgraph, x))
+            self.assertLessEqual(graph.last_evaluated, 4)
+        self.assertEqual(graph.counters['evaluations'], 31)
+        self.assertEqual(profiler.counters['incremental_nodes_skipped'],
+                         graph.counters['nodes_skipped'])
+
+    def test_unchanged_value_stops(self):
+        # swapping a pair leaves its square difference unchanged
+        cgraph = wide_graph(4)
+        x = [0.1, 0.7] + [0.] * 10
+        graph = IncrementalGraph(cgraph)
+        graph.evaluate(x)
+        x[0], x[1] = x[1], x[0]
+        graph.evaluate(x)
+        self.assertEqual(graph.last_evaluated, 1)
+
+    def test_arrays_and_mark_dirty(self):
+        graph = IncrementalGraph(self.cgraph)
+        x = list(self.x)
+        x[self.data_indices[0]] = np.arange(3.)
+        np.testing.assert_array_equal(graph.evaluate(x),
+                                      alg.alg61(self.cgraph, x))
+        # changed in place: compared by identity, so flagged by hand
+        x[self.data_indices[0]] += 1.
+        graph.evaluate(x)
+        self.assertEqual(graph.last_evaluated, 0)
+        graph.mark_dirty(self.data_indices[0])
+        np.testing.assert_array_equal(graph.evaluate(),
+                                      alg.alg61(self.cgraph, x))
+        self.assertGreater(graph.last_evaluated, 0)
+
+    def test_set_leaf_and_invalidate(self):
+        graph = IncrementalGraph(self.cgraph)
+        graph.evaluate(self.x)
+        x = list(self.x)
+        x[self.param_indices[0]] = 2.
+        graph.set_leaf(self.param_indices[0], 2.)
+        self.assertEqual(graph.evaluate(), alg.alg61(self.cgraph, x))
+        graph.invalidate()
+        graph.evaluate()
+        self.assertEqual(graph.last_evaluated, len(self.cgraph.op_indices))
+
+
+if __name__ == '__main__':
+    unittest.main()
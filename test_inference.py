@@ -0,0 +1,101 @@
+# test_inference.py
+"""
+tests of read-only inference: FrozenGraph and NodeFunction.infer
+against alg61 and forward_prop
+
+    python -m pytest test_inference.py
+"""
+import random
+import threading
+import unittest
+
+import numpy as np
+
+import algorithms61_62 as alg
+import backprop_ex
+import benchmarks
+import tensor_graph
+from inference import FrozenGraph
+
+
+class FrozenGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        self.n, self.k = 6, 3
+        self.cgraph = alg.mlp_cgraph(self.n, self.k)
+        self.x, _, self.data_indices = alg.mlp_leaves(self.n, self.k)
+        self.xs = np.array([xb_e[0] for xb_e in alg.mlp_data(self.n, 8)])
+        self.output = self.n * self.k  # f(x), before the loss node
+
+    def reference(self, xs_e):
+        x = list(self.x)
+        for m, xdata_ix in enumerate(self.data_indices[:-1]):
+            x[xdata_ix] = xs_e[m]
+        alg.alg61(self.cgraph, x)
+        return self.cgraph.nodes[self.output].val
+
+    def test_predict(self):
+        frozen = FrozenGraph(self.cgraph, self.x, self.data_indices[:-1],
+                             output=self.output)
+        # the loss node and y leaf are not evaluated
+        self.assertEqual(frozen.n_evaluated, len(self.cgraph.op_indices) - 1)
+        outputs = frozen.predict(self.xs)
+        for xs_e, output in zip(self.xs, outputs):
+            self.assertAlmostEqual(output, self.reference(xs_e))
+        self.assertAlmostEqual(frozen(self.xs[0]), outputs[0])
+
+    def test_constant_folding(self):
+        # only the nodes depending on the y leaf are left
+        frozen = FrozenGraph(self.cgraph, self.x, self.data_indices[-1:])
+        self.assertEqual(frozen.n_evaluated, 1)
+        x = list(self.x)
+        x[self.data_indices[-1]] = 0.3
+        self.assertAlmostEqual(frozen([0.3]), alg.alg61(self.cgraph, x))
+
+    def test_tensor_graph(self):
+        cgraph = tensor_graph.mlp_tensor_graph(6, 2)
+        xt, _, data_indices = tensor_graph.mlp_tensor_leaves(
+            alg.mlp_leaves(6, 2)[0], 6, 2)
+        frozen = FrozenGraph(cgraph, xt, data_indices)
+        xs, ys = np.random.default_rng(0).normal(size=(5, 3)), np.ones(5)
+        x = list(xt)
+        x[data_indices[0]], x[data_indices[1]] = xs, ys
+        expected = alg.alg61(cgraph, x)
+        np.testing.assert_allclose(frozen([xs, ys]), expected)
+        # array leaves are copied when freezing
+        xt[0] += 1.
+        np.testing.assert_array_equal(frozen([xs, ys]), expected)
+
+    def test_threads(self):
+        frozen = FrozenGraph(self.cgraph, self.x, self.data_indices[:-1],
+                             output=self.output)
+        expected = [frozen(xs_e) for xs_e in self.xs]
+        results = {}
+
+        def run(t):
+            results[t] = [frozen(xs_e) for xs_e in self.xs for _ in range(20)]
+        threads = [threading.Thread(target=run, args=(t,)) for t in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for t in range(4):
+            self.assertEqual(results[t][::20], expected)
+
+
+class InferTest(unittest.TestCase):
+
+    def test_infer(self):
+        for root in (backprop_ex.sample_graph()[1],
+                     benchmarks.mult_chain(30)[1],
+                     benchmarks.mult_chain(30, distinct_params=True)[1]):
+            self.assertEqual(root.infer(0.9), root.forward_prop(0.9, {}))
+
+    def test_incomplete_graph(self):
+        with self.assertRaises(backprop_ex.GraphError):
+            backprop_ex.Add('root', backprop_ex.Param('a', 1.)).infer(0.9)
+
+
+if __name__ == '__main__':
+    unittest.main()
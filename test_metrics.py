@@ -0,0 +1,95 @@
+# test_metrics.py
+"""
+tests of the metrics sinks: buffered and asynchronous FileSink, and
+the records the training loops log
+
+    python -m pytest test_metrics.py
+"""
+import json
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+
+import algorithms61_62 as alg
+from metrics import CallbackSink, FileSink
+
+
+def read_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+class FileSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'metrics.jsonl')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_buffered(self):
+        sink = FileSink(self.path, buffer_size=3)
+        params = [np.float64(0.5), np.array([1., 2.])]
+        for step in range(2):
+            sink.log(dict(step=step, params=params))
+        self.assertEqual(os.path.getsize(self.path), 0)
+        # serialized when logged
+        params[1][0] = -1.
+        sink.log(dict(step=2, params=params))
+        sink.flush()
+        records = read_records(self.path)
+        self.assertEqual([r['step'] for r in records], [0, 1, 2])
+        self.assertEqual(records[0]['params'], [0.5, [1., 2.]])
+        self.assertEqual(records[2]['params'], [0.5, [-1., 2.]])
+        sink.log(dict(step=3))
+        sink.close()
+        sink.close()
+        self.assertEqual(len(read_records(self.path)), 4)
+
+    def test_asynchronous(self):
+        with FileSink(self.path, asynchronous=True) as sink:
+            for step in range(500):
+                sink.log(dict(step=step, loss=np.float64(step / 2)))
+            sink.flush()
+            self.assertEqual(len(read_records(self.path)), 500)
+            sink.log(dict(step=500))
+        self.assertFalse(sink._writer.is_alive())
+        records = read_records(self.path)
+        self.assertEqual([r['step'] for r in records], list(range(501)))
+        self.assertEqual(records[3]['loss'], 1.5)
+
+    def test_appends(self):
+        for step in range(2):
+            with FileSink(self.path) as sink:
+                sink.log(dict(step=step))
+        self.assertEqual(read_records(self.path), [dict(step=0),
+                                                   dict(step=1)])
+
+    def test_every(self):
+        with self.assertRaises(Exception):
+            FileSink(self.path, every=0)
+
+
+class TrainingRecordsTest(unittest.TestCase):
+
+    def test_logged_iterations(self):
+        random.seed(0)
+        cgraph = alg.mlp_cgraph(6, 2)
+        x, param_indices, data_indices = alg.mlp_leaves(6, 2)
+        records = []
+        alg.run_backprop_algorithm_batches(
+            cgraph, alg.mlp_data(6, 20), x, param_indices, data_indices,
+            n_iterations=7, metrics=CallbackSink(records.append, every=3))
+        self.assertEqual([r['step'] for r in records], [0, 3, 6])
+        for r in records:
+            self.assertEqual(len(r['params']), len(param_indices))
+            self.assertGreaterEqual(r['seconds'], 0.)
+            self.assertIsInstance(r['loss'], float)
+
+
+if __name__ == '__main__':
+    unittest.main()
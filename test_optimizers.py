@@ -0,0 +1,134 @@
+# test_optimizers.py
+"""
+tests of the optimizers: vectorized updates against scalar reference
+updates, learning rate schedules, state_dict round trips and the
+param vector layouts
+
+    python -m pytest test_optimizers.py
+"""
+import math
+import unittest
+
+import numpy as np
+
+import optimizers
+from backprop_ex import Param
+from optimizers import SGD, Momentum, Nesterov, Adam, RMSProp, \
+    LeafParams, NodeParams
+
+
+GRADS = [[0.5, -1.], [0.25, 2.], [-0.75, 0.1], [1., 1.]]
+
+
+def reference(name, p, grads, lr):
+    # scalar updates of each param in turn, written out per step
+    lr = lr if callable(lr) else optimizers.constant(lr)
+    p = list(p)
+    for k in range(len(p)):
+        a = b = 0.
+        for t, g in enumerate(grad[k] for grad in grads):
+            if name == 'sgd':
+                p[k] -= lr(t) * g
+            elif name == 'momentum':
+                a = 0.9 * a + g
+                p[k] -= lr(t) * a
+            elif name == 'nesterov':
+                a = 0.9 * a + g
+                p[k] -= lr(t) * (g + 0.9 * a)
+            elif name == 'adam':
+                a = 0.9 * a + 0.1 * g
+                b = 0.999 * b + 0.001 * g * g
+                m_hat, v_hat = a / (1 - 0.9 ** (t + 1)), \
+                    b / (1 - 0.999 ** (t + 1))
+                p[k] -= lr(t) * m_hat / math.sqrt(v_hat)
+            elif name == 'rmsprop':
+                b = 0.9 * b + 0.1 * g * g
+                p[k] -= lr(t) * g / math.sqrt(b)
+    return p
+
+
+class UpdateTest(unittest.TestCase):
+
+    optimizers = dict(sgd=SGD, momentum=Momentum, nesterov=Nesterov,
+                      adam=Adam, rmsprop=RMSProp)
+
+    def run_steps(self, optimizer, grads, vector=(1., -2.)):
+        vector = np.array(vector)
+        for grad in grads:
+            optimizer.step(vector, np.array(grad))
+        return vector
+
+    def test_updates(self):
+        for lr in (0.1, optimizers.exponential_decay(0.1, 0.5)):
+            for name, cls in self.optimizers.items():
+                vector = self.run_steps(cls(lr), GRADS)
+                np.testing.assert_allclose(
+                    vector, reference(name, [1., -2.], GRADS, lr), rtol=1e-6,
+                    err_msg=name)
+
+    def test_state_dict(self):
+        # stopped and resumed from a state_dict, as uninterrupted
+        for name, cls in self.optimizers.items():
+            uninterrupted = self.run_steps(cls(0.1), GRADS)
+            optimizer = cls(0.1)
+            vector = self.run_steps(optimizer, GRADS[:2])
+            state = optimizer.state_dict()
+            optimizer.step(vector * 0., np.ones(2))  # state is a copy
+            resumed = cls(0.1)
+            resumed.load_state_dict(state)
+            self.assertEqual(resumed.t, 2)
+            vector = self.run_steps(resumed, GRADS[2:], vector)
+            np.testing.assert_array_equal(vector, uninterrupted,
+                                          err_msg=name)
+
+
+class ScheduleTest(unittest.TestCase):
+
+    def test_schedules(self):
+        self.assertEqual(optimizers.constant(0.1)(7), 0.1)
+        decay = optimizers.step_decay(1., 0.5, 3)
+        self.assertEqual([decay(t) for t in range(7)],
+                         [1., 1., 1., 0.5, 0.5, 0.5, 0.25])
+        self.assertAlmostEqual(optimizers.exponential_decay(1., 0.9)(2), 0.81)
+        self.assertAlmostEqual(optimizers.inverse_time_decay(1., 0.5)(2), 0.5)
+        cosine = optimizers.cosine_decay(1., 10, 0.1)
+        self.assertEqual(cosine(0), 1.)
+        self.assertAlmostEqual(cosine(5), 0.55)
+        self.assertEqual(cosine(10), 0.1)
+        self.assertEqual(cosine(50), 0.1)
+
+    def test_schedule_follows_steps(self):
+        optimizer = SGD(optimizers.step_decay(1., 0.5, 2))
+        vector = np.zeros(1)
+        for _ in range(4):
+            optimizer.step(vector, np.ones(1))
+        self.assertEqual(vector.tolist(), [-3.])
+
+
+class ParamsLayoutTest(unittest.TestCase):
+
+    def test_leaf_params(self):
+        x = [0.5, np.array([[1., 2.], [3., 4.]]), None, -1.]
+        params = LeafParams(x, [3, 1, 0])
+        self.assertEqual(params.vector.tolist(), [-1., 1., 2., 3., 4., 0.5])
+        # array params are views into the vector
+        params.vector[1] = 10.
+        self.assertEqual(x[1][0, 0], 10.)
+        params.vector[0] = 7.
+        params.write_back()
+        self.assertEqual(x[3], 7.)
+        grad_table = [0.1, np.full((2, 2), 0.2), None, 0.3]
+        self.assertEqual(params.gradient(grad_table).tolist(),
+                         [0.3, 0.2, 0.2, 0.2, 0.2, 0.1])
+
+    def test_node_params(self):
+        a, b = Param('a', 1.), Param('b', 2.)
+        params = NodeParams([a, b])
+        self.assertEqual(params.gradient({b: 3.}).tolist(), [0., 3.])
+        params.vector += 1.
+        params.write_back()
+        self.assertEqual((a.value, b.value), (2., 3.))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+# test_parallel.py
+"""
+tests of data-parallel training: shared memory buffers against
+pickled shards
+
+    python -m pytest test_parallel.py
+"""
+import random
+import unittest
+
+import numpy as np
+
+import algorithms61_62 as alg
+import parallel
+from metrics import NullSink
+
+
+class SharedTest(unittest.TestCase):
+
+    def test_shared_matches_unshared(self):
+        random.seed(0)
+        cgraph = alg.mlp_cgraph(6, 3)
+        x0, param_indices, data_indices = alg.mlp_leaves(6, 3)
+        xb = alg.mlp_data(6, 60)
+        results = []
+        for shared, batched in ((False, False), (True, False), (True, True)):
+            x = list(x0)
+            result = parallel.run_backprop_algorithm_parallel(
+                cgraph, xb, x, param_indices, data_indices, n_workers=2,
+                n_iterations=3, seed=3, shared=shared, batched=batched,
+                metrics=NullSink())
+            self.assertEqual(result.iterations, 3)
+            results.append(([x[ix] for ix in param_indices], result.losses))
+        unshared_params, unshared_losses = results[0]
+        for params, losses in results[1:]:
+            np.testing.assert_allclose(params, unshared_params, rtol=1e-12)
+            np.testing.assert_allclose(losses, unshared_losses, rtol=1e-12)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+# test_passes.py
+"""
+tests of the graph passes: folded, fused and pruned graphs against the
+originals, and fused NodeFunction graphs
+
+    python -m pytest test_passes.py
+"""
+import copy
+import random
+import unittest
+
+import numpy as np
+
+import algorithms61_62 as alg
+import backprop_ex
+import benchmarks
+import tensor_graph
+from passes import FusedNode, optimize, optimize_node_function
+
+
+def chain_graph():
+    # leaf 1 constant, node 5 dead, 3 -> 4 a fusable chain
+    reverse_adj = {2: [0, 1], 3: [2], 4: [3], 5: [1], 6: [4, 1]}
+    nodes = [alg.SimpleNode(alg.sum_f, alg.sum_pd) for _ in range(7)]
+    nodes[3] = alg.SimpleNode(alg.sqdiff_f, alg.sqdiff_pd)
+    nodes[4] = alg.SimpleNode(alg.sqdiff_f, alg.sqdiff_pd)
+    return alg.SimpleCGraph(reverse_adj, nodes), \
+        [0.3, 0.7, None, None, None, None, None]
+
+
+class OptimizeTest(unittest.TestCase):
+
+    def test_fold_fuse_eliminate(self):
+        cgraph, x = chain_graph()
+        opt = optimize(cgraph, x, [0])
+        self.assertGreater(opt.stats['fused'], 0)
+        self.assertGreater(opt.stats['removed'], 0)
+        self.assertLess(opt.stats['nodes_after'], len(cgraph.nodes))
+        ref_val, ref_grads = alg.value_and_grad(cgraph, x)
+        val, grads = alg.value_and_grad(opt.cgraph, opt.leaf_values(x))
+        self.assertAlmostEqual(val, ref_val)
+        self.assertAlmostEqual(grads[opt.node_map[0]], ref_grads[0])
+        self.assertEqual(opt.grad_table(grads)[5], 0.)
+
+    def test_fold_frozen_layer(self):
+        # first layer weights and inputs constant: the layer is folded
+        n, k = 6, 3
+        random.seed(0)
+        cgraph = alg.mlp_cgraph(n, k)
+        x, param_indices, _ = alg.mlp_leaves(n, k)
+        live = param_indices[n // 2:] + [n * k + 1]
+        opt = optimize(cgraph, x, live)
+        self.assertGreater(opt.stats['folded'], 0)
+        ref_val, ref_grads = alg.value_and_grad(cgraph, x)
+        x_opt = opt.leaf_values(x)
+        val, grads = alg.value_and_grad(opt.cgraph, x_opt)
+        self.assertAlmostEqual(val, ref_val)
+        np.testing.assert_allclose([grads[m] for m in opt.indices(live)],
+                                   [ref_grads[i] for i in live])
+        # trained on the optimized graph, written back to x
+        x_opt[opt.indices(live)[0]] = 0.125
+        opt.write_back(x_opt, x, live)
+        self.assertEqual(x[live[0]], 0.125)
+
+    def test_tensor_graph(self):
+        cgraph = tensor_graph.mlp_tensor_graph(6, 2)
+        xt, param_indices, data_indices = tensor_graph.mlp_tensor_leaves(
+            alg.mlp_leaves(6, 2)[0], 6, 2)
+        opt = optimize(cgraph, xt, param_indices + data_indices)
+        ref_val, ref_grads = alg.value_and_grad(cgraph, xt)
+        val, grads = alg.value_and_grad(opt.cgraph, opt.leaf_values(xt))
+        np.testing.assert_allclose(val, ref_val)
+        for m, ix in zip(opt.indices(param_indices), param_indices):
+            np.testing.assert_allclose(grads[m], ref_grads[ix])
+
+    def test_own_nodes(self):
+        # alg61 keeps values on the nodes, the optimized graph has its own
+        cgraph, x = chain_graph()
+        opt = optimize(cgraph, x, [0])
+        originals = {id(node) for node in cgraph.nodes}
+        self.assertFalse(any(id(node) in originals
+                             for node in opt.cgraph.nodes))
+
+    def test_copy_nodes(self):
+        fused = FusedNode([alg.SimpleNode(alg.sum_f, alg.sum_pd),
+                           tensor_graph.Square()], val=2.)
+        for node in (fused, tensor_graph.Sum(axis=0, val=1.),
+                     alg.SimpleNode(alg.dot_f, alg.dot_pd, 3.)):
+            new = copy.copy(node)
+            self.assertIsNot(new, node)
+            self.assertEqual(new.val, node.val)
+            self.assertEqual(new.f([1., 2.]), node.f([1., 2.]))
+        self.assertEqual(fused.pd([1., 2.]), fused.vjp(1., [1., 2.]))
+
+
+class OptimizeNodeFunctionTest(unittest.TestCase):
+
+    def test_fused(self):
+        # chains on one param fuse, the distinct param chain does not
+        for (params, root), fusable in (
+                (backprop_ex.sample_graph(), True),
+                (benchmarks.mult_chain(30), True),
+                (benchmarks.mult_chain(30, distinct_params=True), False)):
+            forward_store = {}
+            ref_val = root.forward_prop(0.9, forward_store)
+            ref_grads = root.backward_all(forward_store)
+            fused = optimize_node_function(root)
+            self.assertEqual(len(fused.schedule) < len(root.schedule),
+                             fusable)
+            forward_store = {}
+            self.assertAlmostEqual(fused.forward_prop(0.9, forward_store),
+                                   ref_val)
+            grads = fused.backward_all(forward_store)
+            self.assertEqual(set(grads), set(ref_grads))
+            for param in ref_grads:
+                self.assertAlmostEqual(grads[param], ref_grads[param])
+            # params are shared with the original graph
+            params[0].value += 0.5
+            self.assertAlmostEqual(fused.infer(0.9), root.infer(0.9))
+
+    def test_incomplete_graph(self):
+        with self.assertRaises(backprop_ex.GraphError):
+            optimize_node_function(backprop_ex.Add('root',
+                                                   backprop_ex.Param('a', 1.)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+# test_profiling.py
+"""
+tests of the profiler: profiled runs give the unprofiled results and
+record per node, per op and per iteration
+
+    python -m pytest test_profiling.py
+"""
+import json
+import os
+import random
+import tempfile
+import unittest
+
+import algorithms61_62 as alg
+import benchmarks
+import tensor_graph
+from metrics import NullSink
+from profiling import Profiler, op_name
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        self.cgraph = alg.mlp_cgraph(6, 2)
+        self.x, self.param_indices, self.data_indices = alg.mlp_leaves(6, 2)
+
+    def test_value_and_grad(self):
+        profiler = Profiler()
+        ref_val, ref_grads = alg.value_and_grad(self.cgraph, self.x)
+        val, grads = alg.value_and_grad(self.cgraph, self.x,
+                                        profiler=profiler)
+        self.assertEqual((val, grads), (ref_val, ref_grads))
+        n_ops = len(self.cgraph.op_indices)
+        ops = {(phase, op): calls
+               for (phase, op), (calls, _) in profiler.ops.items()}
+        self.assertEqual(ops[('forward', 'dot_f')], n_ops - 1)
+        self.assertEqual(ops[('forward', 'sqdiff_f')], 1)
+        self.assertEqual(sum(calls for (phase, _), calls in ops.items()
+                             if phase == 'backward'), n_ops)
+        self.assertEqual(len(profiler.nodes), 2 * n_ops)
+
+    def test_op_name(self):
+        self.assertEqual(op_name(self.cgraph.nodes[-1]), 'sqdiff_f')
+        self.assertEqual(op_name(tensor_graph.MatMul()), 'MatMul')
+
+    def test_node_function(self):
+        profiler = Profiler()
+        params, root = benchmarks.mult_chain(5)
+        forward_store, profiled_store = {}, {}
+        value = root.forward_prop(2., forward_store)
+        grads = root.backward_all(forward_store)
+        self.assertEqual(root.forward_prop(2., profiled_store,
+                                           profiler=profiler), value)
+        self.assertEqual(profiled_store, forward_store)
+        self.assertEqual(root.backward_all(profiled_store, profiler=profiler),
+                         grads)
+        self.assertEqual(profiler.ops['forward', 'Mult'][0], 5)
+        self.assertEqual(profiler.ops['forward', 'Add'][0], 1)
+
+    def test_training_iterations(self):
+        # the same params as an unprofiled run, one record per epoch
+        results = []
+        profiler = Profiler()
+        for p in (None, profiler):
+            random.seed(1)
+            x = list(self.x)
+            alg.run_backprop_algorithm_batches(
+                self.cgraph, alg.mlp_data(6, 40), x, self.param_indices,
+                self.data_indices, n_iterations=3, metrics=NullSink(),
+                profiler=p)
+            results.append([x[ix] for ix in self.param_indices])
+        self.assertEqual(results[1], results[0])
+        self.assertEqual([r['iteration'] for r in profiler.iterations],
+                         [0, 1, 2])
+
+    def test_json_and_table(self):
+        profiler = Profiler()
+        alg.value_and_grad(self.cgraph, self.x, profiler=profiler)
+        profiler.count('pruned', 3)
+        profiler.iteration(0.5, steps=4)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'profile.json')
+            text = profiler.to_json(path)
+            with open(path) as f:
+                self.assertEqual(f.read(), text)
+        profile = json.loads(text)
+        self.assertEqual(profile['counters'], {'pruned': 3})
+        self.assertEqual(profile['iterations'],
+                         [dict(iteration=0, seconds=0.5, steps=4)])
+        seconds = [r['seconds'] for r in profile['ops']]
+        self.assertEqual(seconds, sorted(seconds, reverse=True))
+        table = profiler.table(top=3)
+        self.assertIn('dot_f', table)
+        self.assertIn('pruned', table)
+        profiler.reset()
+        self.assertEqual(profiler.to_dict(), dict(ops=[], nodes=[],
+                                                  counters={}, iterations=[]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# test_remat.py
+"""
+tests of rematerialization: checkpointed backward passes against
+value_and_grad and backward_all, memory budgets and the cached plan
+
+    python -m pytest test_remat.py
+"""
+import random
+import unittest
+
+import numpy as np
+
+import algorithms61_62 as alg
+import backprop_ex
+import benchmarks
+from remat import Rematerialization, plan_segments
+
+
+class CGraphTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        self.graphs = [(alg.mlp_cgraph(n, k), alg.mlp_leaves(n, k)[0])
+                       for n, k in ((6, 3), (40, 3))]
+        self.graphs.append((benchmarks.chain_cgraph(200),
+                            [1e-3] + [0.] * 200))
+
+    def test_value_and_grad(self):
+        for cgraph, x in self.graphs:
+            ref_val, ref_grads = alg.value_and_grad(cgraph, x)
+            # the budget of the last keeps every segment whole
+            for remat in (Rematerialization(),
+                          Rematerialization(segment_size=3),
+                          Rematerialization(budget=2 * len(x))):
+                val, grads = remat.value_and_grad(cgraph, x)
+                self.assertEqual(val, ref_val)
+                self.assertEqual([grads[i] for i in cgraph.leaf_indices],
+                                 [ref_grads[i] for i in cgraph.leaf_indices])
+                self.assertEqual(remat.stats['nodes'],
+                                 len(cgraph.op_indices))
+
+    def test_budget(self):
+        cgraph = benchmarks.chain_cgraph(400)
+        x = [1e-3] + [0.] * 400
+        peaks = []
+        for budget in (None, 150, 300, 1000):
+            remat = Rematerialization(budget=budget)
+            remat.value_and_grad(cgraph, x)
+            if budget is not None:
+                self.assertLessEqual(remat.stats['peak_values'], budget)
+            peaks.append((remat.stats['peak_values'],
+                          remat.stats['recomputed']))
+        # more memory, fewer recomputed nodes
+        self.assertEqual(peaks, sorted(peaks, key=lambda p: -p[1]))
+        self.assertEqual(peaks[-1][1], 0)
+        with self.assertRaises(Exception):
+            Rematerialization(budget=10).value_and_grad(cgraph, x)
+
+    def test_plan_cached(self):
+        cgraph, x = self.graphs[0]
+        remat = Rematerialization()
+        remat.value_and_grad(cgraph, x)
+        plan = remat._graph_plan
+        remat.value_and_grad(cgraph, x)
+        self.assertIs(remat._graph_plan, plan)
+        self.assertIsNone(cgraph._forward_adj)
+        other, x_other = self.graphs[1]
+        val, _ = remat.value_and_grad(other, x_other)
+        self.assertEqual(val, alg.alg61(other, x_other))
+
+    def test_batch_value_and_grad(self):
+        cgraph, x = self.graphs[0]
+        x = list(x)
+        x[alg.mlp_leaves(6, 3)[2][-1]] = np.array([1., -1., 0.5])  # y
+        ref = alg.batch_value_and_grad(cgraph, x)
+        val, grads = Rematerialization(segment_size=4).batch_value_and_grad(
+            cgraph, x)
+        self.assertAlmostEqual(val, ref[0])
+        for i in cgraph.leaf_indices:
+            np.testing.assert_allclose(grads[i], ref[1][i])
+
+    def test_plan_segments(self):
+        # a chain: each boundary is the last node of its segment
+        consumers = [[p + 1] for p in range(9)] + [[]]
+        size, boundary, kept = plan_segments(consumers, 3)
+        self.assertEqual((size, boundary, kept), (3, {2, 5, 8}, set()))
+        size, boundary, kept = plan_segments(consumers, 3, budget=9)
+        self.assertEqual(kept, {2, 3})
+
+
+class NodeFunctionTest(unittest.TestCase):
+
+    def test_backward_all(self):
+        for root in (backprop_ex.sample_graph()[1],
+                     benchmarks.mult_chain(30)[1],
+                     benchmarks.mult_chain(30, distinct_params=True)[1]):
+            forward_store = {}
+            ref_val = root.forward_prop(0.9, forward_store)
+            ref_grads = root.backward_all(forward_store)
+            val, grads = Rematerialization(segment_size=4).backward_all(root,
+                                                                        0.9)
+            self.assertEqual(val, ref_val)
+            self.assertEqual(set(grads), set(ref_grads))
+            for param in ref_grads:
+                self.assertAlmostEqual(grads[param], ref_grads[param])
+
+    def test_replanned_on_new_schedule(self):
+        params, root = benchmarks.mult_chain(10, distinct_params=True)
+        remat = Rematerialization(segment_size=4)
+        remat.backward_all(root, 0.9)
+        param = backprop_ex.Param('b', 2.)
+        root.schedule[0].add_child(backprop_ex.Mult('extra', param))
+        root.set_complete()
+        val, grads = remat.backward_all(root, 0.9)
+        self.assertEqual(val, root.infer(0.9))
+        self.assertIn(param, grads)
+
+
+if __name__ == '__main__':
+    unittest.main()
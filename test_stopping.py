@@ -0,0 +1,154 @@
+# test_stopping.py
+"""
+tests of the stopping criteria: each reason to stop, restoring the
+best params on validation patience, and the training results
+
+    python -m pytest test_stopping.py
+"""
+import random
+import unittest
+
+import numpy as np
+
+import algorithms61_62 as alg
+import backprop_ex
+from metrics import NullSink
+from stopping import StoppingCriteria, TrainingResult
+
+
+class CriteriaTest(unittest.TestCase):
+
+    def test_target_loss(self):
+        stopping = StoppingCriteria(target_loss=0.5)
+        self.assertIsNone(stopping.check(0, 0.6))
+        self.assertEqual(stopping.check(1, 0.5), 'target_loss')
+
+    def test_loss_tol(self):
+        stopping = StoppingCriteria(loss_tol=1e-3)
+        self.assertIsNone(stopping.check(0, 1.))
+        self.assertIsNone(stopping.check(1, 0.9))
+        self.assertEqual(stopping.check(2, 0.9005), 'loss_tol')
+
+    def test_grad_tol(self):
+        stopping = StoppingCriteria(grad_tol=0.1)
+        self.assertIsNone(stopping.check(0, 1., np.array([0.3, 0.4])))
+        self.assertIsNone(stopping.check(1, 1.))
+        self.assertEqual(stopping.check(2, 1., np.array([0.06, 0.08])),
+                         'grad_tol')
+
+    def test_time_budget(self):
+        stopping = StoppingCriteria(time_budget=0.)
+        self.assertEqual(stopping.check(0, 1.), 'time_budget')
+
+    def test_patience(self):
+        losses = iter([3., 2., 2.5, 1.9995, 2.2])
+        stopping = StoppingCriteria(validation=lambda x: next(losses),
+                                    patience=3, min_delta=1e-3,
+                                    restore_best=False)
+        reasons = [stopping.check(i, None, x=[0.]) for i in range(5)]
+        self.assertEqual(reasons, [None] * 4 + ['patience'])
+        self.assertEqual(stopping.validation_losses, [3., 2., 2.5, 1.9995,
+                                                      2.2])
+
+    def test_validation_every(self):
+        calls = []
+        stopping = StoppingCriteria(validation=lambda x: calls.append(x) or 1.,
+                                    validation_every=3)
+        for i in range(7):
+            stopping.check(i, None, x=[i])
+        self.assertEqual(calls, [[0], [3], [6]])
+
+    def test_restore_best(self):
+        # x set back in place to a copy of the best evaluation's values
+        x = [1., np.array([1., 2.])]
+        best = iter([1., 0.5, 0.7, 0.8])
+        stopping = StoppingCriteria(validation=lambda x: next(best),
+                                    patience=2)
+        for i in range(4):
+            reason = stopping.check(i, None, x=x)
+            if i == 1:
+                best_x = [x[0], x[1].copy()]
+            x[0] += 1.
+            x[1] += 1.
+        self.assertEqual(reason, 'patience')
+        self.assertEqual(x[0], best_x[0] + 1.)
+        np.testing.assert_array_equal(x[1], best_x[1] + 1.)
+        self.assertEqual(stopping.best_validation_loss, 0.5)
+
+    def test_start_resets(self):
+        stopping = StoppingCriteria(loss_tol=1e-3)
+        stopping.check(0, 1.)
+        stopping.start()
+        self.assertIsNone(stopping.check(0, 1.))
+
+    def test_arguments(self):
+        with self.assertRaises(Exception):
+            StoppingCriteria(patience=0)
+        with self.assertRaises(Exception):
+            StoppingCriteria(validation_every=0)
+
+
+class TrainingResultTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        self.cgraph = alg.mlp_cgraph(6, 2)
+        self.x, self.param_indices, self.data_indices = alg.mlp_leaves(6, 2)
+        xb = alg.mlp_data(6, 60)
+        self.xb_train, self.xb_validation = alg.train_validation_split(xb,
+                                                                       0.2)
+
+    def test_validation_loss(self):
+        loss = alg.validation_loss(self.cgraph, self.xb_validation,
+                                   self.data_indices, batch_size=5)
+        total = 0.
+        for xs_e, y in self.xb_validation:
+            x = list(self.x)
+            for m, xdata_ix in enumerate(self.data_indices[:-1]):
+                x[xdata_ix] = xs_e[m]
+            x[self.data_indices[-1]] = y
+            total += alg.alg61(self.cgraph, x)
+        self.assertAlmostEqual(loss(self.x),
+                               total / len(self.xb_validation))
+        with self.assertRaises(Exception):
+            alg.validation_loss(alg.FlatCGraph.from_cgraph(self.cgraph),
+                                self.xb_validation, self.data_indices)
+
+    def test_patience_restores_best(self):
+        validation = alg.validation_loss(self.cgraph, self.xb_validation,
+                                         self.data_indices)
+        stopping = StoppingCriteria(validation=validation, patience=3)
+        x = list(self.x)
+        result = alg.run_backprop_algorithm_batches(
+            self.cgraph, self.xb_train, x, self.param_indices,
+            self.data_indices, learning_rate=0.05, n_iterations=500,
+            metrics=NullSink(), stopping=stopping)
+        self.assertIsInstance(result, TrainingResult)
+        self.assertEqual(result.reason, 'patience')
+        self.assertEqual(result.iterations, len(result.losses))
+        self.assertEqual(result.validation_losses, stopping.validation_losses)
+        self.assertAlmostEqual(validation(x), min(result.validation_losses))
+
+    def test_full_batch_reasons(self):
+        cgraph, x = alg.SimpleCGraph(
+            alg.sample_graph_structure(),
+            [alg.SimpleNode(alg.sqdiff_f, alg.sqdiff_pd)] * 6), [1., 0.5, 0.2]
+        result = alg.run_backprop_algorithm(
+            cgraph, x, [0, 1, 2], n_iterations=50, metrics=NullSink())
+        self.assertEqual((result.reason, result.iterations),
+                         ('n_iterations', 50))
+        result = alg.run_backprop_algorithm(
+            cgraph, x, [0, 1, 2], n_iterations=10**5, metrics=NullSink(),
+            stopping=StoppingCriteria(target_loss=1e-3))
+        self.assertEqual(result.reason, 'target_loss')
+        self.assertLessEqual(result.loss, 1e-3)
+
+    def test_backprop_ex_rejects_validation(self):
+        with self.assertRaises(Exception):
+            backprop_ex.run_backprop_algorithm(
+                metrics=NullSink(),
+                stopping=StoppingCriteria(validation=lambda x: 0.))
+
+
+if __name__ == '__main__':
+    unittest.main()